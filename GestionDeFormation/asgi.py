@@ -2,6 +2,10 @@
 ASGI config for GestionDeFormation project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The live notification endpoints (users:notification_stream / notification_poll)
+are async views: serve them with an ASGI server, e.g.
+``uvicorn GestionDeFormation.asgi:application``, so idle connections do not
+each hold a worker thread.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
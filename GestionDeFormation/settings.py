@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 AUTH_USER_MODEL = 'users.User'
+AUTHENTICATION_BACKENDS = ['users.backends.CachedUserBackend']
 
 
 LOGIN_URL = 'login'  # Replace with your custom login URL
@@ -50,11 +51,14 @@ LOGOUT_REDIRECT_URL = 'login'
 
 
 MIDDLEWARE = [
+    'users.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'users.middleware.ReplicaStickinessMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.middleware.AuditActorMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -83,12 +87,63 @@ WSGI_APPLICATION = 'GestionDeFormation.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
+# New SQLite connections get users.database.DEFAULT_SQLITE_PRAGMAS (WAL, busy_timeout...);
+# write paths begin their transactions IMMEDIATE through users.database.write_atomic.
 
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # Keep connections between requests; the health check replaces broken ones.
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    },
+    # Local read replica stand-in, refreshed from the primary by `manage.py snapshot_replica`.
+    # Under test it mirrors 'default'.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.replica.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    },
+    # Structure shards for enrollments and notifications (users.sharding); unused until
+    # STRUCTURE_SHARDS maps a structure to them. Create with `manage.py migrate --database=shard_1`.
+    'shard_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.shard_1.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    },
+    'shard_2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.shard_2.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    },
+}
+
+# Reference data (formations, structures, departments, spend summaries) is read from these
+# aliases (users.routers.PrimaryReplicaRouter); empty reads everything from 'default'.
+# After a write the client stays on the primary for REPLICA_STICKY_SECONDS.
+DATABASE_ROUTERS = ['users.routers.StructureShardRouter', 'users.routers.PrimaryReplicaRouter']
+READ_REPLICAS = []
+REPLICA_STICKY_SECONDS = 10
+
+# Enrollments and notifications of the users of a structure live on the structure's shard:
+# {structure_id: alias}. Structures not listed, and all other tables, stay on 'default'.
+# After changing it, run `manage.py rebalance_shards` to move the rows.
+SHARD_DATABASES = ['shard_1', 'shard_2']
+STRUCTURE_SHARDS = {}
+
+# Cached user snapshots (users.backends), reference data, the catalog and the login throttle
+# are invalidated through this cache, so every worker process must see the same one: the
+# app refuses to start on LocMemCache. Use Redis or Memcached when workers span several hosts.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.django_cache',
+    },
 }
 
 
@@ -135,3 +190,43 @@ STATICFILES_DIRS = [
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Notification retention, applied by `manage.py archive_notifications`.
+# 'archive' keeps a compressed copy in NotificationArchive, 'delete' drops the rows.
+
+NOTIFICATION_RETENTION_POLICIES = [
+    {'name': 'read', 'is_read': True, 'days': 90, 'action': 'archive'},
+    {'name': 'unread', 'is_read': False, 'days': 365, 'action': 'archive'},
+]
+
+# Delivered outbox events are purged by `manage.py run_outbox_worker` once processed this many days ago.
+
+OUTBOX_RETENTION_DAYS = 7
+
+# Login throttling: scope -> (attempts, sliding window in seconds), checked before password hashing.
+
+LOGIN_THROTTLE_RATES = {
+    'ip': (20, 60),
+    'email': (5, 300),
+}
+
+# Request metrics (users.middleware.MetricsMiddleware), scraped from /metrics.
+# Every request is timed; METRICS_SAMPLE_RATE is the share whose SQL is also recorded (0 turns that off).
+
+METRICS_SAMPLE_RATE = 1.0
+METRICS_DUPLICATE_QUERY_THRESHOLD = 5
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# One JSON line per sampled request goes to the users.metrics logger at INFO; raise it to see them.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'users': {'handlers': ['console'], 'level': 'INFO'},
+        'users.metrics': {'level': 'WARNING'},
+    },
+}
@@ -1,15 +1,30 @@
 
 
 
+import io
+import json
+import logging
 from django.contrib import admin
 from django.urls import path, reverse
 from django.utils.html import format_html
 from django.contrib import messages
 from django.shortcuts import redirect
+from django.http import JsonResponse
+from django.template.response import TemplateResponse
 from django.contrib.auth import logout
 from django.utils import timezone
 from django import forms
-from .models import User, Structure, Department, Formation, UserFormation, Notification
+from django.db import transaction
+from .models import User, Structure, Department, Formation, UserFormation, Notification, OutboxEvent, TrainingSpendSummary
+from .analytics import DASHBOARD_MONTHS, spend_dashboard
+from .approvals import decide_users, decide_user_formations
+from .changelists import LargeTableAdminMixin, choices_filter, department_filter, structure_filter
+from .exports import EXPORTS, scope_for_user, stream_csv, xlsx_available, xlsx_response
+from .imports import import_formations, read_rows
+from .outbox import enqueue_notification
+from .review import DECIDED_STATES, REVIEW_MAX_DECISIONS, REVIEW_PAGE_SIZE, commit_decisions, review_page
+
+logger = logging.getLogger(__name__)
 
 # Customize Admin Site
 admin.site.site_header = "TMS"
@@ -21,13 +36,101 @@ def user_logout(request):
     messages.success(request, "You have been logged out.")
     return redirect('')
 
-class UserAdmin(admin.ModelAdmin):
+def report_decision(model_admin, request, result, noun, verb):
+    message = f"{result.updated} {noun} successfully {verb}."
+    skipped = result.selected - result.updated
+    if skipped:
+        message += f" {skipped} selected item(s) were not pending and were left unchanged."
+    model_admin.message_user(request, message)
+
+class ExportMixin:
+    # Adds CSV/XLSX export actions and an export/<fmt>/ view over the whole (scoped) changelist.
+    export_name = None
+
+    def export(self, request, queryset, fmt):
+        structure_path, _ = EXPORTS[self.export_name]
+        queryset = scope_for_user(queryset, request.user, structure_path)
+        if fmt == 'xlsx':
+            if not xlsx_available():
+                self.message_user(request, "XLSX export requires the openpyxl package.", level=messages.ERROR)
+                return None
+            return xlsx_response(queryset, self.export_name)
+        return stream_csv(queryset, self.export_name)
+
+    def export_csv(self, request, queryset):
+        return self.export(request, queryset, 'csv')
+    export_csv.short_description = "Export selected to CSV"
+
+    def export_xlsx(self, request, queryset):
+        return self.export(request, queryset, 'xlsx')
+    export_xlsx.short_description = "Export selected to Excel"
+
+    def export_view(self, request, fmt):
+        if fmt not in ('csv', 'xlsx') or not self.has_view_permission(request):
+            return redirect(f'admin:{self.opts.app_label}_{self.opts.model_name}_changelist')
+        response = self.export(request, self.get_queryset(request), fmt)
+        return response or redirect(f'admin:{self.opts.app_label}_{self.opts.model_name}_changelist')
+
+    def get_urls(self):
+        custom_urls = [
+            path('export/<str:fmt>/', self.admin_site.admin_view(self.export_view),
+                 name=f'{self.opts.app_label}_{self.opts.model_name}_export'),
+        ]
+        return custom_urls + super().get_urls()
+
+class ReviewQueueMixin:
+    # Keyboard review queue: pages of pending items, decisions committed in one POST.
+    review_kind = None
+    change_list_template = 'admin/users/review_change_list.html'
+
+    def review_view(self, request):
+        context = {
+            **self.admin_site.each_context(request),
+            'title': f"Review {self.opts.verbose_name_plural.lower()}",
+            'opts': self.opts,
+            'review_kind': self.review_kind,
+            'page_size': REVIEW_PAGE_SIZE,
+        }
+        return TemplateResponse(request, 'admin/users/review_queue.html', context)
+
+    def review_items_view(self, request):
+        after = request.GET.get('after', '0')
+        after = int(after) if after.isdigit() else 0
+        items = review_page(self.get_queryset(request), self.review_kind, after)
+        return JsonResponse({'status': 'success', 'items': items, 'more': len(items) == REVIEW_PAGE_SIZE})
+
+    def review_commit_view(self, request):
+        if request.method != 'POST':
+            return JsonResponse({'status': 'error', 'message': 'POST required.'}, status=405)
+        if not self.has_change_permission(request):
+            return JsonResponse({'status': 'error', 'message': 'Permission denied.'}, status=403)
+        try:
+            decisions = {int(pk): decision for pk, decision in json.loads(request.body)['decisions'].items()}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return JsonResponse({'status': 'error', 'message': 'Invalid decisions.'}, status=400)
+        if not decisions or len(decisions) > REVIEW_MAX_DECISIONS or not set(decisions.values()) <= set(DECIDED_STATES):
+            return JsonResponse({'status': 'error', 'message': 'Invalid decisions.'}, status=400)
+        results = commit_decisions(self.get_queryset(request), self.review_kind, decisions, actor=request.user)
+        return JsonResponse({'status': 'success', 'results': {str(pk): status for pk, status in results.items()}})
+
+    def get_urls(self):
+        prefix = f'{self.opts.app_label}_{self.opts.model_name}'
+        custom_urls = [
+            path('review/', self.admin_site.admin_view(self.review_view), name=f'{prefix}_review'),
+            path('review/items/', self.admin_site.admin_view(self.review_items_view), name=f'{prefix}_review_items'),
+            path('review/commit/', self.admin_site.admin_view(self.review_commit_view), name=f'{prefix}_review_commit'),
+        ]
+        return custom_urls + super().get_urls()
+
+class UserAdmin(LargeTableAdminMixin, ExportMixin, admin.ModelAdmin):
     list_display = ('user_email', 'user_username', 'user_firstname', 'user_lastname', 'user_role', 'structure', 'department', 'state', 'user_cree_date')
-    list_filter = ('user_role', 'state', 'structure', 'department')
+    list_filter = ('user_role', 'state', structure_filter('structure'), department_filter('department', 'structure'))
+    list_select_related = ('structure', 'department__structure')
     search_fields = ('user_email', 'user_username', 'user_firstname', 'user_lastname', 'structure__structure_varchar', 'department__department_name')
     ordering = ('user_email',)
     readonly_fields = ('user_cree_par', 'user_cree_date', 'user_miseajour_par', 'user_miseajour_date')
-    actions = ['validate_users', 'refuse_users']
+    actions = ['validate_users', 'refuse_users', 'export_csv', 'export_xlsx']
+    export_name = 'users'
 
     fieldsets = (
         (None, {'fields': ('user_email', 'user_username', 'user_firstname', 'user_lastname')}),
@@ -38,30 +141,22 @@ class UserAdmin(admin.ModelAdmin):
 
 
     def validate_users(self, request, queryset):
-        updated = queryset.filter(state='pending').update(state='approved', is_active=True)
-        for user in queryset.filter(state='pending'):
-            Notification.objects.create(
-                user=user,
-                message=f"Your account has been validated. Welcome to TMS!",
-            )
-        self.message_user(request, f"{updated} user(s) successfully validated.")
+        result = decide_users(queryset, 'approve', actor=request.user)
+        report_decision(self, request, result, "user(s)", "validated")
     validate_users.short_description = "Validate selected users"
 
     def refuse_users(self, request, queryset):
-        updated = queryset.filter(state='pending').update(state='rejected', is_active=False)
-        for user in queryset.filter(state='pending'):
-            Notification.objects.create(
-                user=user,
-                message=f"Your account request has been refused.",
-            )
-        self.message_user(request, f"{updated} user(s) successfully refused.")
+        result = decide_users(queryset, 'refuse', actor=request.user)
+        report_decision(self, request, result, "user(s)", "refused")
     refuse_users.short_description = "Refuse selected users"
 
-class AccountsDemandedAdmin(admin.ModelAdmin):
+class AccountsDemandedAdmin(ReviewQueueMixin, LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('user_email', 'user_username', 'user_firstname', 'user_lastname', 'user_role', 'structure', 'department', 'user_cree_date', 'validate_button', 'refuse_button')
-    list_filter = ('user_role', 'structure', 'department')
+    list_filter = ('user_role', structure_filter('structure'), department_filter('department', 'structure'))
+    list_select_related = ('structure', 'department__structure')
     search_fields = ('user_email', 'user_username', 'user_firstname', 'user_lastname', 'structure__structure_varchar', 'department__department_name')
-    ordering = ('user_cree_date',)
+    ordering = ('user_cree_date', 'pk')
+    review_kind = 'users'
     readonly_fields = ('user_email', 'user_username', 'user_firstname', 'user_lastname', 'user_role', 'structure', 'department', 'user_cree_par', 'user_cree_date', 'user_miseajour_par', 'user_miseajour_date')
 
     def get_queryset(self, request):
@@ -104,25 +199,23 @@ class AccountsDemandedAdmin(admin.ModelAdmin):
             # Check if DRH is trying to validate a user outside their structure
             if request.user.user_role == 'DRH' and user.structure != request.user.structure:
                 self.message_user(request, "You can only validate users from your structure.", level=messages.ERROR)
-                print(f"Permission denied for DRH {request.user.username}: User {user.user_username} not in structure")
+                logger.warning("Permission denied for DRH %s: user %s not in structure", request.user.user_username, user.user_username)
                 return redirect('admin:users_accountsdemanded_changelist')
-            print(f"Validating user: {user.user_username} (ID: {pk})")
+            logger.info("Validating user %s (ID: %s)", user.user_username, pk)
             user.state = 'approved'
             user.is_active = True
             if user.user_role == 'DRH':
                 user.is_superuser = True
                 user.is_staff = True
-                print(f"User {user.user_username} set as superuser (role: drh)")
-            user.save()
-            Notification.objects.create(
-                user=user,
-                message=f"Your account has been validated. Welcome to TMS!",
-            )
+                logger.info("User %s set as superuser (role: DRH)", user.user_username)
+            with transaction.atomic():
+                user.save()
+                enqueue_notification(user, "Your account has been validated. Welcome to TMS!")
             self.message_user(request, f"User {user.user_username} successfully validated.")
-            print(f"User {user.user_username} validated successfully")
+            logger.info("User %s validated", user.user_username)
         except User.DoesNotExist:
             self.message_user(request, "User not found or already processed.", level=messages.ERROR)
-            print(f"User not found or already processed: ID {pk}")
+            logger.warning("User not found or already processed: ID %s", pk)
         return redirect('admin:users_accountsdemanded_changelist')
 
     def refuse_user(self, request, pk):
@@ -131,21 +224,19 @@ class AccountsDemandedAdmin(admin.ModelAdmin):
             # Check if DRH is trying to refuse a user outside their structure
             if request.user.user_role == 'DRH' and user.structure != request.user.structure:
                 self.message_user(request, "You can only refuse users from your structure.", level=messages.ERROR)
-                print(f"Permission denied for DRH {request.user.username}: User {user.user_username} not in structure")
+                logger.warning("Permission denied for DRH %s: user %s not in structure", request.user.user_username, user.user_username)
                 return redirect('admin:users_accountsdemanded_changelist')
-            print(f"Refusing user: {user.user_username} (ID: {pk})")
+            logger.info("Refusing user %s (ID: %s)", user.user_username, pk)
             user.state = 'rejected'
             user.is_active = False
-            user.save()
-            Notification.objects.create(
-                user=user,
-                message=f"Your account request has been refused.",
-            )
+            with transaction.atomic():
+                user.save()
+                enqueue_notification(user, "Your account request has been refused.")
             self.message_user(request, f"User {user.user_username} successfully refused.")
-            print(f"User {user.user_username} refused successfully")
+            logger.info("User %s refused", user.user_username)
         except User.DoesNotExist:
             self.message_user(request, "User not found or already processed.", level=messages.ERROR)
-            print(f"User not found or already processed: ID {pk}")
+            logger.warning("User not found or already processed: ID %s", pk)
         return redirect('admin:users_accountsdemanded_changelist')
 
     def has_change_permission(self, request, obj=None):
@@ -169,7 +260,8 @@ class StructureAdmin(admin.ModelAdmin):
 
 class DepartmentAdmin(admin.ModelAdmin):
     list_display = ('department_name', 'department_code', 'structure', 'department_cree_date')
-    list_filter = ('structure',)
+    list_filter = (structure_filter('structure'),)
+    list_select_related = ('structure',)
     search_fields = ('department_name', 'department_code', 'structure__structure_varchar')
     ordering = ('department_name',)
     readonly_fields = ('department_cree_par', 'department_cree_date', 'department_miseajour_par', 'department_miseajour_date')
@@ -183,9 +275,14 @@ class DepartmentAdmin(admin.ModelAdmin):
         # Only superusers who are not DRH can access the User section
         return request.user.is_superuser
 
+class FormationImportForm(forms.Form):
+    file = forms.FileField(help_text="CSV or JSON with one formation per row, keyed by structure_code and formation_ref.")
+    dry_run = forms.BooleanField(required=False, help_text="Validate and count without saving.")
+
 class FormationAdmin(admin.ModelAdmin):
     list_display = ('formation_titre', 'formation_ref', 'formation_niveau', 'formation_cout', 'formation_pays', 'formation_category', 'structure')
-    list_filter = ('formation_niveau', 'formation_pays', 'formation_category', 'structure')
+    list_filter = ('formation_niveau', 'formation_pays', 'formation_category', structure_filter('structure'))
+    list_select_related = ('structure',)
     search_fields = ('formation_titre', 'formation_ref', 'structure__structure_varchar')
     ordering = ('formation_titre',)
     exclude = ('user_id',)
@@ -195,6 +292,45 @@ class FormationAdmin(admin.ModelAdmin):
         (None, {'fields': ('formation_titre', 'formation_ref', 'formation_niveau', 'formation_description', 'formation_cout', 'formation_pays', 'formation_duree', 'formation_prerequis', 'formation_programme', 'formation_cible', 'formation_objectif', 'formation_category', 'structure')}),
         ('Audit Info', {'fields': ('formation_mise_a_jour_cree', 'formation_mise_a_jour_date')}),
     )
+    change_list_template = 'admin/users/formation/change_list.html'
+
+    def get_urls(self):
+        custom_urls = [
+            path('import/', self.admin_site.admin_view(self.import_view), name='users_formation_import'),
+        ]
+        return custom_urls + super().get_urls()
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            return redirect('admin:users_formation_changelist')
+        form = FormationImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            fmt = 'json' if upload.name.lower().endswith(('.json', '.jsonl')) else 'csv'
+            # DRH users may only load formations into their own structure.
+            structures = [request.user.structure_id] if request.user.user_role == 'DRH' else None
+            try:
+                rows = read_rows(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''), fmt)
+                result = import_formations(rows, dry_run=form.cleaned_data['dry_run'], structures=structures)
+            except (UnicodeDecodeError, ValueError) as error:
+                self.message_user(request, f"Could not read the file: {error}", level=messages.ERROR)
+            else:
+                prefix = "Dry run: " if form.cleaned_data['dry_run'] else ""
+                self.message_user(
+                    request,
+                    f"{prefix}{result.inserted} inserted, {result.updated} updated, {result.rejected} rejected.",
+                    level=messages.WARNING if result.rejected else messages.SUCCESS,
+                )
+                for line, message in result.errors[:20]:
+                    self.message_user(request, f"Line {line}: {message}", level=messages.ERROR)
+                return redirect('admin:users_formation_changelist')
+        context = {
+            **self.admin_site.each_context(request),
+            'title': "Import formations",
+            'opts': self.model._meta,
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/users/formation/import.html', context)
 
 class UserFormationAdminForm(forms.ModelForm):
     STATE_CHOICES = (
@@ -208,14 +344,22 @@ class UserFormationAdminForm(forms.ModelForm):
         model = UserFormation
         fields = '__all__'
 
-class UserFormationAdmin(admin.ModelAdmin):
+class UserFormationAdmin(LargeTableAdminMixin, ExportMixin, admin.ModelAdmin):
     form = UserFormationAdminForm
     list_display = ('user', 'formation', 'date_inscription', 'state_formation', 'get_valide_date')
-    list_filter = ('state_formation', 'date_inscription')
+    # Every state an enrollment can reach, including those set outside this form.
+    STATE_FILTER_CHOICES = UserFormationAdminForm.STATE_CHOICES + (
+        ('validated', 'Validated'),
+        ('cancelled', 'Cancelled'),
+    )
+    list_filter = (choices_filter('state_formation', STATE_FILTER_CHOICES), 'date_inscription')
+    list_select_related = ('user', 'formation')
     search_fields = ('user__user_username', 'formation__formation_titre')
-    ordering = ('date_inscription',)
+    # 'pk' keeps the ordering total so the admin doesn't append '-pk' and defeat the date index.
+    ordering = ('date_inscription', 'pk')
     readonly_fields = ('valide_par', 'valide_date', 'date_inscription')
-    actions = ['validate_formations', 'refuse_formations']
+    actions = ['validate_formations', 'refuse_formations', 'export_csv', 'export_xlsx']
+    export_name = 'enrollments'
 
     def get_valide_date(self, obj):
         return obj.valide_date if obj.valide_date else '-'
@@ -236,39 +380,25 @@ class UserFormationAdmin(admin.ModelAdmin):
         return super().formfield_for_choice_field(db_field, request, **kwargs)
 
     def validate_formations(self, request, queryset):
-        updated = queryset.filter(state_formation='pending').update(
-            state_formation='approved',
-            valide_par=request.user,
-            valide_date=timezone.now()
-        )
-        for user_formation in queryset.filter(state_formation='pending'):
-            Notification.objects.create(
-                user=user_formation.user,
-                message=f"Your registration for '{user_formation.formation.formation_titre}' has been validated."
-            )
-        self.message_user(request, f"{updated} formation registration(s) successfully validated.")
+        result = decide_user_formations(queryset, 'approve', actor=request.user)
+        report_decision(self, request, result, "formation registration(s)", "validated")
     validate_formations.short_description = "Validate selected formations"
 
     def refuse_formations(self, request, queryset):
-        updated = queryset.filter(state_formation='pending').update(
-            state_formation='rejected',
-            valide_par=request.user,
-            valide_date=timezone.now()
-        )
-        for user_formation in queryset.filter(state_formation='pending'):
-            Notification.objects.create(
-                user=user_formation.user,
-                message=f"Your registration for '{user_formation.formation.formation_titre}' has been refused."
-            )
-        self.message_user(request, f"{updated} formation registration(s) successfully refused.")
+        result = decide_user_formations(queryset, 'refuse', actor=request.user)
+        report_decision(self, request, result, "formation registration(s)", "refused")
     refuse_formations.short_description = "Refuse selected formations"
 
-class PendingUserFormationsAdmin(admin.ModelAdmin):
+class PendingUserFormationsAdmin(ReviewQueueMixin, LargeTableAdminMixin, ExportMixin, admin.ModelAdmin):
     list_display = ('user', 'formation', 'date_inscription', 'state_formation', 'get_valide_date', 'validate_button', 'refuse_button')
-    list_filter = ('state_formation', 'date_inscription', 'formation__structure')
+    list_filter = ('date_inscription', structure_filter('formation__structure'))
+    list_select_related = ('user', 'formation')
     search_fields = ('user__user_username', 'formation__formation_titre')
-    ordering = ('date_inscription',)
+    ordering = ('date_inscription', 'pk')
     readonly_fields = ('user', 'formation', 'date_inscription', 'valide_par', 'valide_date')
+    actions = ['export_csv', 'export_xlsx']
+    export_name = 'enrollments'
+    review_kind = 'enrollments'
 
     def get_queryset(self, request):
         qs = UserFormation.objects.filter(state_formation='pending')
@@ -314,21 +444,23 @@ class PendingUserFormationsAdmin(admin.ModelAdmin):
             # Check if DRH is trying to validate a formation outside their structure
             if request.user.user_role == 'DRH' and user_formation.formation.structure != request.user.structure:
                 self.message_user(request, "You can only validate formations from your structure.", level=messages.ERROR)
-                print(f"Permission denied for DRH {request.user.username}: Formation {user_formation.formation.formation_titre} not in structure")
+                logger.warning("Permission denied for DRH %s: formation %s not in structure", request.user.user_username, user_formation.formation.formation_titre)
                 return redirect('admin:users_pendinguserformations_changelist')
-            print(f"Validating formation for user: {user_formation.user.user_username}, formation: {user_formation.formation.formation_titre} (ID: {pk})")
+            logger.info("Validating formation registration %s: user %s, formation %s", pk, user_formation.user.user_username, user_formation.formation.formation_titre)
             user_formation.state_formation = 'approved'
+            user_formation.valide_par = request.user.user_username
             user_formation.valide_date = timezone.now()
-            user_formation.save()
-            Notification.objects.create(
-                user=user_formation.user,
-                message=f"Your registration for '{user_formation.formation.formation_titre}' has been validated."
-            )
+            with transaction.atomic():
+                user_formation.save()
+                enqueue_notification(
+                    user_formation.user,
+                    f"Your registration for '{user_formation.formation.formation_titre}' has been validated."
+                )
             self.message_user(request, f"Formation registration for {user_formation.user.user_username} successfully validated.")
-            print(f"Formation registration validated successfully for user: {user_formation.user.user_username}")
+            logger.info("Formation registration %s validated for user %s", pk, user_formation.user.user_username)
         except UserFormation.DoesNotExist:
             self.message_user(request, "Formation registration not found or already processed.", level=messages.ERROR)
-            print(f"Formation registration not found or already processed: ID {pk}")
+            logger.warning("Formation registration not found or already processed: ID %s", pk)
         return redirect('admin:users_pendinguserformations_changelist')
 
     def refuse_user_formation(self, request, pk):
@@ -337,33 +469,85 @@ class PendingUserFormationsAdmin(admin.ModelAdmin):
             # Check if DRH is trying to refuse a formation outside their structure
             if request.user.user_role == 'DRH' and user_formation.formation.structure != request.user.structure:
                 self.message_user(request, "You can only refuse formations from your structure.", level=messages.ERROR)
-                print(f"Permission denied for DRH {request.user.username}: Formation {user_formation.formation.formation_titre} not in structure")
+                logger.warning("Permission denied for DRH %s: formation %s not in structure", request.user.user_username, user_formation.formation.formation_titre)
                 return redirect('admin:users_pendinguserformations_changelist')
-            print(f"Refusing formation for user: {user_formation.user.user_username}, formation: {user_formation.formation.formation_titre} (ID: {pk})")
+            logger.info("Refusing formation registration %s: user %s, formation %s", pk, user_formation.user.user_username, user_formation.formation.formation_titre)
             user_formation.state_formation = 'rejected'
-            user_formation.valide_par = request.user.user_id
+            user_formation.valide_par = request.user.user_username
             user_formation.valide_date = timezone.now()
-            user_formation.save()
-            Notification.objects.create(
-                user=user_formation.user,
-                message=f"Your registration for '{user_formation.formation.formation_titre}' has been refused."
-            )
+            with transaction.atomic():
+                user_formation.save()
+                enqueue_notification(
+                    user_formation.user,
+                    f"Your registration for '{user_formation.formation.formation_titre}' has been refused."
+                )
             self.message_user(request, f"Formation registration for {user_formation.user.user_username} successfully refused.")
-            print(f"Formation registration refused successfully for user: {user_formation.user.user_username}")
+            logger.info("Formation registration %s refused for user %s", pk, user_formation.user.user_username)
         except UserFormation.DoesNotExist:
             self.message_user(request, "Formation registration not found or already processed.", level=messages.ERROR)
-            print(f"Formation registration not found or already processed: ID {pk}")
+            logger.warning("Formation registration not found or already processed: ID %s", pk)
         return redirect('admin:users_pendinguserformations_changelist')
 
     def has_change_permission(self, request, obj=None):
         return request.user.is_superuser or request.user.user_role == 'DRH'
 
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'state', 'attempts', 'created_at', 'available_at', 'processed_at', 'last_error')
+    list_filter = ('state', 'event_type')
+    ordering = ('-event_id',)
+    readonly_fields = ('event_type', 'payload', 'state', 'attempts', 'created_at', 'available_at', 'processed_at', 'last_error')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_module_permission(self, request):
+        return request.user.is_superuser and request.user.user_role != 'DRH'
+
+class TrainingSpendSummaryAdmin(admin.ModelAdmin):
+    # The changelist is replaced by a dashboard built from the pre-aggregated rows only.
+    def changelist_view(self, request, extra_context=None):
+        if request.user.user_role == 'DRH':
+            structure_id = request.user.structure_id or 0
+        else:
+            structure_id = request.GET.get('structure')
+            structure_id = int(structure_id) if structure_id and structure_id.isdigit() else None
+        try:
+            months = min(max(int(request.GET.get('months') or DASHBOARD_MONTHS), 1), 60)
+        except ValueError:
+            months = DASHBOARD_MONTHS
+        context = {
+            **self.admin_site.each_context(request),
+            'title': "Training spend",
+            'opts': self.model._meta,
+            'months': months,
+            'dashboard': spend_dashboard(structure_id, months),
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, 'admin/users/spend_dashboard.html', context)
+
+    def has_module_permission(self, request):
+        return request.user.is_superuser or request.user.user_role == 'DRH'
+
+    def has_view_permission(self, request, obj=None):
+        return self.has_module_permission(request)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 # Register models
 admin.site.register(User, UserAdmin)
 admin.site.register(Structure, StructureAdmin)
 admin.site.register(Department, DepartmentAdmin)
 admin.site.register(Formation, FormationAdmin)
 admin.site.register(UserFormation, UserFormationAdmin)
+admin.site.register(OutboxEvent, OutboxEventAdmin)
+admin.site.register(TrainingSpendSummary, TrainingSpendSummaryAdmin)
 
 # Register Accounts Demanded as a proxy model
 class AccountsDemanded(User):
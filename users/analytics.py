@@ -0,0 +1,159 @@
+from datetime import date
+from django.db import transaction
+from django.db.models import Count, DateField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+from django.utils import timezone
+from .models import Department, Formation, TrainingSpendSummary, User, UserFormation
+from .reference import cached_structures
+from .sharding import all_shards, shards_for_pks
+
+SPEND_STATE = 'approved'
+SPEND_CHUNK_SIZE = 500
+DASHBOARD_MONTHS = 12
+BUCKET_FIELDS = ('structure_id', 'department_id', 'formation_category', 'formation_pays', 'month')
+# UserFormation columns holding the bucket an enrollment was counted under, then its cost.
+SNAPSHOT_FIELDS = tuple(f"spend_{name}" for name in BUCKET_FIELDS)
+
+
+def _snapshot():
+    """Update expressions storing each enrollment's current bucket and cost on the row."""
+    user = User.objects.filter(pk=OuterRef('user_id'))
+    formation = Formation.objects.filter(pk=OuterRef('formation_id'))
+    return {
+        'spend_structure_id': Coalesce(Subquery(user.values('structure_id')), Value(0)),
+        'spend_department_id': Coalesce(Subquery(user.values('department_id')), Value(0)),
+        'spend_formation_category': Subquery(formation.values('formation_category')),
+        'spend_formation_pays': Subquery(formation.values('formation_pays')),
+        'spend_month': TruncMonth('date_inscription', output_field=DateField()),
+        'spend_cost': Coalesce(Subquery(formation.values('formation_cout')), Value(0)),
+    }
+
+
+def _bucket_totals(queryset):
+    """``{bucket: [enrollments, cost]}`` for the counted enrollments of ``queryset``, from their stored buckets."""
+    rows = (
+        queryset.filter(spend_month__isnull=False).order_by()
+        .values_list(*SNAPSHOT_FIELDS)
+        .annotate(enrollments=Count('user_formation_id'), cost=Sum('spend_cost'))
+    )
+    totals = {}
+    for row in rows:
+        total = totals.setdefault(tuple(row[:5]), [0, 0])
+        total[0] += row[5]
+        total[1] += row[6]
+    return totals
+
+
+def apply_spend(user_formation_ids, sign):
+    """Add (``sign=1``) or remove (``sign=-1``) enrollments from their spend buckets.
+
+    Adding stores the bucket and cost on each enrollment; removing subtracts what was
+    stored, whatever the user's or formation's values are now, and clears it.
+    """
+    user_formation_ids = list(user_formation_ids)
+    totals = {}
+    for start in range(0, len(user_formation_ids), SPEND_CHUNK_SIZE):
+        chunk = user_formation_ids[start:start + SPEND_CHUNK_SIZE]
+        for using, ids in shards_for_pks(chunk).items():
+            shard_rows = UserFormation.objects.using(using).filter(pk__in=ids)
+            if sign > 0:
+                shard_rows.filter(spend_month__isnull=True).update(**_snapshot())
+            for bucket, (enrollments, cost) in _bucket_totals(shard_rows).items():
+                total = totals.setdefault(bucket, [0, 0])
+                total[0] += enrollments
+                total[1] += cost
+            if sign < 0:
+                shard_rows.update(**{name: None for name in SNAPSHOT_FIELDS}, spend_cost=None)
+    if not totals:
+        return 0
+    with transaction.atomic():
+        if sign > 0:
+            TrainingSpendSummary.objects.bulk_create(
+                [TrainingSpendSummary(**dict(zip(BUCKET_FIELDS, bucket))) for bucket in totals],
+                ignore_conflicts=True,
+            )
+        for bucket, (enrollments, cost) in totals.items():
+            TrainingSpendSummary.objects.filter(**dict(zip(BUCKET_FIELDS, bucket))).update(
+                enrollments=F('enrollments') + sign * enrollments,
+                total_cost=F('total_cost') + sign * cost,
+            )
+    return len(totals)
+
+
+def rebuild_spend_summary():
+    """Recount every approved enrollment at today's bucket and cost, and replace the summary."""
+    for using in all_shards():
+        rows = UserFormation.objects.using(using)
+        rows.exclude(state_formation=SPEND_STATE).filter(spend_month__isnull=False).update(
+            **{name: None for name in SNAPSHOT_FIELDS}, spend_cost=None,
+        )
+        rows.filter(state_formation=SPEND_STATE).update(**_snapshot())
+    totals = _bucket_totals(UserFormation.objects.filter(state_formation=SPEND_STATE))
+    with transaction.atomic():
+        TrainingSpendSummary.objects.all().delete()
+        TrainingSpendSummary.objects.bulk_create(
+            [
+                TrainingSpendSummary(**dict(zip(BUCKET_FIELDS, bucket)), enrollments=enrollments, total_cost=cost)
+                for bucket, (enrollments, cost) in totals.items()
+            ],
+            batch_size=SPEND_CHUNK_SIZE,
+        )
+    return len(totals)
+
+
+def _first_month(months):
+    today = timezone.localdate()
+    year, month = today.year, today.month - (months - 1)
+    while month <= 0:
+        month += 12
+        year -= 1
+    return date(year, month, 1)
+
+
+def _ranked(totals, labels):
+    return sorted(
+        (
+            {'key': key, 'label': labels.get(key, key), 'enrollments': enrollments, 'total_cost': cost}
+            for key, (enrollments, cost) in totals.items()
+        ),
+        key=lambda row: (-row['total_cost'], str(row['label'])),
+    )
+
+
+def spend_dashboard(structure_id=None, months=DASHBOARD_MONTHS):
+    """Spend totals over the last ``months`` months, read from the summary table only."""
+    since = _first_month(months)
+    qs = TrainingSpendSummary.objects.filter(month__gte=since)
+    if structure_id is not None:
+        qs = qs.filter(structure_id=structure_id)
+    dimensions = {name: {} for name in BUCKET_FIELDS}
+    total_enrollments, total_cost = 0, 0
+    for *bucket, enrollments, cost in qs.values_list(*BUCKET_FIELDS, 'enrollments', 'total_cost'):
+        total_enrollments += enrollments
+        total_cost += cost
+        for name, key in zip(BUCKET_FIELDS, bucket):
+            total = dimensions[name].setdefault(key, [0, 0])
+            total[0] += enrollments
+            total[1] += cost
+
+    structures = {s['structure_id']: s['structure_varchar'] for s in cached_structures()}
+    structures[0] = 'No structure'
+    departments = dict(
+        Department.objects.filter(pk__in=dimensions['department_id']).values_list('department_id', 'department_name')
+    )
+    departments[0] = 'No department'
+    categories = dict(Formation._meta.get_field('formation_category').choices)
+    return {
+        'since': since,
+        'structure_id': structure_id,
+        'enrollments': total_enrollments,
+        'total_cost': total_cost,
+        'by_structure': _ranked(dimensions['structure_id'], structures),
+        'by_department': _ranked(dimensions['department_id'], departments),
+        'by_category': _ranked(dimensions['formation_category'], categories),
+        'by_country': _ranked(dimensions['formation_pays'], {}),
+        'by_month': [
+            {'key': month, 'label': f"{month:%Y-%m}", 'enrollments': enrollments, 'total_cost': cost}
+            for month, (enrollments, cost) in sorted(dimensions['month'].items())
+        ],
+    }
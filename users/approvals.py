@@ -0,0 +1,95 @@
+from collections import namedtuple
+from django.db import transaction
+from django.utils import timezone
+from .analytics import SPEND_STATE, apply_spend
+from .audit import audit_actor
+from .backends import invalidate_cached_users
+from .database import write_atomic
+from .models import User, UserFormation
+from .outbox import enqueue_notifications
+from .sharding import queryset_shards, shard_atomic, shards_for_pks
+
+APPROVAL_CHUNK_SIZE = 500
+
+ApprovalResult = namedtuple('ApprovalResult', ['selected', 'pending', 'updated', 'notified', 'updated_ids'])
+
+USER_DECISIONS = {
+    'approve': ('approved', True, "Your account has been validated. Welcome to TMS!"),
+    'refuse': ('rejected', False, "Your account request has been refused."),
+}
+FORMATION_DECISIONS = {
+    'approve': ('approved', "Your registration for '{title}' has been validated."),
+    'refuse': ('rejected', "Your registration for '{title}' has been refused."),
+}
+
+
+def _chunks(items, size=APPROVAL_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _actor_name(actor):
+    return getattr(actor, 'user_username', None) or (str(actor) if actor else None)
+
+
+def decide_users(queryset, decision, actor=None):
+    """Approve or refuse the pending users of ``queryset`` in one transaction.
+
+    Rows are locked, flipped with chunked UPDATEs and their notifications are
+    queued in the outbox; users that are no longer pending are left untouched.
+    """
+    state, is_active, message = USER_DECISIONS[decision]
+    selected = queryset.count()
+    with write_atomic(), audit_actor(actor):
+        pending = list(
+            queryset.filter(state='pending').select_for_update().order_by().values_list('user_id', 'user_role')
+        )
+        updated_ids = []
+        for chunk in _chunks(pending):
+            ids = [user_id for user_id, _ in chunk]
+            if User.objects.filter(pk__in=ids, state='pending').update(state=state, is_active=is_active) == len(ids):
+                updated_ids.extend(ids)
+            else:
+                updated_ids.extend(User.objects.filter(pk__in=ids, state=state).values_list('user_id', flat=True))
+        if decision == 'approve':
+            # DRH accounts administer their structure from the admin site.
+            drh_ids = set(updated_ids).intersection(user_id for user_id, role in pending if role == 'DRH')
+            for chunk in _chunks(list(drh_ids)):
+                User.objects.filter(pk__in=chunk).update(is_staff=True, is_superuser=True)
+        notified = enqueue_notifications((user_id, message) for user_id in updated_ids)
+        transaction.on_commit(lambda: invalidate_cached_users(updated_ids))
+    return ApprovalResult(selected, len(pending), len(updated_ids), notified, updated_ids)
+
+
+def decide_user_formations(queryset, decision, actor=None):
+    """Approve or refuse the pending enrollments of ``queryset`` in one transaction per shard."""
+    state, template = FORMATION_DECISIONS[decision]
+    validator = _actor_name(actor)
+    now = timezone.now()
+    selected = queryset.count()
+    with shard_atomic(queryset_shards(queryset)), audit_actor(actor):
+        pending = list(
+            queryset.filter(state_formation='pending').select_for_update(of=('self',)).order_by()
+            .values_list('user_formation_id', 'user_id', 'formation__formation_titre')
+        )
+        updated_ids = []
+        for chunk in _chunks(pending):
+            for using, ids in shards_for_pks(pk for pk, _, _ in chunk).items():
+                rows = UserFormation.objects.using(using)
+                changed = rows.filter(pk__in=ids, state_formation='pending').update(
+                    state_formation=state, valide_par=validator, valide_date=now,
+                )
+                if changed == len(ids):
+                    updated_ids.extend(ids)
+                else:
+                    updated_ids.extend(
+                        rows.filter(pk__in=ids, state_formation=state, valide_date=now)
+                        .values_list('user_formation_id', flat=True)
+                    )
+        if state == SPEND_STATE:
+            apply_spend(updated_ids, 1)
+        updated = set(updated_ids)
+        notified = enqueue_notifications(
+            (user_id, template.format(title=title)) for pk, user_id, title in pending if pk in updated
+        )
+    return ApprovalResult(selected, len(pending), len(updated_ids), notified, updated_ids)
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import models
+from django.utils import timezone
+from django_currentuser.middleware import get_current_authenticated_user
+
+_actor = ContextVar('audit_actor', default=None)
+
+
+@contextmanager
+def audit_actor(user):
+    """Attribute the writes made inside the block to ``user``.
+
+    Requests are covered by the current-user middleware; use this in commands,
+    workers and anywhere the acting user is known but not logged in.
+    """
+    token = _actor.set(user)
+    try:
+        yield user
+    finally:
+        _actor.reset(token)
+
+
+def current_actor_name():
+    user = _actor.get() or get_current_authenticated_user()
+    return getattr(user, 'user_username', None)
+
+
+def _auto_now_fields(model):
+    return [field for field in model._meta.concrete_fields if getattr(field, 'auto_now', False)]
+
+
+class AuditQuerySet(models.QuerySet):
+    """Stamps the model's audit fields on set-based writes, like ``save()`` does on single rows."""
+
+    def update(self, **kwargs):
+        now = timezone.now()
+        for field in _auto_now_fields(self.model):
+            kwargs.setdefault(field.name, now)
+        updated_by = self.model.audit_updated_by
+        if updated_by and updated_by not in kwargs:
+            name = current_actor_name()
+            if name:
+                kwargs[updated_by] = name
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        name = current_actor_name()
+        for obj in objs:
+            obj.stamp_audit(adding=True, actor_name=name)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    bulk_create.alters_data = True
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        name = current_actor_name()
+        stamped = set()
+        for obj in objs:
+            stamped.update(obj.stamp_audit(adding=False, actor_name=name))
+        fields = list(fields) + [field for field in stamped if field not in fields]
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    bulk_update.alters_data = True
+
+
+AuditManager = models.Manager.from_queryset(AuditQuerySet, 'AuditManager')
+
+
+class AuditedModel(models.Model):
+    """Base for models carrying ``*_cree_par`` / ``*_miseajour_par`` style audit columns.
+
+    Subclasses name their columns in ``audit_created_by`` and ``audit_updated_by``;
+    ``auto_now`` dates are refreshed by ``update()`` and ``bulk_update()`` as well.
+    """
+    audit_created_by = None
+    audit_updated_by = None
+
+    objects = AuditManager()
+
+    class Meta:
+        abstract = True
+
+    def stamp_audit(self, adding, actor_name=None):
+        """Fill the audit fields and return the names of the fields that were set."""
+        stamped = []
+        if not adding:
+            now = timezone.now()
+            for field in _auto_now_fields(type(self)):
+                setattr(self, field.attname, now)
+                stamped.append(field.name)
+        if actor_name:
+            if adding and self.audit_created_by:
+                setattr(self, self.audit_created_by, actor_name)
+                stamped.append(self.audit_created_by)
+            if self.audit_updated_by:
+                setattr(self, self.audit_updated_by, actor_name)
+                stamped.append(self.audit_updated_by)
+        return stamped
+
+    def save(self, *args, **kwargs):
+        self.stamp_audit(self._state.adding, current_actor_name())
+        super().save(*args, **kwargs)
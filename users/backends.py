@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from .models import User
+from .reference import reference_version
+
+USER_CACHE_TIMEOUT = 300
+
+
+def _user_key(user_id):
+    # The reference version is part of the key: renaming a structure or department drops every snapshot.
+    return f"auth:user:{reference_version()}:{user_id}"
+
+
+def invalidate_cached_users(user_ids):
+    cache.delete_many([_user_key(user_id) for user_id in user_ids])
+
+
+def check_user_cache():
+    """Refuse a per-process cache: another worker would keep serving a deactivated user's snapshot."""
+    backend_path = f"{CachedUserBackend.__module__}.{CachedUserBackend.__qualname__}"
+    if backend_path in settings.AUTHENTICATION_BACKENDS and isinstance(caches['default'], LocMemCache):
+        raise ImproperlyConfigured(
+            "CachedUserBackend needs a cache shared by every worker process; "
+            "CACHES['default'] is a LocMemCache."
+        )
+
+
+class CachedUserBackend(ModelBackend):
+    """ModelBackend whose per-request user lookup is served from the cache.
+
+    The snapshot is loaded with its structure and department in one joined
+    query and kept until the user is saved or deleted (see signals), or is
+    changed by the approval engine. Those invalidations must reach every
+    worker, hence check_user_cache() at startup.
+    """
+
+    def get_user(self, user_id):
+        key = _user_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            try:
+                user = User._default_manager.select_related('structure', 'department').get(pk=user_id)
+            except User.DoesNotExist:
+                return None
+            cache.set(key, user, USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
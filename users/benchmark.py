@@ -0,0 +1,357 @@
+import json
+import random
+import statistics
+import time
+from collections import namedtuple
+from contextlib import ExitStack
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from .analytics import rebuild_spend_summary
+from .catalog import bump_catalog_version
+from .models import Department, Formation, Notification, NotificationCounter, Structure, User, UserFormation
+from .reference import bump_reference_version
+from .routers import read_replicas
+from .search import rebuild_search_index
+from .sharding import all_shards
+
+BENCHMARK_SEED = 1337
+GENERATE_BATCH_SIZE = 5000
+# Row counts at scale 1.0; --scale multiplies every one of them.
+BENCHMARK_SIZES = {
+    'structures': 10,
+    'departments': 100,
+    'users': 100_000,
+    'formations': 10_000,
+    'enrollments': 1_000_000,
+    'notifications': 500_000,
+}
+USERNAME_PREFIX = 'bench'
+STRUCTURE_CODE_PREFIX = 'BENCH'
+ENROLLMENT_STATES = (('approved', 70), ('pending', 20), ('rejected', 10))
+COUNTRIES = ('DZ', 'FR', 'IT', 'US', 'NO', 'CA', 'GB', 'ES')
+LEVELS = ('L1', 'L2', 'L3', 'M1', 'M2')
+
+Scenario = namedtuple('Scenario', ['name', 'actor', 'method', 'url', 'data', 'budget'])
+
+
+def benchmark_sizes(scale=1.0):
+    sizes = {name: max(1, int(count * scale)) for name, count in BENCHMARK_SIZES.items()}
+    sizes['departments'] = max(sizes['departments'], sizes['structures'])
+    # Every structure gets its DRH and manager, every department its chief, plus one admin.
+    sizes['users'] = max(sizes['users'], 2 * sizes['structures'] + sizes['departments'] + 2)
+    return sizes
+
+
+def _bulk(model, objects, batch_size=GENERATE_BATCH_SIZE):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+
+
+def _weighted(rng, choices):
+    return rng.choices([value for value, _ in choices], weights=[weight for _, weight in choices])[0]
+
+
+def _user_specs(sizes, structure_ids, departments):
+    """Yield ``(username, role, structure_id, department_id)``, the special accounts first."""
+    yield f"{USERNAME_PREFIX}-admin", 'admin', structure_ids[0], None
+    for index, structure_id in enumerate(structure_ids):
+        yield f"{USERNAME_PREFIX}-drh-{index}", 'DRH', structure_id, None
+        yield f"{USERNAME_PREFIX}-manager-{index}", 'manager', structure_id, departments[structure_id][0]
+    for index, (department_id, structure_id) in enumerate(
+        (department_id, structure_id) for structure_id in structure_ids for department_id in departments[structure_id]
+    ):
+        yield f"{USERNAME_PREFIX}-chief-{index}", 'department_chief', structure_id, department_id
+    special = 1 + 2 * len(structure_ids) + sum(len(ids) for ids in departments.values())
+    for index in range(sizes['users'] - special):
+        structure_id = structure_ids[index % len(structure_ids)]
+        department_ids = departments[structure_id]
+        yield f"{USERNAME_PREFIX}{index:07d}", 'employee', structure_id, department_ids[index % len(department_ids)]
+
+
+def generate(scale=1.0, seed=BENCHMARK_SEED, log=None):
+    """Load a deterministic data set through bulk inserts and return the row count of each table.
+
+    structures -> departments -> users -> formations -> enrollments -> notifications,
+    then the denormalized tables (unread counters, spend summary, search index) are rebuilt.
+    """
+    if Structure.objects.filter(structure_code__startswith=STRUCTURE_CODE_PREFIX).exists():
+        raise ValueError("Benchmark data is already loaded in this database.")
+    log = log or (lambda message: None)
+    rng = random.Random(seed)
+    sizes = benchmark_sizes(scale)
+    now = timezone.now()
+
+    with transaction.atomic():
+        _bulk(Structure, (
+            Structure(structure_varchar=f"Benchmark structure {i}", structure_code=f"{STRUCTURE_CODE_PREFIX}{i:03d}",
+                      structure_niveau=str(1 + i % 3))
+            for i in range(sizes['structures'])
+        ))
+        structure_ids = list(
+            Structure.objects.filter(structure_code__startswith=STRUCTURE_CODE_PREFIX)
+            .order_by('pk').values_list('pk', flat=True)
+        )
+        _bulk(Department, (
+            Department(department_name=f"Benchmark department {i}", department_code=f"{STRUCTURE_CODE_PREFIX}-D{i:04d}",
+                       structure_id=structure_ids[i % len(structure_ids)])
+            for i in range(sizes['departments'])
+        ))
+        departments = {structure_id: [] for structure_id in structure_ids}
+        for department_id, structure_id in (
+            Department.objects.filter(structure_id__in=structure_ids).order_by('pk').values_list('pk', 'structure_id')
+        ):
+            departments[structure_id].append(department_id)
+        log(f"{len(structure_ids)} structures, {sizes['departments']} departments")
+
+        # One hash for everybody: hashing 100k passwords would dominate the load time.
+        password = make_password(USERNAME_PREFIX)
+        _bulk(User, (
+            User(
+                user_email=f"{username}@benchmark.example", user_username=username, password=password,
+                user_firstname=f"First{i}", user_lastname=f"Last{i}", user_role=role,
+                structure_id=structure_id, department_id=department_id,
+                state='pending' if role == 'employee' and rng.random() < 0.02 else 'approved',
+                is_active=True, is_staff=role in ('admin', 'DRH'), is_superuser=role in ('admin', 'DRH'),
+                user_cree_date=now - timedelta(days=rng.randrange(730)),
+            )
+            for i, (username, role, structure_id, department_id) in enumerate(
+                _user_specs(sizes, structure_ids, departments)
+            )
+        ))
+        user_ids = list(
+            User.objects.filter(user_username__startswith=USERNAME_PREFIX).order_by('pk').values_list('pk', flat=True)
+        )
+        log(f"{len(user_ids)} users")
+
+        categories = [value for value, _ in Formation._meta.get_field('formation_category').choices]
+        _bulk(Formation, (
+            Formation(
+                formation_titre=f"Formation {rng.choice(categories).replace('_', ' ')} {i}",
+                formation_ref=f"{STRUCTURE_CODE_PREFIX}-F{i:06d}", formation_niveau=rng.choice(LEVELS),
+                formation_description=f"Benchmark formation {i}", formation_cout=rng.randrange(100, 20000),
+                formation_pays=rng.choice(COUNTRIES), formation_duree=rng.randrange(1, 30),
+                formation_category=rng.choice(categories), structure_id=structure_ids[i % len(structure_ids)],
+            )
+            for i in range(sizes['formations'])
+        ))
+        formation_ids = list(
+            Formation.objects.filter(formation_ref__startswith=f"{STRUCTURE_CODE_PREFIX}-F")
+            .order_by('pk').values_list('pk', flat=True)
+        )
+        log(f"{len(formation_ids)} formations")
+
+        per_user, extra = divmod(sizes['enrollments'], len(user_ids))
+
+        def enrollments():
+            for index, user_id in enumerate(user_ids):
+                count = min(per_user + (index < extra), len(formation_ids))
+                for formation_id in rng.sample(formation_ids, count):
+                    state = _weighted(rng, ENROLLMENT_STATES)
+                    yield UserFormation(
+                        user_id=user_id, formation_id=formation_id, state_formation=state,
+                        date_inscription=now - timedelta(minutes=rng.randrange(365 * 24 * 60)),
+                        valide_date=None if state == 'pending' else now, valide_par=None if state == 'pending' else 'bench',
+                    )
+
+        _bulk(UserFormation, enrollments())
+        log(f"{sizes['enrollments']} enrollments")
+
+        unread = {}
+
+        def notifications():
+            per_user, extra = divmod(sizes['notifications'], len(user_ids))
+            for index, user_id in enumerate(user_ids):
+                for n in range(per_user + (index < extra)):
+                    is_read = rng.random() < 0.8
+                    if not is_read:
+                        unread[user_id] = unread.get(user_id, 0) + 1
+                    yield Notification(
+                        user_id=user_id, message=f"Benchmark notification {n} for user {user_id}", is_read=is_read,
+                        created_at=now - timedelta(minutes=rng.randrange(90 * 24 * 60)),
+                    )
+
+        _bulk(Notification, notifications())
+        _bulk(NotificationCounter, (NotificationCounter(user_id=user_id, unread=count) for user_id, count in unread.items()))
+        log(f"{sizes['notifications']} notifications")
+
+    # bulk_create() skips the signals that keep these in step.
+    rebuild_spend_summary()
+    rebuild_search_index()
+    bump_reference_version()
+    bump_catalog_version(Structure.objects.values_list('structure_id', flat=True))
+    if connection.vendor in ('sqlite', 'postgresql'):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+    return {model.__name__: model.objects.count() for model in (
+        Structure, Department, User, Formation, UserFormation, Notification,
+    )}
+
+
+def benchmark_actors():
+    users = {
+        user.user_username: user for user in User.objects.filter(user_username__in=[
+            f"{USERNAME_PREFIX}-admin", f"{USERNAME_PREFIX}-drh-0", f"{USERNAME_PREFIX}-manager-0",
+            f"{USERNAME_PREFIX}-chief-0", f"{USERNAME_PREFIX}0000000",
+        ])
+    }
+    if len(users) < 5:
+        raise ValueError("No benchmark data found; load it with the --generate option first.")
+    return {
+        'admin': users[f"{USERNAME_PREFIX}-admin"],
+        'drh': users[f"{USERNAME_PREFIX}-drh-0"],
+        'manager': users[f"{USERNAME_PREFIX}-manager-0"],
+        'chief': users[f"{USERNAME_PREFIX}-chief-0"],
+        'employee': users[f"{USERNAME_PREFIX}0000000"],
+    }
+
+
+def _admin(model_name, budget, actor='admin', **params):
+    name = f"admin:{model_name}" + ''.join(f" {key}={value}" for key, value in params.items())
+    if actor != 'admin':
+        name += f" ({actor})"
+    return Scenario(name, actor, 'get', reverse(f'admin:users_{model_name}_changelist'), params, budget)
+
+
+def benchmark_scenarios(actors):
+    """Every view and admin page, with the number of queries each may run (session lookup included)."""
+    employee = actors['employee']
+    formation_id = Formation.objects.filter(structure_id=employee.structure_id).order_by('pk').values_list(
+        'pk', flat=True
+    ).first()
+    new_formation_id = Formation.objects.exclude(user_formations__user=employee).order_by('pk').values_list(
+        'pk', flat=True
+    ).first()
+    team_ids = list(
+        User.objects.filter(department_id=actors['chief'].department_id, user_role='employee', state='approved')
+        .order_by('pk').values_list('pk', flat=True)[:5]
+    )
+    return [
+        Scenario('user_list', 'employee', 'get', reverse('users:user_list'), {}, 7),
+        Scenario('user_list:manager', 'manager', 'get', reverse('users:user_list'), {}, 9),
+        Scenario('structure_departments', 'employee', 'get',
+                 reverse('users:structure_departments', args=[employee.structure_id]), {}, 1),
+        Scenario('participate_formation', 'employee', 'post', reverse('users:participate_formation'),
+                 {'formation_id': new_formation_id}, 4),
+        Scenario('enroll_batch', 'chief', 'post', reverse('users:enroll_batch'),
+                 {'formation_id': new_formation_id, 'user_ids': team_ids}, 6),
+        Scenario('notification_feed', 'employee', 'get', reverse('users:notification_feed'), {}, 3),
+        Scenario('mark_all_notifications_read', 'employee', 'post', reverse('users:mark_all_notifications_read'),
+                 {}, 5),
+        Scenario('formation_catalog', 'employee', 'get', reverse('users:formation_catalog'), {}, 2),
+        Scenario('formation_search', 'employee', 'get', reverse('users:formation_search'), {'q': 'forage'}, 5),
+        Scenario('formation_detail', 'employee', 'get', reverse('users:formation_detail', args=[formation_id]), {}, 2),
+        Scenario('team_formation_matrix', 'chief', 'get', reverse('users:team_formation_matrix'), {}, 5),
+        _admin('user', budget=5),
+        _admin('user', budget=5, structure=employee.structure_id),
+        _admin('accountsdemanded', budget=5),
+        _admin('accountsdemanded', actor='drh', budget=5),
+        _admin('structure', budget=7),
+        _admin('department', budget=6),
+        _admin('formation', budget=8),
+        _admin('userformation', budget=6),
+        _admin('userformation', budget=7, p=50),
+        _admin('pendinguserformations', budget=5),
+        _admin('pendinguserformations', actor='drh', budget=5),
+        _admin('outboxevent', budget=7),
+        _admin('trainingspendsummary', budget=5),
+        _admin('trainingspendsummary', actor='drh', budget=5),
+        Scenario('admin:pendinguserformations_review_items', 'drh', 'get',
+                 reverse('admin:users_pendinguserformations_review_items'), {}, 2),
+    ]
+
+
+def _request(client, scenario):
+    if scenario.method == 'post':
+        response = client.post(scenario.url, json.dumps(scenario.data), content_type='application/json')
+    else:
+        response = client.get(scenario.url, scenario.data)
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def run_scenario(client, scenario, repeat=5):
+    """Time ``repeat`` requests after one warm-up; writes made by the view are rolled back each time.
+
+    Queries are counted, and writes rolled back, on 'default' and on every shard in use;
+    reads sent to a replica count as well.
+    """
+    aliases = all_shards()
+    timings = []
+    for _ in range(repeat + 1):
+        with ExitStack() as stack:
+            for alias in aliases:
+                stack.enter_context(transaction.atomic(using=alias))
+            captured = [
+                stack.enter_context(CaptureQueriesContext(connections[alias]))
+                for alias in dict.fromkeys(aliases + read_replicas())
+            ]
+            started = time.perf_counter()
+            response = _request(client, scenario)
+            timings.append((time.perf_counter() - started) * 1000)
+            queries = sum(len(queries) for queries in captured)
+            for alias in aliases:
+                transaction.set_rollback(True, using=alias)
+    timings = sorted(timings[1:])
+    return {
+        'name': scenario.name,
+        'method': scenario.method.upper(),
+        'url': scenario.url,
+        'status': response.status_code,
+        'queries': queries,
+        'budget': scenario.budget,
+        'over_budget': queries > scenario.budget,
+        'median_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        'min_ms': round(timings[0], 2),
+        'max_ms': round(timings[-1], 2),
+    }
+
+
+def run_benchmarks(repeat=5, names=None):
+    """Run the scenarios against the current database and return a JSON-serializable report."""
+    actors = benchmark_actors()
+    clients = {}
+    results = []
+    # The test client's host name is only accepted by the test runner.
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for scenario in benchmark_scenarios(actors):
+            if names and scenario.name not in names:
+                continue
+            if scenario.actor not in clients:
+                clients[scenario.actor] = Client()
+                clients[scenario.actor].force_login(actors[scenario.actor])
+            results.append(run_scenario(clients[scenario.actor], scenario, repeat))
+    return {
+        'created_at': timezone.now().isoformat(),
+        'vendor': connection.vendor,
+        'repeat': repeat,
+        'rows': {model.__name__: model.objects.count() for model in (User, Formation, UserFormation, Notification)},
+        'results': results,
+    }
+
+
+def compare_reports(previous, current, threshold=1.25):
+    """``(name, before_ms, after_ms, ratio, regressed)`` for the scenarios present in both reports."""
+    before = {result['name']: result for result in previous['results']}
+    rows = []
+    for result in current['results']:
+        old = before.get(result['name'])
+        if old is None:
+            continue
+        ratio = result['median_ms'] / old['median_ms'] if old['median_ms'] else 1.0
+        rows.append((result['name'], old['median_ms'], result['median_ms'], round(ratio, 2), ratio > threshold))
+    return rows
@@ -0,0 +1,118 @@
+import hashlib
+import json
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.functions import Substr
+from .metrics import registry
+from .models import Formation
+from .reference import REFERENCE_CACHE_TIMEOUT, bump_cache_version, cache_version, invalidate_now_and_on_commit
+
+CATALOG_PAGE_SIZE = 24
+CATALOG_MAX_PAGE_SIZE = 100
+CATALOG_FILTERS = ('formation_niveau', 'formation_category', 'formation_pays', 'structure')
+CATALOG_FIELDS = (
+    'formation_id', 'formation_titre', 'formation_ref', 'formation_niveau', 'formation_pays',
+    'formation_duree', 'formation_cout', 'formation_category', 'structure_id', 'formation_resume',
+    'formation_mise_a_jour_date',
+)
+FORMATION_DETAIL_FIELDS = (
+    'formation_id', 'formation_titre', 'formation_ref', 'formation_niveau', 'formation_pays',
+    'formation_duree', 'formation_cout', 'formation_category', 'structure_id', 'formation_description',
+    'formation_prerequis', 'formation_programme', 'formation_cible', 'formation_objectif',
+)
+# One version for the whole catalog and one per structure; pages filtered on a
+# structure only go stale when that structure's formations change. The versions live
+# in the cache, which every worker must share (see CACHES): with a per-process cache,
+# the other workers would keep serving their pages for CATALOG_CACHE_TIMEOUT.
+CATALOG_VERSION_KEY = 'catalog:version:{}'
+CATALOG_CACHE_TIMEOUT = REFERENCE_CACHE_TIMEOUT
+CATALOG_CACHE_OUTCOMES = ('hit', 'miss')
+
+
+def parse_catalog_params(params):
+    """Read filters, cursor and page size from a GET QueryDict; raise ValueError on bad input."""
+    filters = {}
+    for name in CATALOG_FILTERS:
+        value = params.get(name, '').strip()
+        if value:
+            filters[name] = value
+    if 'structure' in filters:
+        filters['structure'] = int(filters['structure'])
+    cursor = params.get('cursor') or None
+    if cursor is not None:
+        cursor = int(cursor)
+    limit = int(params.get('limit') or CATALOG_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return filters, cursor, min(limit, CATALOG_MAX_PAGE_SIZE)
+
+
+def catalog_page(filters=None, cursor=None, limit=CATALOG_PAGE_SIZE, using=None):
+    # Keyset pagination on the primary key: every page costs the same however deep it is.
+    qs = Formation.objects.using(using).filter(**(filters or {}))
+    if cursor is not None:
+        qs = qs.filter(formation_id__gt=cursor)
+    rows = list(
+        qs.annotate(formation_resume=Substr('formation_description', 1, 160))
+        .order_by('formation_id')
+        .values(*CATALOG_FIELDS)[:limit + 1]
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]['formation_id']
+    return {'results': rows, 'next_cursor': next_cursor}
+
+
+def catalog_facet_values(field, using=None):
+    return list(
+        Formation.objects.using(using).exclude(**{field: ''})
+        .order_by(field)
+        .values_list(field, flat=True)
+        .distinct()
+    )
+
+
+def catalog_version(structure_id=None):
+    return cache_version(CATALOG_VERSION_KEY.format('all' if structure_id is None else structure_id))
+
+
+def bump_catalog_version(structure_ids):
+    """Invalidate the whole catalog and the pages of the given structures."""
+    bump_cache_version(CATALOG_VERSION_KEY.format('all'))
+    for structure_id in set(structure_ids):
+        bump_cache_version(CATALOG_VERSION_KEY.format(structure_id))
+
+
+def invalidate_catalog(structure_ids):
+    invalidate_now_and_on_commit(bump_catalog_version, list(structure_ids))
+
+
+def catalog_cache_stats():
+    return registry.counts('catalog_cache', CATALOG_CACHE_OUTCOMES)
+
+
+def _cached(structure_id, name, params, loader):
+    scope = 'all' if structure_id is None else structure_id
+    digest = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    key = f"catalog:{scope}:{catalog_version(structure_id)}:{name}:{digest}"
+    value = cache.get(key)
+    registry.increment('catalog_cache', 'miss' if value is None else 'hit')
+    if value is None:
+        value = loader()
+        cache.set(key, value, CATALOG_CACHE_TIMEOUT)
+    return value
+
+
+# Both load from 'default': just after a formation edit the replica can still return the
+# old formation, and the page would be cached under the version that edit bumped.
+def cached_catalog_page(filters=None, cursor=None, limit=CATALOG_PAGE_SIZE):
+    filters = filters or {}
+    return _cached(
+        filters.get('structure'), 'page', [filters, cursor, limit],
+        lambda: catalog_page(filters, cursor, limit, using=DEFAULT_DB_ALIAS),
+    )
+
+
+def cached_facet_values(field):
+    return _cached(None, 'facet', field, lambda: catalog_facet_values(field, using=DEFAULT_DB_ALIAS))
@@ -0,0 +1,208 @@
+import hashlib
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import EmptyPage, InvalidPage, Paginator
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from .reference import cached_departments, cached_structures
+from .sharding import id_range_start, is_sharded, queryset_shards
+
+COUNT_CAP = 10000
+# Past this offset pages are found by keyset from the previous page's last row, then fetched by primary key.
+DEFERRED_JOIN_OFFSET = 1000
+PAGE_BOUNDARY_TIMEOUT = 60 * 30
+
+
+def estimated_table_rows(model, using=DEFAULT_DB_ALIAS):
+    """Planner statistics instead of COUNT(*): PostgreSQL's reltuples, SQLite's MAX(rowid)."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+        elif connection.vendor == 'sqlite':
+            cursor.execute('SELECT MAX(rowid) FROM %s' % connection.ops.quote_name(table))
+        else:
+            return None
+        row = cursor.fetchone()
+    estimate = row[0] if row and row[0] else 0
+    if estimate and connection.vendor == 'sqlite' and is_sharded(model):
+        # A shard's rowids count from the start of its id range.
+        estimate -= id_range_start(using)
+    return estimate if estimate > 0 else None
+
+
+def keyset_fields(qs):
+    """``[(field_path, descending), ...]`` up to the primary key, or None when the ordering can't be seeked.
+
+    Seeking needs plain, non-null fields ending with the primary key, so that
+    ``(fields) > (last row's values)`` is exactly the rows after that one.
+    """
+    query = qs.query
+    if not query.standard_ordering:
+        return None
+    ordering = query.order_by or (query.get_meta().ordering if query.default_ordering else ())
+    fields = []
+    for item in ordering:
+        if not isinstance(item, str) or item == '?':
+            return None
+        path = item.lstrip('-')
+        model, field = qs.model, None
+        for part in path.split('__'):
+            if model is None:
+                return None
+            try:
+                field = model._meta.pk if part == 'pk' else model._meta.get_field(part)
+            except FieldDoesNotExist:
+                return None
+            if field.null or not field.concrete:
+                return None
+            model = field.related_model
+        if field.is_relation:
+            # Ordering by a relation sorts by the related model's ordering, not by this column.
+            return None
+        fields.append((path, item.startswith('-')))
+        if '__' not in path and field.primary_key:
+            return fields
+    return None
+
+
+def keyset_after(fields, values):
+    # Lexicographic (a, b, pk) > (x, y, z): a > x, or a = x and b > y, or ...
+    condition, equal = Q(), {}
+    for (path, descending), value in zip(fields, values):
+        condition |= Q(**equal, **{f"{path}__{'lt' if descending else 'gt'}": value})
+        equal[path] = value
+    return condition
+
+
+class EstimatedCountPaginator(Paginator):
+    """Counts at most COUNT_CAP rows; above that the count is an estimate and deep pages stay reachable.
+
+    Deep pages seek past the last row of the previous page, whose sort key is
+    cached for PAGE_BOUNDARY_TIMEOUT when that page is served, so paging
+    forward never reads the skipped rows. A page reached without going through
+    the previous one (a typed-in page number, an expired key) falls back to an
+    offset over primary keys only, and records its own boundary for the next.
+    """
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        exact = qs.order_by().values('pk')[:COUNT_CAP + 1].count()
+        if exact <= COUNT_CAP:
+            self.estimated = False
+            return exact
+        self.estimated = True
+        estimate = 0
+        if not qs.query.where:
+            estimate = sum(estimated_table_rows(qs.model, using) or 0 for using in queryset_shards(qs))
+        return max(estimate, exact)
+
+    def validate_number(self, number):
+        if self.count and getattr(self, 'estimated', False):
+            try:
+                number = int(number)
+            except (TypeError, ValueError):
+                raise InvalidPage("That page number is not an integer")
+            if number < 1:
+                raise EmptyPage("That page number is less than 1")
+            return number
+        return super().validate_number(number)
+
+    @cached_property
+    def keyset(self):
+        return keyset_fields(self.object_list)
+
+    def boundary_key(self, number):
+        digest = hashlib.md5(f"{self.object_list.query}|{self.per_page}".encode()).hexdigest()
+        return f"changelist:boundary:{digest}:{number}"
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        if bottom < DEFERRED_JOIN_OFFSET:
+            return super().page(number)
+        qs = self.object_list
+        if self.keyset is None:
+            pks = list(qs.values_list('pk', flat=True)[bottom:bottom + self.per_page])
+        else:
+            paths = [path for path, descending in self.keyset]
+            after = cache.get(self.boundary_key(number - 1))
+            if after is None:
+                rows = list(qs.values_list('pk', *paths)[bottom:bottom + self.per_page])
+            else:
+                rows = list(qs.filter(keyset_after(self.keyset, after)).values_list('pk', *paths)[:self.per_page])
+            if rows:
+                cache.set(self.boundary_key(number), rows[-1][1:], PAGE_BOUNDARY_TIMEOUT)
+            pks = [row[0] for row in rows]
+        if not pks:
+            raise EmptyPage("That page contains no results")
+        return self._get_page(list(qs.filter(pk__in=pks)), number, self)
+
+
+class ReferenceListFilter(admin.SimpleListFilter):
+    # Choices come from the cached reference data instead of a query over every related row.
+    field_path = None
+
+    def queryset(self, request, queryset):
+        if self.value():
+            try:
+                return queryset.filter(**{self.field_path: self.value()})
+            except (ValueError, ValidationError) as e:
+                raise IncorrectLookupParameters(e)
+        return queryset
+
+
+def choices_filter(field_path, choices):
+    # Fixed choices, where the default filter would run SELECT DISTINCT over the whole table.
+    class ChoicesFilter(ReferenceListFilter):
+        title = field_path.replace('_', ' ')
+        parameter_name = field_path
+
+        def lookups(self, request, model_admin):
+            return choices
+
+    ChoicesFilter.field_path = field_path
+    return ChoicesFilter
+
+
+def structure_filter(field_path):
+    class StructureFilter(ReferenceListFilter):
+        title = 'structure'
+        parameter_name = field_path
+
+        def lookups(self, request, model_admin):
+            return [(s['structure_id'], s['structure_varchar']) for s in cached_structures()]
+
+    StructureFilter.field_path = field_path
+    return StructureFilter
+
+
+def department_filter(field_path, structure_path):
+    class DepartmentFilter(ReferenceListFilter):
+        # Only offered once a structure is picked, so the sidebar never lists every department.
+        title = 'department'
+        parameter_name = field_path
+
+        def lookups(self, request, model_admin):
+            structure_id = request.GET.get(structure_path)
+            if not structure_id or not structure_id.isdigit():
+                return []
+            return [(d['department_id'], d['department_name']) for d in cached_departments(int(structure_id))]
+
+    DepartmentFilter.field_path = field_path
+    return DepartmentFilter
+
+
+class LargeTableAdminMixin:
+    """Changelist settings for tables with millions of rows.
+
+    Relations shown in ``list_display`` must be listed in ``list_select_related``;
+    the count is capped and deep pages use a primary-key scan.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
@@ -0,0 +1,85 @@
+import sqlite3
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import transaction
+
+# Applied to every new SQLite connection. WAL lets readers run beside the writer,
+# busy_timeout makes a writer wait for the lock instead of failing at once. auto_vacuum
+# only takes on a new database, or at the next VACUUM (archive_notifications --full-vacuum).
+DEFAULT_SQLITE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 20000,
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+
+# SQLite begins transactions DEFERRED: one that reads and then writes upgrades its lock
+# half-way and fails with "database is locked", busy_timeout or not, when another writer
+# got there first. Write paths use write_atomic(), which takes the lock at BEGIN instead.
+DEFAULT_WRITE_TRANSACTION_MODE = 'IMMEDIATE'
+
+
+def sqlite_pragmas():
+    return getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+
+
+def write_transaction_mode(connection):
+    if connection.vendor != 'sqlite':
+        return None
+    # A connection can opt out (users.sharding.attach_primary does for in-memory test shards).
+    if hasattr(connection, 'write_transaction_mode'):
+        return connection.write_transaction_mode
+    return getattr(settings, 'SQLITE_WRITE_TRANSACTION_MODE', DEFAULT_WRITE_TRANSACTION_MODE)
+
+
+@contextmanager
+def write_atomic(using=None):
+    """``transaction.atomic(using)`` for a block that writes.
+
+    On SQLite the outermost block begins with BEGIN IMMEDIATE, so it waits for the
+    write lock up front; nested blocks are savepoints of the enclosing transaction.
+    Read-only transactions keep the default mode and never queue behind writers.
+    """
+    connection = transaction.get_connection(using)
+    mode = write_transaction_mode(connection)
+    with ExitStack() as stack:
+        if mode is None or connection.in_atomic_block:
+            stack.enter_context(transaction.atomic(using=using))
+        else:
+            # Connecting resets transaction_mode from OPTIONS, so connect before swapping it.
+            connection.ensure_connection()
+            default_mode, connection.transaction_mode = connection.transaction_mode, mode
+            try:
+                stack.enter_context(transaction.atomic(using=using))
+            finally:
+                connection.transaction_mode = default_mode
+        yield
+
+
+def apply_sqlite_pragmas(connection, pragmas=None):
+    pragmas = sqlite_pragmas() if pragmas is None else pragmas
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            if not name.isidentifier() or not str(value).lstrip('-').isalnum():
+                raise ValueError(f"Invalid SQLite pragma {name}={value!r}")
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def snapshot_sqlite(source, target, pages=1024):
+    """Copy the SQLite database behind connection ``source`` into the file ``target``.
+
+    Uses the online backup API, in steps of ``pages``, so writers on the source are only
+    held up briefly and readers of ``target`` always see a whole snapshot. Returns the
+    copied size in pages.
+    """
+    source.ensure_connection()
+    destination = sqlite3.connect(target)
+    try:
+        source.connection.backup(destination, pages=pages)
+        return destination.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        destination.close()
@@ -0,0 +1,211 @@
+import base64
+import csv
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from .approvals import decide_users
+from .backends import invalidate_cached_users
+from .database import write_atomic
+from .models import Department, Structure, User
+
+SYNC_BATCH_SIZE = 500
+# Below this many passwords, starting worker processes costs more than it saves.
+PARALLEL_HASH_THRESHOLD = 16
+
+SYNC_FIELDS = ('user_username', 'user_firstname', 'user_lastname', 'user_role', 'structure_id', 'department_id')
+CSV_COLUMNS = {
+    'email': 'user_email',
+    'username': 'user_username',
+    'firstname': 'user_firstname',
+    'lastname': 'user_lastname',
+    'role': 'user_role',
+    'structure_code': 'structure_code',
+    'department_code': 'department_code',
+    'password': 'password',
+}
+LDIF_ATTRIBUTES = {
+    'mail': 'user_email',
+    'uid': 'user_username',
+    'givenname': 'user_firstname',
+    'sn': 'user_lastname',
+    'employeetype': 'user_role',
+    'o': 'structure_code',
+    'departmentnumber': 'department_code',
+    'userpassword': 'password',
+}
+
+SyncPlan = namedtuple('SyncPlan', ['creates', 'updates', 'unchanged', 'errors'])
+
+
+def _read_csv(stream):
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, {
+            CSV_COLUMNS[column.strip().lower()]: (value or '').strip()
+            for column, value in row.items()
+            if column and column.strip().lower() in CSV_COLUMNS
+        }
+
+
+def _unfold_ldif(stream):
+    """Yield ``(line, text)`` for each logical LDIF line, folded continuations joined back on."""
+    start, parts = None, []
+    for number, raw in enumerate(stream, start=1):
+        line = raw.rstrip('\r\n')
+        if line.startswith(' ') and parts:
+            parts.append(line[1:])
+            continue
+        if parts:
+            yield start, ''.join(parts)
+        start, parts = number, [line]
+    if parts:
+        yield start, ''.join(parts)
+
+
+def _read_ldif(stream):
+    """Minimal LDIF reader: records separated by blank lines, folded lines, ``attr:: base64`` values.
+
+    Only the first value of a repeated attribute is kept.
+    """
+    entry, start = {}, None
+    for number, line in _unfold_ldif(stream):
+        if not line.strip():
+            if entry:
+                yield start, entry
+            entry, start = {}, None
+            continue
+        if line.startswith('#') or ':' not in line:
+            continue
+        name, _, value = line.partition(':')
+        if value.startswith(':'):
+            value = base64.b64decode(value[1:].strip()).decode('utf-8')
+        start = start or number
+        entry.setdefault(name.strip().lower(), value.strip())
+    if entry:
+        yield start, entry
+
+
+def read_directory(stream, fmt):
+    """Yield ``(line, entry)`` where entry uses the User field names listed in CSV_COLUMNS."""
+    if fmt == 'csv':
+        yield from _read_csv(stream)
+        return
+    for line, record in _read_ldif(stream):
+        yield line, {field: record[name].strip() for name, field in LDIF_ATTRIBUTES.items() if name in record}
+
+
+def plan_sync(entries, structures=None):
+    """Compare directory entries with the existing users; return a SyncPlan without writing anything.
+
+    ``structures`` restricts the structures entries may belong to.
+    """
+    entries = list(entries)
+    structure_qs = Structure.objects.all() if structures is None else Structure.objects.filter(pk__in=structures)
+    structures_by_code = dict(structure_qs.values_list('structure_code', 'structure_id'))
+    departments_by_code = {
+        code: (department_id, structure_id)
+        for code, department_id, structure_id in Department.objects.filter(
+            structure_id__in=structures_by_code.values()
+        ).values_list('department_code', 'department_id', 'structure_id')
+    }
+    roles = {value for value, _ in User._meta.get_field('user_role').choices}
+
+    emails = [User.objects.normalize_email(entry.get('user_email', '')) for _, entry in entries]
+    usernames = [entry.get('user_username', '') for _, entry in entries]
+    existing = {user.user_email: user for user in User.objects.filter(user_email__in=emails)}
+    taken_usernames = dict(User.objects.filter(user_username__in=usernames).values_list('user_username', 'user_email'))
+
+    creates, updates, errors = [], [], []
+    unchanged = 0
+    seen_emails, seen_usernames = set(), {}
+    for (line, entry), email in zip(entries, emails):
+        try:
+            username = entry.get('user_username', '')
+            if not email or '@' not in email:
+                raise ValueError("a valid email is required")
+            if email in seen_emails:
+                raise ValueError(f"duplicate email {email}")
+            if not username:
+                raise ValueError("username is required")
+            if seen_usernames.get(username, email) != email or taken_usernames.get(username, email) != email:
+                raise ValueError(f"username '{username}' belongs to another user")
+            role = entry.get('user_role') or 'employee'
+            if role not in roles:
+                raise ValueError(f"unknown role '{role}'")
+            structure_id = structures_by_code.get(entry.get('structure_code', ''))
+            if structure_id is None:
+                raise ValueError(f"unknown structure_code '{entry.get('structure_code', '')}'")
+            department_id = None
+            if entry.get('department_code'):
+                department_id, department_structure = departments_by_code.get(entry['department_code'], (None, None))
+                if department_id is None or department_structure != structure_id:
+                    raise ValueError(f"department '{entry['department_code']}' is not in that structure")
+        except ValueError as error:
+            errors.append((line, str(error)))
+            continue
+        seen_emails.add(email)
+        seen_usernames[username] = email
+        values = {
+            'user_username': username,
+            'user_firstname': entry.get('user_firstname', ''),
+            'user_lastname': entry.get('user_lastname', ''),
+            'user_role': role,
+            'structure_id': structure_id,
+            'department_id': department_id,
+        }
+        user = existing.get(email)
+        if user is None:
+            creates.append({'user_email': email, 'password': entry.get('password') or None, **values})
+            continue
+        changes = {
+            name: (getattr(user, name), value) for name, value in values.items() if getattr(user, name) != value
+        }
+        if changes:
+            updates.append((user, changes))
+        else:
+            unchanged += 1
+    return SyncPlan(creates, updates, unchanged, errors)
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def hash_passwords(passwords, workers=None):
+    """``make_password`` over ``passwords``, spread over worker processes for large batches."""
+    passwords = list(passwords)
+    workers = workers or os.cpu_count() or 1
+    if workers < 2 or len(passwords) < PARALLEL_HASH_THRESHOLD:
+        return [make_password(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        return list(pool.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def apply_sync(plan, approve=False, actor=None, workers=None):
+    """Write ``plan`` in one transaction; with ``approve`` the pending users are approved as well.
+
+    Passwords are hashed before the transaction opens so that it stays short.
+    """
+    hashes = hash_passwords([row['password'] for row in plan.creates], workers)
+    new_users = [
+        User(**{name: value for name, value in row.items() if name != 'password'}, password=hashed, state='pending')
+        for row, hashed in zip(plan.creates, hashes)
+    ]
+    changed_fields = sorted({name for _, changes in plan.updates for name in changes})
+    for user, changes in plan.updates:
+        for name, (_, value) in changes.items():
+            setattr(user, name, value)
+    with write_atomic():
+        User.objects.bulk_create(new_users, batch_size=SYNC_BATCH_SIZE)
+        if plan.updates:
+            User.objects.bulk_update([user for user, _ in plan.updates], changed_fields, batch_size=SYNC_BATCH_SIZE)
+        updated_ids = [user.pk for user, _ in plan.updates]
+        transaction.on_commit(lambda: invalidate_cached_users(updated_ids))
+        approved = 0
+        if approve:
+            emails = [user.user_email for user in new_users] + [user.user_email for user, _ in plan.updates]
+            approved = decide_users(User.objects.filter(user_email__in=emails), 'approve', actor).updated
+    return len(new_users), len(plan.updates), approved
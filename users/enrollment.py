@@ -0,0 +1,94 @@
+from django.db import connections
+from django.utils import timezone
+from .audit import current_actor_name
+from .database import write_atomic
+from .models import Formation, User, UserFormation
+from .routers import pin_primary
+from .sharding import shards_for_users
+
+ENROLL_BATCH_LIMIT = 200
+
+CREATED = 'created'
+ALREADY_ENROLLED = 'already_enrolled'
+NOT_FOUND = 'not_found'
+
+
+def _insert_returning(using, user_ids, formation_ids, values):
+    """INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING: enrolls every existing
+    user x formation pair in one statement and reports which rows were new."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = UserFormation._meta
+    user_column, formation_column = meta.get_field('user').column, meta.get_field('formation').column
+    columns = ['state_formation', 'date_inscription', 'valide_par']
+    params = [meta.get_field(name).get_db_prep_save(values[name], connection) for name in columns]
+    sql = (
+        f"INSERT INTO {qn(meta.db_table)} ({qn(user_column)}, {qn(formation_column)}, "
+        f"{', '.join(qn(meta.get_field(name).column) for name in columns)}) "
+        f"SELECT u.{qn(User._meta.pk.column)}, f.{qn(Formation._meta.pk.column)}, %s, %s, %s "
+        f"FROM {qn(User._meta.db_table)} u CROSS JOIN {qn(Formation._meta.db_table)} f "
+        f"WHERE u.{qn(User._meta.pk.column)} IN ({', '.join(['%s'] * len(user_ids))}) "
+        f"AND f.{qn(Formation._meta.pk.column)} IN ({', '.join(['%s'] * len(formation_ids))}) "
+        f"ON CONFLICT ({qn(user_column)}, {qn(formation_column)}) DO NOTHING "
+        f"RETURNING {qn(user_column)}, {qn(formation_column)}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + list(user_ids) + list(formation_ids))
+        return {tuple(row) for row in cursor.fetchall()}
+
+
+def _insert_ignoring(using, user_ids, formation_ids, values):
+    existing = set(
+        UserFormation.objects.using(using).filter(user_id__in=user_ids, formation_id__in=formation_ids)
+        .values_list('user_id', 'formation_id')
+    )
+    users = User.objects.filter(pk__in=user_ids).values_list('pk', flat=True)
+    formations = Formation.objects.filter(pk__in=formation_ids).values_list('pk', flat=True)
+    missing = [(u, f) for u in users for f in formations if (u, f) not in existing]
+    UserFormation.objects.using(using).bulk_create(
+        [UserFormation(user_id=u, formation_id=f, **values) for u, f in missing], ignore_conflicts=True,
+    )
+    return set(missing)
+
+
+def _supports_insert_returning(connection):
+    return connection.vendor in ('sqlite', 'postgresql') and connection.features.can_return_rows_from_bulk_insert
+
+
+def enroll(user_ids, formation_ids, actor=None):
+    """Enroll every user in every formation as pending, skipping existing enrollments.
+
+    Returns ``{(user_id, formation_id): state}`` where state is ``CREATED``,
+    ``ALREADY_ENROLLED`` or ``NOT_FOUND`` (unknown user or formation). The
+    unique (user, formation) constraint makes concurrent calls safe.
+    """
+    user_ids, formation_ids = list(dict.fromkeys(user_ids)), list(dict.fromkeys(formation_ids))
+    if not user_ids or not formation_ids:
+        return {}
+    values = {
+        'state_formation': 'pending',
+        'date_inscription': timezone.now(),
+        'valide_par': getattr(actor, 'user_username', None) or current_actor_name(),
+    }
+    # Raw SQL bypasses the router; keep this client's next reads on the primary.
+    pin_primary()
+    pairs = [(u, f) for u in user_ids for f in formation_ids]
+    created, existing = set(), set()
+    # Each user's enrollments go to the shard of their structure; see users.sharding.
+    for using, shard_user_ids in shards_for_users(user_ids).items():
+        with write_atomic(using=using):
+            insert = _insert_returning if _supports_insert_returning(connections[using]) else _insert_ignoring
+            shard_created = insert(using, shard_user_ids, formation_ids, values)
+            created |= shard_created
+            if len(shard_created) < len(shard_user_ids) * len(formation_ids):
+                existing.update(
+                    UserFormation.objects.using(using)
+                    .filter(user_id__in=shard_user_ids, formation_id__in=formation_ids)
+                    .values_list('user_id', 'formation_id')
+                )
+    if len(created) == len(pairs):
+        return {pair: CREATED for pair in pairs}
+    return {
+        pair: CREATED if pair in created else ALREADY_ENROLLED if pair in existing else NOT_FOUND
+        for pair in pairs
+    }
@@ -0,0 +1,123 @@
+import csv
+import tempfile
+from datetime import datetime
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+EXPORT_CHUNK_SIZE = 2000
+
+# name -> (queryset path to the owning structure, [(header, value path), ...])
+EXPORTS = {
+    'enrollments': ('formation__structure', [
+        ('ID', 'user_formation_id'),
+        ('Username', 'user__user_username'),
+        ('Email', 'user__user_email'),
+        ('First name', 'user__user_firstname'),
+        ('Last name', 'user__user_lastname'),
+        ('Structure', 'user__structure__structure_varchar'),
+        ('Department', 'user__department__department_name'),
+        ('Formation ref', 'formation__formation_ref'),
+        ('Formation', 'formation__formation_titre'),
+        ('Category', 'formation__formation_category'),
+        ('Country', 'formation__formation_pays'),
+        ('Cost', 'formation__formation_cout'),
+        ('State', 'state_formation'),
+        ('Registered on', 'date_inscription'),
+        ('Validated by', 'valide_par'),
+        ('Validated on', 'valide_date'),
+    ]),
+    'users': ('structure', [
+        ('ID', 'user_id'),
+        ('Email', 'user_email'),
+        ('Username', 'user_username'),
+        ('First name', 'user_firstname'),
+        ('Last name', 'user_lastname'),
+        ('Role', 'user_role'),
+        ('State', 'state'),
+        ('Active', 'is_active'),
+        ('Structure', 'structure__structure_varchar'),
+        ('Department', 'department__department_name'),
+        ('Created on', 'user_cree_date'),
+        ('Created by', 'user_cree_par'),
+    ]),
+}
+
+
+class Echo:
+    """File-like object whose write() hands the line back, so csv.writer can feed a generator."""
+
+    def write(self, value):
+        return value
+
+
+def scope_for_user(queryset, user, structure_path):
+    # Same rule as the pending admins: DRH users see their structure, other superusers see everything.
+    if user.user_role == 'DRH':
+        if not user.structure_id:
+            return queryset.none()
+        return queryset.filter(**{f"{structure_path}_id": user.structure_id})
+    if user.is_superuser:
+        return queryset
+    return queryset.none()
+
+
+def _cell(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).strftime('%Y-%m-%d %H:%M') if timezone.is_aware(value) else value.isoformat()
+    return value
+
+
+def export_rows(queryset, name):
+    _, columns = EXPORTS[name]
+    yield [header for header, _ in columns]
+    rows = queryset.order_by('pk').values_list(*[path for _, path in columns]).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for row in rows:
+        yield [_cell(value) for value in row]
+
+
+def _filename(name, extension):
+    return f"{name}-{timezone.localtime():%Y%m%d-%H%M}.{extension}"
+
+
+def csv_lines(queryset, name):
+    writer = csv.writer(Echo())
+    # The BOM makes Excel read the file as UTF-8.
+    yield '\ufeff'
+    for row in export_rows(queryset, name):
+        yield writer.writerow(row)
+
+
+def stream_csv(queryset, name):
+    response = StreamingHttpResponse(csv_lines(queryset, name), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{_filename(name, "csv")}"'
+    return response
+
+
+def xlsx_available():
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def xlsx_response(queryset, name):
+    """XLSX export through openpyxl's write-only mode, spooled to disk rather than held in memory.
+
+    Unlike CSV the workbook is a zip that can only be sent once complete.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(name)
+    for row in export_rows(queryset, name):
+        sheet.append(row)
+    spool = tempfile.TemporaryFile()
+    workbook.save(spool)
+    spool.seek(0)
+    return FileResponse(
+        spool,
+        as_attachment=True,
+        filename=_filename(name, 'xlsx'),
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
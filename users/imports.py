@@ -0,0 +1,162 @@
+import csv
+import json
+from collections import namedtuple
+from .catalog import invalidate_catalog
+from .database import write_atomic
+from .models import Formation, Structure
+from .search import index_formations
+
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+# Columns of an import file; a row names its structure by 'structure_code' or 'structure_id'.
+REQUIRED_FIELDS = (
+    'formation_ref', 'formation_titre', 'formation_niveau', 'formation_description',
+    'formation_cout', 'formation_pays', 'formation_duree', 'formation_category',
+)
+OPTIONAL_FIELDS = ('formation_prerequis', 'formation_programme', 'formation_cible', 'formation_objectif')
+INTEGER_FIELDS = ('formation_cout', 'formation_duree')
+UPDATE_FIELDS = [name for name in REQUIRED_FIELDS + OPTIONAL_FIELDS if name != 'formation_ref'] + [
+    'formation_mise_a_jour_date',
+]
+
+ImportResult = namedtuple('ImportResult', ['inserted', 'updated', 'rejected', 'errors'])
+
+
+def read_rows(stream, fmt):
+    """Yield ``(line, row dict)`` from a CSV file or a JSON array / JSON lines file.
+
+    Raises ValueError when the JSON does not hold one object per row.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    text = stream.read()
+    if text.lstrip().startswith('['):
+        rows = enumerate(json.loads(text), start=1)
+    else:
+        rows = ((index, json.loads(line)) for index, line in enumerate(text.splitlines(), start=1) if line.strip())
+    for index, row in rows:
+        if not isinstance(row, dict):
+            raise ValueError(f"row {index} is not a JSON object")
+        yield index, row
+
+
+class FormationValidator:
+    def __init__(self, structures=None):
+        qs = Structure.objects.all() if structures is None else Structure.objects.filter(pk__in=structures)
+        self.structures_by_code = dict(qs.values_list('structure_code', 'structure_id'))
+        self.structure_ids = set(self.structures_by_code.values())
+        self.categories = {value for value, _ in Formation._meta.get_field('formation_category').choices}
+        self.max_lengths = {
+            name: Formation._meta.get_field(name).max_length for name in REQUIRED_FIELDS + OPTIONAL_FIELDS
+        }
+
+    def structure_id(self, row):
+        code = str(row.get('structure_code') or '').strip()
+        if code:
+            if code not in self.structures_by_code:
+                raise ValueError(f"unknown structure_code '{code}'")
+            return self.structures_by_code[code]
+        try:
+            structure_id = int(row.get('structure_id'))
+        except (TypeError, ValueError):
+            raise ValueError("structure_code or structure_id is required")
+        if structure_id not in self.structure_ids:
+            raise ValueError(f"unknown structure_id {structure_id}")
+        return structure_id
+
+    def __call__(self, row):
+        """Return the Formation built from ``row``; raise ValueError with the first problem found."""
+        values = {'structure_id': self.structure_id(row)}
+        for name in REQUIRED_FIELDS + OPTIONAL_FIELDS:
+            value = row.get(name)
+            value = value.strip() if isinstance(value, str) else value
+            if value in (None, ''):
+                if name in REQUIRED_FIELDS:
+                    raise ValueError(f"{name} is required")
+                value = None
+            elif name in INTEGER_FIELDS:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"{name} must be an integer")
+                if value < 0:
+                    raise ValueError(f"{name} must not be negative")
+            elif self.max_lengths[name] and len(str(value)) > self.max_lengths[name]:
+                raise ValueError(f"{name} is longer than {self.max_lengths[name]} characters")
+            values[name] = value
+        if values['formation_category'] not in self.categories:
+            raise ValueError(f"unknown formation_category '{values['formation_category']}'")
+        return Formation(**values)
+
+
+def _matching(keys):
+    return Formation.objects.filter(
+        structure_id__in={structure_id for structure_id, _ in keys},
+        formation_ref__in={ref for _, ref in keys},
+    )
+
+
+def _upsert(formations, dry_run=False):
+    keys = {(formation.structure_id, formation.formation_ref) for formation in formations}
+    with write_atomic():
+        existing = set(_matching(keys).values_list('structure_id', 'formation_ref')) & keys
+        if dry_run:
+            return len(keys) - len(existing), len(existing)
+        Formation.objects.bulk_create(
+            formations,
+            update_conflicts=True,
+            unique_fields=['structure', 'formation_ref'],
+            update_fields=UPDATE_FIELDS,
+        )
+        # bulk_create() bypasses post_save, so the search index and catalog cache are refreshed here.
+        ids = [formation.pk for formation in formations if formation.pk is not None]
+        if len(ids) < len(formations):
+            ids = _matching(keys).values_list('formation_id', flat=True)
+        index_formations(ids)
+        invalidate_catalog(structure_id for structure_id, _ in keys)
+    return len(keys) - len(existing), len(existing)
+
+
+def import_formations(rows, batch_size=IMPORT_BATCH_SIZE, dry_run=False, structures=None):
+    """Validate and upsert ``(line, row)`` pairs on (structure, formation_ref), one transaction per batch.
+
+    Within a file the last row for a given key wins; earlier ones are rejected.
+    ``structures`` restricts the structures rows may belong to.
+    """
+    validate = FormationValidator(structures)
+    inserted = updated = rejected = 0
+    errors = []
+
+    def reject(line, message):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append((line, message))
+
+    def flush(batch):
+        nonlocal inserted, updated
+        if batch:
+            batch_inserted, batch_updated = _upsert(list(batch.values()), dry_run)
+            inserted += batch_inserted
+            updated += batch_updated
+
+    batch, lines = {}, {}
+    for line, row in rows:
+        try:
+            formation = validate(row)
+        except ValueError as error:
+            reject(line, str(error))
+            continue
+        key = (formation.structure_id, formation.formation_ref)
+        if key in batch:
+            reject(lines[key], f"superseded by line {line}")
+        batch[key], lines[key] = formation, line
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch, lines = {}, {}
+    flush(batch)
+    return ImportResult(inserted, updated, rejected, errors)
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from users.retention import (
+    RETENTION_BATCH_SIZE, apply_policy, compact_database, open_export, retention_policies,
+)
+
+
+class Command(BaseCommand):
+    help = "Archive or delete old notifications according to the retention policies, then compact the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RETENTION_BATCH_SIZE,
+                            help="Number of notifications moved per transaction.")
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep between batches to leave room for other writers.")
+        parser.add_argument('--export', metavar='FILE',
+                            help="Append archived notifications to this JSON lines file (.gz to compress) "
+                                 "instead of the archive table.")
+        parser.add_argument('--policy', action='append', dest='policies', metavar='NAME',
+                            help="Only run the named policy (repeatable).")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the notifications each policy would handle.")
+        parser.add_argument('--skip-compact', action='store_true',
+                            help="Do not release free pages or run ANALYZE afterwards.")
+        parser.add_argument('--full-vacuum', action='store_true',
+                            help="Run a full VACUUM first, once, to switch an older SQLite file to incremental "
+                                 "auto-vacuum. Locks the database for the whole rewrite.")
+
+    def handle(self, *args, **options):
+        try:
+            policies = retention_policies()
+        except ValueError as error:
+            raise CommandError(error)
+        if options['policies']:
+            policies = [policy for policy in policies if policy.get('name') in options['policies']]
+            if not policies:
+                raise CommandError("No retention policy matches the given name(s).")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        export = open_export(options['export']) if options['export'] and not options['dry_run'] else None
+        total = 0
+        try:
+            for policy in policies:
+                handled = apply_policy(
+                    policy, batch_size=options['batch_size'], export=export,
+                    dry_run=options['dry_run'], pause=options['pause'],
+                )
+                total += handled
+                verb = 'archived' if policy['action'] == 'archive' else 'deleted'
+                if options['dry_run']:
+                    verb = f"would be {verb}"
+                self.stdout.write(f"Policy '{policy.get('name')}': {handled} notification(s) {verb}.")
+        finally:
+            if export is not None:
+                export.close()
+
+        if (total or options['full_vacuum']) and not options['dry_run'] and not options['skip_compact']:
+            for using, released in (compact_database(full=options['full_vacuum']) or {}).items():
+                if released is None:
+                    self.stdout.write(self.style.WARNING(
+                        f"Database '{using}' is not in incremental auto-vacuum mode; its free pages are reused "
+                        f"but not released. Run once with --full-vacuum to switch it."
+                    ))
+                else:
+                    self.stdout.write(f"Database '{using}': {released} free page(s) released, statistics refreshed.")
+        self.stdout.write(self.style.SUCCESS(f"{total} notification(s) handled."))
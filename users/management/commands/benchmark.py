@@ -0,0 +1,68 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from users.benchmark import BENCHMARK_SEED, compare_reports, generate, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Time every view and admin page against the benchmark data set and report query counts as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--generate', action='store_true',
+                            help="Load the synthetic data set first (bulk inserts into the configured database).")
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help="Multiplier on the data set size (1.0 = 100k users, 1M enrollments).")
+        parser.add_argument('--seed', type=int, default=BENCHMARK_SEED)
+        parser.add_argument('--skip-run', action='store_true', help="Only generate the data.")
+        parser.add_argument('--repeat', type=int, default=5, help="Timed requests per scenario.")
+        parser.add_argument('--only', action='append', dest='names', metavar='NAME',
+                            help="Only run the named scenario (repeatable).")
+        parser.add_argument('--output', metavar='FILE', help="Write the JSON report to this file.")
+        parser.add_argument('--compare', metavar='FILE', help="Compare the medians with an earlier report.")
+        parser.add_argument('--threshold', type=float, default=1.25,
+                            help="Slowdown ratio reported as a regression by --compare.")
+        parser.add_argument('--strict', action='store_true',
+                            help="Fail when a query budget is exceeded or --compare finds a regression.")
+
+    def handle(self, *args, **options):
+        if options['generate']:
+            try:
+                counts = generate(options['scale'], options['seed'], log=self.stdout.write)
+            except ValueError as error:
+                raise CommandError(error)
+            self.stdout.write(self.style.SUCCESS(
+                "Generated " + ", ".join(f"{count} {name}" for name, count in counts.items()) + "."
+            ))
+        if options['skip_run']:
+            return
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be positive.")
+
+        try:
+            report = run_benchmarks(options['repeat'], options['names'])
+        except ValueError as error:
+            raise CommandError(error)
+        failures = []
+        for result in report['results']:
+            line = (f"{result['name']:<50} {result['status']} {result['median_ms']:>9.1f} ms "
+                    f"(p95 {result['p95_ms']:.1f}) {result['queries']:>3}/{result['budget']} queries")
+            if result['over_budget']:
+                failures.append(f"{result['name']}: {result['queries']} queries, budget {result['budget']}")
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as stream:
+                previous = json.load(stream)
+            for name, before, after, ratio, regressed in compare_reports(previous, report, options['threshold']):
+                line = f"{name:<50} {before:>9.1f} -> {after:>9.1f} ms  x{ratio}"
+                if regressed:
+                    failures.append(f"{name}: {ratio}x slower")
+                    line = self.style.ERROR(line)
+                self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as stream:
+                json.dump(report, stream, indent=2)
+            self.stdout.write(f"Report written to {options['output']}.")
+        if failures and options['strict']:
+            raise CommandError("; ".join(failures))
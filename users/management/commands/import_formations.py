@@ -0,0 +1,40 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from users.imports import IMPORT_BATCH_SIZE, import_formations, read_rows
+
+
+class Command(BaseCommand):
+    help = "Import Formation rows from a CSV or JSON file, upserting on (structure, formation_ref)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file, JSON array or JSON lines file.")
+        parser.add_argument('--format', choices=['csv', 'json'],
+                            help="File format; guessed from the extension by default.")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help="Rows validated and written per transaction.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Validate and count without writing anything.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('json' if os.path.splitext(path)[1].lower() in ('.json', '.jsonl') else 'csv')
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        started = time.monotonic()
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as stream:
+                result = import_formations(read_rows(stream, fmt), options['batch_size'], options['dry_run'])
+        except OSError as error:
+            raise CommandError(f"Cannot read {path}: {error}")
+        except ValueError as error:
+            raise CommandError(f"Cannot parse {path}: {error}")
+        for line, message in result.errors:
+            self.stderr.write(f"Line {line}: {message}")
+        if result.rejected > len(result.errors):
+            self.stderr.write(f"... and {result.rejected - len(result.errors)} more rejected row(s).")
+        prefix = "Dry run: " if options['dry_run'] else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}{result.inserted} inserted, {result.updated} updated, {result.rejected} rejected "
+            f"in {time.monotonic() - started:.2f}s."
+        ))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from users.models import Notification, UserFormation
+from users.sharding import move_misplaced_rows
+
+
+class Command(BaseCommand):
+    help = ("Move enrollments and notifications to the shard of their user's structure, after "
+            "STRUCTURE_SHARDS changed or users moved between structures.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Users moved per transaction.")
+
+    def handle(self, *args, **options):
+        for model in (UserFormation, Notification):
+            moved = move_misplaced_rows(model, options['batch_size'])
+            self.stdout.write(f"{model._meta.verbose_name_plural}: {moved} row(s) moved.")
+        self.stdout.write(self.style.SUCCESS("Shards are balanced."))
@@ -0,0 +1,18 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from users.search import fts_available, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index over the Formation catalog in one bulk pass."
+
+    def handle(self, *args, **options):
+        if not fts_available():
+            raise CommandError("The formation search index requires SQLite FTS5.")
+        started = time.monotonic()
+        with transaction.atomic():
+            count = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {count} formation(s) in {time.monotonic() - started:.2f}s."
+        ))
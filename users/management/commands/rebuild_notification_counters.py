@@ -0,0 +1,14 @@
+import time
+from django.core.management.base import BaseCommand
+from users.models import NotificationCounter
+
+
+class Command(BaseCommand):
+    help = "Recompute every user's unread-notification counter from the notifications on all shards."
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        counters = NotificationCounter.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {counters} unread counter(s) in {time.monotonic() - started:.2f}s."
+        ))
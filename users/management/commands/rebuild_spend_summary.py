@@ -0,0 +1,14 @@
+import time
+from django.core.management.base import BaseCommand
+from users.analytics import rebuild_spend_summary
+
+
+class Command(BaseCommand):
+    help = "Recompute the training spend summary table from the approved enrollments."
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        buckets = rebuild_spend_summary()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {buckets} spend bucket(s) in {time.monotonic() - started:.2f}s."
+        ))
@@ -0,0 +1,47 @@
+import time
+from django.core.management.base import BaseCommand
+from users.outbox import DRAIN_BATCH_SIZE, drain, outbox_lag, purge_done_events
+
+
+class Command(BaseCommand):
+    help = "Deliver queued outbox events (notifications) in batches, retrying failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DRAIN_BATCH_SIZE,
+                            help="Number of events claimed per batch.")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to sleep when the outbox is empty.")
+        parser.add_argument('--report-every', type=float, default=60.0,
+                            help="Seconds between lag reports (delivered events are purged at the same pace).")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the outbox once and exit.")
+
+    def report(self):
+        purged = purge_done_events()
+        if purged:
+            self.stdout.write(f"Purged {purged} delivered event(s).")
+        lag = outbox_lag()
+        self.stdout.write(
+            f"Outbox: {lag['pending']} pending, {lag['failed']} failed, lag {lag['lag_seconds']:.1f}s"
+        )
+
+    def handle(self, *args, **options):
+        if options['once']:
+            delivered, failed = drain(options['batch_size'])
+            self.stdout.write(f"Delivered {delivered} event(s), {failed} failed.")
+            self.report()
+            return
+        last_report = 0.0
+        self.stdout.write("Outbox worker started.")
+        try:
+            while True:
+                delivered, failed = drain(options['batch_size'], max_batches=100)
+                if delivered or failed:
+                    self.stdout.write(f"Delivered {delivered} event(s), {failed} failed.")
+                if time.monotonic() - last_report >= options['report_every']:
+                    self.report()
+                    last_report = time.monotonic()
+                if not delivered and not failed:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Outbox worker stopped.")
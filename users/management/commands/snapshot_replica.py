@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from users.database import snapshot_sqlite
+
+
+class Command(BaseCommand):
+    help = ("Refresh the local read replica stand-in: copy the primary SQLite database into the "
+            "replica's file. Run it periodically (cron) to emulate replication lag.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='replica', help="Replica alias to refresh.")
+        parser.add_argument('--to', metavar='PATH', help="Write the snapshot to this file instead.")
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        if alias == DEFAULT_DB_ALIAS or alias not in connections.settings:
+            raise CommandError(f"Unknown replica alias {alias!r}.")
+        source = connections[DEFAULT_DB_ALIAS]
+        if source.vendor != 'sqlite' or connections.settings[alias]['ENGINE'] != source.settings_dict['ENGINE']:
+            raise CommandError("Snapshots are only for the SQLite replica stand-in.")
+        target = options['to'] or str(connections.settings[alias]['NAME'])
+        pages = snapshot_sqlite(source, target)
+        self.stdout.write(self.style.SUCCESS(f"Copied {pages} page(s) of {source.settings_dict['NAME']} to {target}."))
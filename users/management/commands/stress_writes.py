@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+from collections import Counter
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+from users.stress import run_write_stress
+
+
+class Command(BaseCommand):
+    help = ("Concurrency stress test: parallel writers enroll and approve against a throw-away copy of the "
+            "schema, using the configured SQLite profile. Never touches the configured database file or cache.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help="Parallel writer threads.")
+        parser.add_argument('--iterations', type=int, default=25, help="Enroll + approve rounds per writer.")
+        parser.add_argument('--no-profile', action='store_true',
+                            help="Run with SQLite defaults (rollback journal, deferred transactions) for comparison.")
+
+    def handle(self, *args, **options):
+        database = connections.settings['default']
+        if database['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError("The stress test is for the SQLite profile.")
+        if options['writers'] < 2 or options['iterations'] < 1:
+            raise CommandError("Use at least 2 writers and 1 iteration.")
+
+        # Point 'default' at a temporary file for the rest of this process; the
+        # settings dict is shared by every connection the writer threads open.
+        connections.close_all()
+        directory = tempfile.mkdtemp(prefix='stress-')
+        original = database['NAME']
+        database['NAME'] = os.path.join(directory, 'stress.sqlite3')
+        # Cache versions bumped by the approvals belong to the throw-away rows, not the project's cache.
+        profile = {'CACHES': {'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(directory, 'cache'),
+        }}}
+        if options['no_profile']:
+            profile['SQLITE_PRAGMAS'] = {'journal_mode': 'DELETE'}
+            profile['SQLITE_WRITE_TRANSACTION_MODE'] = None
+        try:
+            with override_settings(**profile):
+                call_command('migrate', run_syncdb=True, verbosity=0)
+                result = run_write_stress(options['writers'], options['iterations'])
+        finally:
+            connections.close_all()
+            database['NAME'] = original
+            shutil.rmtree(directory, ignore_errors=True)
+
+        self.stdout.write(
+            f"{result.writers} writers, {result.operations} operations in {result.seconds:.2f}s, "
+            f"p95 {result.p95_ms:.1f} ms, {len(result.errors)} error(s)."
+        )
+        for message, count in Counter(result.errors).most_common():
+            self.stdout.write(self.style.ERROR(f"  {count} x {message}"))
+        if result.errors:
+            raise CommandError(f"{len(result.errors)} write(s) failed under contention.")
+        self.stdout.write(self.style.SUCCESS("No lock errors."))
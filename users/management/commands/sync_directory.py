@@ -0,0 +1,65 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from users.audit import audit_actor
+from users.directory import apply_sync, plan_sync, read_directory
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = "Create or update users in bulk from an HR directory export (CSV or LDIF)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file (email, username, firstname, lastname, role, structure_code, "
+                                         "department_code, password) or LDIF file.")
+        parser.add_argument('--format', choices=['csv', 'ldif'],
+                            help="File format; guessed from the extension by default.")
+        parser.add_argument('--approve', action='store_true',
+                            help="Approve the synced users that are still pending, in the same transaction.")
+        parser.add_argument('--actor', metavar='EMAIL',
+                            help="User recorded as the author of the changes and approvals.")
+        parser.add_argument('--workers', type=int,
+                            help="Processes used to hash initial passwords (default: CPU count).")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only print the differences; write nothing.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('ldif' if path.lower().endswith('.ldif') else 'csv')
+        actor = None
+        if options['actor']:
+            actor = User.objects.filter(user_email=options['actor']).first()
+            if actor is None:
+                raise CommandError(f"No user with email {options['actor']}.")
+        started = time.monotonic()
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as stream:
+                plan = plan_sync(read_directory(stream, fmt))
+        except OSError as error:
+            raise CommandError(f"Cannot read {path}: {error}")
+        except ValueError as error:
+            raise CommandError(f"Cannot parse {path}: {error}")
+
+        for row in plan.creates:
+            self.stdout.write(f"+ {row['user_email']} ({row['user_username']}, {row['user_role']})")
+        for user, changes in plan.updates:
+            diff = ', '.join(f"{name}: {old!r} -> {new!r}" for name, (old, new) in changes.items())
+            self.stdout.write(f"~ {user.user_email}: {diff}")
+        for line, message in plan.errors:
+            self.stderr.write(f"! line {line}: {message}")
+
+        summary = (
+            f"{len(plan.creates)} to create, {len(plan.updates)} to update, "
+            f"{plan.unchanged} unchanged, {len(plan.errors)} rejected"
+        )
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Dry run: {summary}."))
+            return
+        with audit_actor(actor):
+            created, updated, approved = apply_sync(
+                plan, approve=options['approve'], actor=actor, workers=options['workers'] or os.cpu_count(),
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"{created} created, {updated} updated, {approved} approved, {plan.unchanged} unchanged, "
+            f"{len(plan.errors)} rejected in {time.monotonic() - started:.2f}s."
+        ))
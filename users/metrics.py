@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_RATE = 1.0
+# The same SQL statement this many times in one request is reported as a probable N+1.
+DEFAULT_DUPLICATE_QUERY_THRESHOLD = 5
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNRESOLVED_VIEW = '<unresolved>'
+
+
+def sample_rate():
+    return float(getattr(settings, 'METRICS_SAMPLE_RATE', DEFAULT_SAMPLE_RATE))
+
+
+def duplicate_query_threshold():
+    return int(getattr(settings, 'METRICS_DUPLICATE_QUERY_THRESHOLD', DEFAULT_DUPLICATE_QUERY_THRESHOLD))
+
+
+class QueryRecorder:
+    """``connection.execute_wrapper`` that counts statements and their time, keyed by SQL text.
+
+    The SQL still has its placeholders, so a statement run once per row of a
+    list shows up as one text with a high count.
+    """
+
+    def __init__(self):
+        self.statements = Counter()
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.statements[sql] += 1
+
+    @property
+    def count(self):
+        return sum(self.statements.values())
+
+    @property
+    def duplicates(self):
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+    def most_repeated(self):
+        return self.statements.most_common(1)[0] if self.statements else (None, 0)
+
+
+class _ViewStats:
+    __slots__ = (
+        'responses', 'buckets', 'duration', 'size', 'sized', 'sampled', 'queries', 'sql_seconds',
+        'duplicates', 'n_plus_one',
+    )
+
+    def __init__(self):
+        self.responses = Counter()
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.duration = 0.0
+        self.size = 0
+        self.sized = 0
+        self.sampled = 0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.duplicates = 0
+        self.n_plus_one = 0
+
+
+class MetricsRegistry:
+    # Per process, like any Prometheus client: each worker is scraped (or summed) separately.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        self._counters = Counter()
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+            self._counters = Counter()
+
+    def increment(self, name, outcome):
+        """Count one ``outcome`` of the event ``name`` (a cache lookup, a throttle check)."""
+        with self._lock:
+            self._counters[(name, outcome)] += 1
+
+    def counts(self, name, outcomes):
+        with self._lock:
+            return {outcome: self._counters[(name, outcome)] for outcome in outcomes}
+
+    def record(self, view, action, method, status, duration, size=None, queries=None):
+        with self._lock:
+            stats = self._views.setdefault((view, action), _ViewStats())
+            stats.responses[(method, status)] += 1
+            stats.duration += duration
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    stats.buckets[index] += 1
+            if size is not None:
+                stats.size += size
+                stats.sized += 1
+            if queries is not None:
+                stats.sampled += 1
+                stats.queries += queries.count
+                stats.sql_seconds += queries.seconds
+                stats.duplicates += queries.duplicates
+                stats.n_plus_one += queries.most_repeated()[1] >= duplicate_query_threshold()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: {name: getattr(stats, name) for name in _ViewStats.__slots__}
+                for key, stats in self._views.items()
+            }
+
+
+registry = MetricsRegistry()
+
+
+def view_labels(request):
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else UNRESOLVED_VIEW
+    action = ''
+    # Admin changelist actions all post to the changelist URL; the action name tells them apart.
+    if request.method == 'POST' and view.endswith('_changelist'):
+        action = request.POST.get('action', '')
+    return view, action
+
+
+def response_size(response):
+    if getattr(response, 'streaming', False):
+        return None
+    return len(response.content)
+
+
+def record_request(request, response, duration, queries=None):
+    view, action = view_labels(request)
+    size = response_size(response)
+    registry.record(view, action, request.method, response.status_code, duration, size, queries)
+    if queries is None:
+        return
+    statement, repeated = queries.most_repeated()
+    line = {
+        'view': view,
+        'action': action,
+        'method': request.method,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 2),
+        'queries': queries.count,
+        'sql_ms': round(queries.seconds * 1000, 2),
+        'duplicate_queries': queries.duplicates,
+        'bytes': size,
+    }
+    logger.info(json.dumps(line))
+    if repeated >= duplicate_query_threshold():
+        logger.warning("Possible N+1 in %s: %d executions of %s", view, repeated, statement[:200])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def render_prometheus(extra=()):
+    """The registry in the Prometheus text exposition format.
+
+    ``extra`` adds families given as ``(name, type, help, [(labels, value), ...])``.
+    """
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{_labels(**labels)} {value}")
+
+    views = sorted(registry.snapshot().items())
+    family('http_requests_total', 'counter', 'Responses by view, admin action, method and status.', [
+        ('', {'view': view, 'action': action, 'method': method, 'status': status}, count)
+        for (view, action), stats in views
+        for (method, status), count in sorted(stats['responses'].items())
+    ])
+    samples = []
+    for (view, action), stats in views:
+        labels = {'view': view, 'action': action}
+        for bound, count in zip(DURATION_BUCKETS, stats['buckets']):
+            samples.append(('_bucket', {**labels, 'le': bound}, count))
+        total = sum(stats['responses'].values())
+        samples.append(('_bucket', {**labels, 'le': '+Inf'}, total))
+        samples.append(('_sum', labels, round(stats['duration'], 6)))
+        samples.append(('_count', labels, total))
+    family('http_request_duration_seconds', 'histogram', 'Wall time spent in the middleware stack and view.', samples)
+    family('http_response_size_bytes', 'summary', 'Size of non-streaming response bodies.', [
+        sample for (view, action), stats in views for sample in (
+            ('_sum', {'view': view, 'action': action}, stats['size']),
+            ('_count', {'view': view, 'action': action}, stats['sized']),
+        )
+    ])
+    for name, key, help_text in (
+        ('http_sampled_requests_total', 'sampled', 'Requests whose SQL was recorded.'),
+        ('db_queries_total', 'queries', 'SQL statements run by sampled requests.'),
+        ('db_query_duration_seconds_total', 'sql_seconds', 'Time spent in SQL by sampled requests.'),
+        ('db_duplicate_queries_total', 'duplicates', 'Repeated executions of an identical SQL statement.'),
+        ('db_n_plus_one_requests_total', 'n_plus_one', 'Sampled requests flagged as a probable N+1.'),
+    ):
+        family(name, 'counter', help_text, [
+            ('', {'view': view, 'action': action}, round(stats[key], 6)) for (view, action), stats in views
+        ])
+    family('metrics_sample_rate', 'gauge', 'Share of requests whose SQL is recorded.', [('', {}, sample_rate())])
+    for name, kind, help_text, extra_samples in extra:
+        family(name, kind, help_text, [('', labels, value) for labels, value in extra_samples])
+    return '\n'.join(lines) + '\n'
+
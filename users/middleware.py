@@ -0,0 +1,101 @@
+import random
+import time
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from .audit import audit_actor
+from .metrics import QueryRecorder, record_request, sample_rate
+from .routers import PRIMARY_COOKIE, primary_scope, primary_written, sticky_seconds
+
+
+class AuditActorMiddleware:
+    """Attribute the writes made while handling a request to the logged-in user.
+
+    Async-capable so that streaming views do not pin a worker thread for the
+    whole connection; ``request.user`` is only resolved when something is written.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with audit_actor(request.user):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with audit_actor(request.user):
+            return await self.get_response(request)
+
+
+class MetricsMiddleware:
+    """Time every request; for a ``METRICS_SAMPLE_RATE`` share of them also record their SQL.
+
+    Async requests (the notification stream and poll) are timed without SQL,
+    which runs in other threads there.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        rate = sample_rate()
+        if rate <= 0 or random.random() >= rate:
+            response = self.get_response(request)
+            record_request(request, response, time.perf_counter() - started)
+            return response
+        queries = QueryRecorder()
+        # Every alias: reads can go to a replica and enrollments and notifications to a shard.
+        with ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(queries))
+            response = self.get_response(request)
+        record_request(request, response, time.perf_counter() - started, queries)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        record_request(request, response, time.perf_counter() - started)
+        return response
+
+
+class ReplicaStickinessMiddleware:
+    """Read-your-writes for the replica router: after a request writes, a short-lived
+    cookie keeps the client on the primary for ``REPLICA_STICKY_SECONDS``, longer than
+    replica lag. A cookie rather than the session, so that writes cost no session save.
+
+    Async requests (the notification stream and poll) only touch unreplicated
+    models, so they pass through untouched.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with primary_scope(pinned=PRIMARY_COOKIE in request.COOKIES):
+            response = self.get_response(request)
+            if primary_written():
+                response.set_cookie(PRIMARY_COOKIE, '1', max_age=sticky_seconds(), httponly=True, samesite='Lax')
+        return response
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
@@ -0,0 +1,150 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:14
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Department',
+            fields=[
+                ('department_id', models.AutoField(primary_key=True, serialize=False)),
+                ('department_name', models.CharField(max_length=255)),
+                ('department_code', models.CharField(max_length=50, unique=True)),
+                ('department_cree_par', models.CharField(blank=True, max_length=50, null=True)),
+                ('department_cree_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('department_miseajour_par', models.CharField(blank=True, max_length=50, null=True)),
+                ('department_miseajour_date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Structure',
+            fields=[
+                ('structure_id', models.AutoField(primary_key=True, serialize=False)),
+                ('structure_varchar', models.CharField(max_length=255)),
+                ('structure_code', models.CharField(max_length=50)),
+                ('structure_cree_par', models.CharField(blank=True, max_length=50, null=True)),
+                ('structure_cree_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('structure_miseajour_par', models.CharField(blank=True, max_length=50, null=True)),
+                ('structure_miseajour_date', models.DateTimeField(auto_now=True)),
+                ('structure_niveau', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('user_id', models.AutoField(primary_key=True, serialize=False)),
+                ('user_firstname', models.CharField(max_length=50)),
+                ('user_lastname', models.CharField(max_length=50)),
+                ('user_username', models.CharField(max_length=50, unique=True)),
+                ('user_email', models.EmailField(max_length=254, unique=True)),
+                ('user_password', models.CharField(max_length=128)),
+                ('user_cree_par', models.CharField(blank=True, max_length=50, null=True)),
+                ('user_cree_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user_miseajour_par', models.CharField(blank=True, max_length=50, null=True)),
+                ('user_miseajour_date', models.DateTimeField(auto_now=True, null=True)),
+                ('user_role', models.CharField(choices=[('employee', 'Employee'), ('manager', 'Manager'), ('department_chief', 'Department Chief'), ('DRH', 'DRH'), ('admin', 'Admin')], max_length=50)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('approved', 'Approved'), ('rejected', 'Rejected')], default='pending', max_length=20)),
+                ('is_active', models.BooleanField(default=False)),
+                ('is_staff', models.BooleanField(default=False)),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
+                ('department', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='users', to='users.department')),
+                ('structure', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='users', to='users.structure')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='AccountsDemanded',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'Account Demanded',
+                'verbose_name_plural': 'Accounts Demanded',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('users.user',),
+        ),
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('notification_id', models.AutoField(primary_key=True, serialize=False)),
+                ('message', models.TextField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('is_read', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Formation',
+            fields=[
+                ('formation_id', models.AutoField(primary_key=True, serialize=False)),
+                ('formation_titre', models.CharField(max_length=255)),
+                ('formation_ref', models.CharField(max_length=50)),
+                ('formation_niveau', models.CharField(max_length=50)),
+                ('formation_description', models.TextField()),
+                ('formation_cout', models.IntegerField()),
+                ('formation_mise_a_jour_cree', models.CharField(blank=True, max_length=50, null=True)),
+                ('formation_mise_a_jour_date', models.DateTimeField(auto_now=True)),
+                ('formation_pays', models.CharField(max_length=50)),
+                ('formation_duree', models.IntegerField()),
+                ('formation_prerequis', models.CharField(blank=True, max_length=255, null=True)),
+                ('formation_programme', models.TextField(blank=True, null=True)),
+                ('formation_cible', models.TextField(blank=True, null=True)),
+                ('formation_objectif', models.TextField(blank=True, null=True)),
+                ('formation_category', models.CharField(choices=[('geophysique', 'Géophysique'), ('forage_petrole', 'Forage Pétrolier'), ('production_des_hydrocarbures', 'Production des Hydrocarbures'), ('transport_des_hydrocarbures', 'Transport des Hydrocarbures'), ('exploitation_des_hydrocarbures', 'Exploitation des Hydrocarbures'), ('genie_du_gaz', 'Génie du Gaz'), ('raffinage', 'Raffinage'), ('chimie_et_analyse_des_hydrocarbures', 'Chimie et Analyse des Hydrocarbures'), ('instrumentation_petroliere', 'Instrumentation Pétrolière'), ('maintenance_industrielle', 'Maintenance Industrielle'), ('securite_industrielle_et_environnement', 'Sécurité Industrielle et Environnement'), ('economie_petroliere', 'Économie Pétrolière'), ('energies_nouvelles_et_renouvelables', 'Énergies Nouvelles et Renouvelables')], max_length=50)),
+                ('user_id', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='formations', to=settings.AUTH_USER_MODEL)),
+                ('structure', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='formations', to='users.structure')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='department',
+            name='structure',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='departments', to='users.structure'),
+        ),
+        migrations.CreateModel(
+            name='UserFormation',
+            fields=[
+                ('user_formation_id', models.AutoField(primary_key=True, serialize=False)),
+                ('date_inscription', models.DateTimeField(default=django.utils.timezone.now)),
+                ('state_formation', models.CharField(max_length=50)),
+                ('valide_par', models.CharField(blank=True, max_length=50, null=True)),
+                ('valide_date', models.DateTimeField(blank=True, null=True)),
+                ('formation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_formations', to='users.formation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_formations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PendingUserFormations',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'Pending Formation Registration',
+                'verbose_name_plural': 'Pending Formation Registrations',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('users.userformation',),
+        ),
+    ]
@@ -0,0 +1,152 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:14
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Case, IntegerField, Value, When
+
+
+def rename_duplicate_refs(apps, schema_editor):
+    # Renamed rather than deleted: a duplicate may already have enrollments.
+    # The first formation keeps the reference, the others get their id appended.
+    Formation = apps.get_model('users', 'Formation')
+    rows = Formation.objects.using(schema_editor.connection.alias)
+    duplicated = (
+        rows.values('structure_id', 'formation_ref').annotate(count=models.Count('pk')).filter(count__gt=1)
+        .values_list('structure_id', 'formation_ref')
+    )
+    max_length = Formation._meta.get_field('formation_ref').max_length
+    for structure_id, ref in duplicated:
+        formations = rows.filter(structure_id=structure_id, formation_ref=ref).order_by('pk')
+        for formation in formations[1:]:
+            suffix = f"-{formation.pk}"
+            formation.formation_ref = ref[:max_length - len(suffix)] + suffix
+            formation.save(update_fields=['formation_ref'])
+
+
+def remove_duplicate_enrollments(apps, schema_editor):
+    # Older rows were inserted without the unique constraint; keep one row per
+    # (user, formation), preferring a decided enrollment over a pending one.
+    UserFormation = apps.get_model('users', 'UserFormation')
+    rows = UserFormation.objects.using(schema_editor.connection.alias)
+    duplicated = (
+        rows.values('user_id', 'formation_id').annotate(count=models.Count('pk')).filter(count__gt=1)
+        .values_list('user_id', 'formation_id')
+    )
+    pending_last = Case(When(state_formation='pending', then=Value(1)), default=Value(0), output_field=IntegerField())
+    stale = []
+    for user_id, formation_id in duplicated:
+        ids = list(
+            rows.filter(user_id=user_id, formation_id=formation_id)
+            .order_by(pending_last, 'pk').values_list('pk', flat=True)
+        )
+        stale.extend(ids[1:])
+    for start in range(0, len(stale), 500):
+        rows.filter(pk__in=stale[start:start + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationArchive',
+            fields=[
+                ('notification_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('user_id', models.IntegerField(db_index=True)),
+                ('message', models.BinaryField()),
+                ('created_at', models.DateTimeField()),
+                ('was_read', models.BooleanField(default=True)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NotificationCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='notification_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('event_id', models.AutoField(primary_key=True, serialize=False)),
+                ('event_type', models.CharField(max_length=50)),
+                ('payload', models.JSONField()),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrainingSpendSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('structure_id', models.IntegerField(default=0)),
+                ('department_id', models.IntegerField(default=0)),
+                ('formation_category', models.CharField(max_length=50)),
+                ('formation_pays', models.CharField(max_length=50)),
+                ('month', models.DateField()),
+                ('enrollments', models.IntegerField(default=0)),
+                ('total_cost', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='userformation',
+            name='formation',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='user_formations', to='users.formation'),
+        ),
+        migrations.AlterField(
+            model_name='userformation',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='user_formations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'is_read', '-created_at'], name='notification_feed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userformation',
+            index=models.Index(fields=['date_inscription'], name='userformation_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userformation',
+            index=models.Index(fields=['state_formation', 'date_inscription'], name='userformation_state_date_idx'),
+        ),
+        migrations.RunPython(rename_duplicate_refs, migrations.RunPython.noop, hints={'model_name': 'formation'}),
+        migrations.AddConstraint(
+            model_name='formation',
+            constraint=models.UniqueConstraint(fields=('structure', 'formation_ref'), name='unique_structure_formation_ref'),
+        ),
+        migrations.RunPython(
+            remove_duplicate_enrollments, migrations.RunPython.noop, hints={'model_name': 'userformation'},
+        ),
+        migrations.AddConstraint(
+            model_name='userformation',
+            constraint=models.UniqueConstraint(fields=('user', 'formation'), name='unique_user_formation'),
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(fields=['state', 'available_at'], name='users_outbo_state_4e0d25_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trainingspendsummary',
+            index=models.Index(fields=['month', 'structure_id'], name='users_train_month_c0434b_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='trainingspendsummary',
+            constraint=models.UniqueConstraint(fields=('structure_id', 'department_id', 'formation_category', 'formation_pays', 'month'), name='unique_spend_bucket'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+def backfill_counters(apps, schema_editor):
+    # Counters start empty; count the unread notifications already stored here.
+    # Shard databases are recounted by `manage.py rebuild_notification_counters`.
+    alias = schema_editor.connection.alias
+    Notification = apps.get_model('users', 'Notification')
+    NotificationCounter = apps.get_model('users', 'NotificationCounter')
+    User = apps.get_model('users', 'User')
+    counts = (
+        Notification.objects.using(alias).filter(is_read=False, user_id__in=User.objects.using(alias).values('pk'))
+        .order_by()
+        .values_list('user_id').annotate(unread=models.Count('pk'))
+    )
+    NotificationCounter.objects.using(alias).bulk_create(
+        [NotificationCounter(user_id=user_id, unread=unread) for user_id, unread in counts],
+        batch_size=1000, ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_schema_updates'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop, hints={'model_name': 'notificationcounter'}),
+    ]
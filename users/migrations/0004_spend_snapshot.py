@@ -0,0 +1,64 @@
+from django.db import migrations, models
+from django.db.models import DateField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, TruncMonth
+
+
+def snapshot_approved_enrollments(apps, schema_editor):
+    # Approved enrollments were counted at their current bucket and cost; record it on the row.
+    alias = schema_editor.connection.alias
+    UserFormation = apps.get_model('users', 'UserFormation')
+    User = apps.get_model('users', 'User')
+    Formation = apps.get_model('users', 'Formation')
+    user = User.objects.filter(pk=OuterRef('user_id'))
+    formation = Formation.objects.filter(pk=OuterRef('formation_id'))
+    UserFormation.objects.using(alias).filter(state_formation='approved').update(
+        spend_structure_id=Coalesce(Subquery(user.values('structure_id')), Value(0)),
+        spend_department_id=Coalesce(Subquery(user.values('department_id')), Value(0)),
+        spend_formation_category=Subquery(formation.values('formation_category')),
+        spend_formation_pays=Subquery(formation.values('formation_pays')),
+        spend_month=TruncMonth('date_inscription', output_field=DateField()),
+        spend_cost=Coalesce(Subquery(formation.values('formation_cout')), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_backfill_notification_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userformation',
+            name='spend_cost',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userformation',
+            name='spend_department_id',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userformation',
+            name='spend_formation_category',
+            field=models.CharField(blank=True, editable=False, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='userformation',
+            name='spend_formation_pays',
+            field=models.CharField(blank=True, editable=False, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='userformation',
+            name='spend_month',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userformation',
+            name='spend_structure_id',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(
+            snapshot_approved_enrollments, migrations.RunPython.noop, hints={'model_name': 'userformation'},
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# Frozen copy of users.search.FTS_TABLE / FTS_COLUMNS at the time of this migration.
+FTS_TABLE = 'users_formation_fts'
+FTS_COLUMNS = 'formation_titre, formation_description, formation_programme, formation_objectif, formation_cible'
+
+
+class RunSQLWithFTS5(migrations.RunSQL):
+    """RunSQL that does nothing on databases without FTS5; search then falls back to the ORM."""
+
+    def _fts5(self, schema_editor):
+        connection = schema_editor.connection
+        if connection.vendor != 'sqlite':
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            return bool(cursor.fetchone()[0])
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self._fts5(schema_editor):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if self._fts5(schema_editor):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_spend_snapshot'),
+    ]
+
+    operations = [
+        RunSQLWithFTS5(
+            [
+                # Older releases created the table lazily: start over from the catalog.
+                'DROP TABLE IF EXISTS %s' % FTS_TABLE,
+                "CREATE VIRTUAL TABLE %s USING fts5(%s, tokenize = 'unicode61 remove_diacritics 2')"
+                % (FTS_TABLE, FTS_COLUMNS),
+                'INSERT INTO %s (rowid, %s) SELECT formation_id, %s FROM users_formation'
+                % (FTS_TABLE, FTS_COLUMNS, FTS_COLUMNS),
+            ],
+            'DROP TABLE IF EXISTS %s' % FTS_TABLE,
+            hints={'model_name': 'formation'},
+        ),
+    ]
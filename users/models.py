@@ -1,9 +1,13 @@
-from django.db import models
+import zlib
+from collections import Counter
+from django.db import models, transaction
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.utils import timezone
-from django_currentuser.middleware import get_current_authenticated_user
+from .audit import AuditedModel, AuditQuerySet
+from .sharding import ShardedManager, all_shards
 
-class UserManager(BaseUserManager):
+class UserManager(BaseUserManager.from_queryset(AuditQuerySet)):
     def _create_user(self, user_email, user_username, password=None, **extra_fields):
         if not user_email:
             raise ValueError("The Email field must be set")
@@ -33,7 +37,7 @@ class UserManager(BaseUserManager):
             raise ValueError('Superuser must have is_superuser=True.')
         return self._create_user(user_email, user_username, password, **extra_fields)
 
-class Structure(models.Model):
+class Structure(AuditedModel):
     structure_id = models.AutoField(primary_key=True)
     structure_varchar = models.CharField(max_length=255)
     structure_code = models.CharField(max_length=50)
@@ -43,18 +47,13 @@ class Structure(models.Model):
     structure_miseajour_date = models.DateTimeField(auto_now=True)
     structure_niveau = models.CharField(max_length=50)
 
-    def save(self, *args, **kwargs):
-        user = get_current_authenticated_user()
-        if user:
-            if not self.pk:  # New instance
-                self.structure_cree_par = user.user_username
-            self.structure_miseajour_par = user.user_username
-        super().save(*args, **kwargs)
+    audit_created_by = 'structure_cree_par'
+    audit_updated_by = 'structure_miseajour_par'
 
     def __str__(self):
         return self.structure_varchar
 
-class Department(models.Model):
+class Department(AuditedModel):
     department_id = models.AutoField(primary_key=True)
     department_name = models.CharField(max_length=255)
     department_code = models.CharField(max_length=50, unique=True)
@@ -64,18 +63,13 @@ class Department(models.Model):
     department_miseajour_par = models.CharField(max_length=50, blank=True, null=True)
     department_miseajour_date = models.DateTimeField(auto_now=True)
 
-    def save(self, *args, **kwargs):
-        user = get_current_authenticated_user()
-        if user:
-            if not self.pk:  # New instance
-                self.department_cree_par = user.user_username
-            self.department_miseajour_par = user.user_username
-        super().save(*args, **kwargs)
+    audit_created_by = 'department_cree_par'
+    audit_updated_by = 'department_miseajour_par'
 
     def __str__(self):
         return f"{self.department_name} ({self.structure.structure_varchar})"
 
-class User(AbstractBaseUser, PermissionsMixin):
+class User(AuditedModel, AbstractBaseUser, PermissionsMixin):
     user_id = models.AutoField(primary_key=True)
     user_firstname = models.CharField(max_length=50)
     user_lastname = models.CharField(max_length=50)
@@ -112,18 +106,13 @@ class User(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'user_email'
     REQUIRED_FIELDS = ['user_username', 'user_firstname', 'user_lastname', 'user_role']
 
-    def save(self, *args, **kwargs):
-        user = get_current_authenticated_user()
-        if user:
-            if not self.pk:  # New instance
-                self.user_cree_par = user.user_username
-            self.user_miseajour_par = user.user_username
-        super().save(*args, **kwargs)
+    audit_created_by = 'user_cree_par'
+    audit_updated_by = 'user_miseajour_par'
 
     def __str__(self):
         return self.user_username
 
-class Formation(models.Model):
+class Formation(AuditedModel):
     formation_id = models.AutoField(primary_key=True)
     formation_titre = models.CharField(max_length=255)
     formation_ref = models.CharField(max_length=50)
@@ -156,70 +145,237 @@ class Formation(models.Model):
     user_id = models.ForeignKey(User, on_delete=models.CASCADE, related_name='formations', null=True)
     structure = models.ForeignKey(Structure, on_delete=models.CASCADE, related_name='formations')
 
-    def save(self, *args, **kwargs):
-        user = get_current_authenticated_user()
-        if user:
-            if not self.pk:  # New instance
-                self.formation_mise_a_jour_cree = user.user_username
-        super().save(*args, **kwargs)
+    audit_created_by = 'formation_mise_a_jour_cree'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['structure', 'formation_ref'], name='unique_structure_formation_ref'),
+        ]
 
     def __str__(self):
         return self.formation_titre
 
-class UserFormation(models.Model):
+class UserFormation(AuditedModel):
     user_formation_id = models.AutoField(primary_key=True)
     date_inscription = models.DateTimeField(default=timezone.now)
     state_formation = models.CharField(max_length=50)
     valide_par = models.CharField(max_length=50, blank=True, null=True)
     valide_date = models.DateTimeField(blank=True, null=True)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user_formations')
-    formation = models.ForeignKey(Formation, on_delete=models.CASCADE, related_name='user_formations')
+    # No database constraints: with sharding on, the row and its user/formation live in different databases.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user_formations', db_constraint=False)
+    formation = models.ForeignKey(
+        Formation, on_delete=models.CASCADE, related_name='user_formations', db_constraint=False,
+    )
+    # The TrainingSpendSummary bucket and cost this enrollment was counted under (users.analytics),
+    # so that un-counting it hits the same bucket after a price edit or a user move. Empty when not counted.
+    spend_structure_id = models.IntegerField(null=True, blank=True, editable=False)
+    spend_department_id = models.IntegerField(null=True, blank=True, editable=False)
+    spend_formation_category = models.CharField(max_length=50, null=True, blank=True, editable=False)
+    spend_formation_pays = models.CharField(max_length=50, null=True, blank=True, editable=False)
+    spend_month = models.DateField(null=True, blank=True, editable=False)
+    spend_cost = models.IntegerField(null=True, blank=True, editable=False)
+
+    audit_created_by = 'valide_par'
+
+    objects = ShardedManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'formation'], name='unique_user_formation'),
+        ]
+        # Back the admin changelists, which order by registration date and filter on state.
+        indexes = [
+            models.Index(fields=['date_inscription'], name='userformation_date_idx'),
+            models.Index(fields=['state_formation', 'date_inscription'], name='userformation_state_date_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # State as loaded, so that post_save can tell which transition happened.
+        instance._loaded_state = instance.__dict__.get('state_formation')
+        return instance
 
     def save(self, *args, **kwargs):
-        user = get_current_authenticated_user()
-        if user:
-            if not self.pk:  # New instance
-                self.valide_par = user.user_username
+        # The spend columns are only written by users.analytics; saving an instance loaded
+        # before the enrollment was counted must not clear them.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and not field.name.startswith('spend_')
+            ]
         super().save(*args, **kwargs)
 
     def valider_par(self, validator):
+        from .outbox import enqueue_notification
         self.valide_par = validator
         self.valide_date = timezone.now()
         self.state_formation = 'validated'
-        self.save()
-        Notification.objects.create(
-            user=self.user,
-            message=f"Your participation in '{self.formation.formation_titre}' has been validated."
-        )
+        with transaction.atomic():
+            self.save()
+            enqueue_notification(
+                self.user,
+                f"Your participation in '{self.formation.formation_titre}' has been validated."
+            )
 
     def annuler_inscription(self):
+        from .outbox import enqueue_notification
         self.state_formation = 'cancelled'
-        self.save()
-        Notification.objects.create(
-            user=self.user,
-            message=f"Your participation in '{self.formation.formation_titre}' has been cancelled."
-        )
+        with transaction.atomic():
+            self.save()
+            enqueue_notification(
+                self.user,
+                f"Your participation in '{self.formation.formation_titre}' has been cancelled."
+            )
 
     def __str__(self):
         return f"{self.user.user_username} - {self.formation.formation_titre}"
 
-class Notification(models.Model):
-    objects = None
+class Notification(AuditedModel):
     notification_id = models.AutoField(primary_key=True)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications', db_constraint=False)
     message = models.TextField()
     created_at = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
 
+    objects = ShardedManager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Read state as loaded, so that save() can tell whether is_read changed (admin, scripts).
+        instance._loaded_is_read = instance.__dict__.get('is_read')
+        return instance
+
     def save(self, *args, **kwargs):
-        user = get_current_authenticated_user()
-        if user:
-            if not self.pk:  # New instance
-                self.created_at = timezone.now()
-        super().save(*args, **kwargs)
+        from .streaming import publish_unread
+        adding = self._state.adding
+        was_read = True if adding else getattr(self, '_loaded_is_read', None)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'is_read' not in update_fields:
+            was_read = None
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if was_read is not None and was_read != self.is_read:
+                NotificationCounter.objects.adjust({self.user_id: -1 if self.is_read else 1})
+                if not adding:
+                    # New notifications reach the streams through the hub's poll, with their count.
+                    publish_unread([self.user_id])
+        if was_read is not None:
+            self._loaded_is_read = self.is_read
 
     def __str__(self):
         return f"Notification for {self.user.user_username}: {self.message[:50]}"
 
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['user', 'is_read', '-created_at'], name='notification_feed_idx')]
+
+class NotificationCounterManager(models.Manager):
+    def adjust(self, deltas):
+        """Apply ``{user_id: delta}`` to the unread counters, creating missing rows."""
+        deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        # Only increments may need a fresh row; a decrement for a missing row means the user is being deleted.
+        self.bulk_create(
+            [self.model(user_id=user_id) for user_id, delta in deltas.items() if delta > 0],
+            ignore_conflicts=True,
+        )
+        by_delta = {}
+        for user_id, delta in deltas.items():
+            by_delta.setdefault(delta, []).append(user_id)
+        for delta, user_ids in by_delta.items():
+            # Clamped: a decrement for a row that was never counted must not go below zero.
+            self.filter(user_id__in=user_ids).update(unread=Greatest(models.F('unread') + delta, 0))
+
+    def rebuild(self):
+        """Recount the unread notifications of every user, on every shard; return the number of counters."""
+        counts = Counter()
+        for alias in all_shards():
+            counts.update(dict(
+                Notification.objects.using(alias).filter(is_read=False).order_by()
+                .values_list('user_id').annotate(unread=models.Count('pk'))
+            ))
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(
+                [self.model(user_id=user_id, unread=unread) for user_id, unread in counts.items()], batch_size=1000,
+            )
+        return len(counts)
+
+    def unread_for(self, user):
+        return self.filter(user_id=user.pk).values_list('unread', flat=True).first() or 0
+
+class NotificationCounter(models.Model):
+    # Denormalized COUNT(*) of a user's unread notifications, kept in step with every write to them.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='notification_counter')
+    unread = models.IntegerField(default=0)
+
+    objects = NotificationCounterManager()
+
+    def __str__(self):
+        return f"{self.user_id}: {self.unread} unread"
+
+class NotificationArchive(models.Model):
+    # Compact copy of a pruned notification: no foreign key to keep up and a zlib-compressed message.
+    notification_id = models.IntegerField(primary_key=True)
+    user_id = models.IntegerField(db_index=True)
+    message = models.BinaryField()
+    created_at = models.DateTimeField()
+    was_read = models.BooleanField(default=True)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    @property
+    def message_text(self):
+        return zlib.decompress(bytes(self.message)).decode('utf-8')
+
+    def __str__(self):
+        return f"Archived notification {self.notification_id} for user {self.user_id}"
+
+class TrainingSpendSummary(models.Model):
+    # Approved enrollments and their cost per bucket; 0 stands for "no structure/department".
+    structure_id = models.IntegerField(default=0)
+    department_id = models.IntegerField(default=0)
+    formation_category = models.CharField(max_length=50)
+    formation_pays = models.CharField(max_length=50)
+    month = models.DateField()
+    enrollments = models.IntegerField(default=0)
+    total_cost = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['structure_id', 'department_id', 'formation_category', 'formation_pays', 'month'],
+                name='unique_spend_bucket',
+            ),
+        ]
+        indexes = [models.Index(fields=['month', 'structure_id'])]
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} {self.formation_category}/{self.formation_pays}: {self.total_cost}"
+
+class OutboxEvent(models.Model):
+    event_id = models.AutoField(primary_key=True)
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    state = models.CharField(
+        max_length=20,
+        choices=[
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('failed', 'Failed')
+        ],
+        default='pending'
+    )
+    attempts = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.event_type} #{self.event_id} ({self.state})"
+
+    class Meta:
+        indexes = [models.Index(fields=['state', 'available_at'])]
@@ -0,0 +1,174 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+from .database import write_atomic
+from .models import Notification, NotificationCounter, OutboxEvent
+from .sharding import shard_atomic
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_EVENT = 'notification'
+EVENT_MAX_ITEMS = 1000
+DRAIN_BATCH_SIZE = 50
+NOTIFICATION_BATCH_SIZE = 1000
+CLAIM_LEASE = timedelta(minutes=5)
+RETRY_BASE_DELAY = timedelta(seconds=10)
+MAX_ATTEMPTS = 8
+PURGE_BATCH_SIZE = 1000
+DEFAULT_OUTBOX_RETENTION_DAYS = 7
+
+
+def enqueue_notifications(notifications):
+    """Queue ``(user_id, message)`` pairs for delivery by the outbox worker.
+
+    Call it inside the transaction that changes the state being notified: the
+    events then commit, or roll back, together with that change.
+    """
+    items = [[user_id, message] for user_id, message in notifications]
+    events = [
+        OutboxEvent(event_type=NOTIFICATION_EVENT, payload={'notifications': items[start:start + EVENT_MAX_ITEMS]})
+        for start in range(0, len(items), EVENT_MAX_ITEMS)
+    ]
+    OutboxEvent.objects.bulk_create(events)
+    return len(items)
+
+
+def enqueue_notification(user, message):
+    return enqueue_notifications([(user.pk, message)])
+
+
+def deliver_notifications(events):
+    notifications = [
+        Notification(user_id=user_id, message=message)
+        for event in events
+        for user_id, message in event.payload['notifications']
+    ]
+    Notification.objects.bulk_create(notifications, batch_size=NOTIFICATION_BATCH_SIZE)
+    deltas = {}
+    for notification in notifications:
+        deltas[notification.user_id] = deltas.get(notification.user_id, 0) + 1
+    NotificationCounter.objects.adjust(deltas)
+    return len(notifications)
+
+
+HANDLERS = {
+    NOTIFICATION_EVENT: deliver_notifications,
+}
+
+
+def claim_events(batch_size=DRAIN_BATCH_SIZE):
+    # Claiming pushes available_at past the lease, so a crashed worker's events come back on their own.
+    now = timezone.now()
+    with write_atomic():
+        qs = OutboxEvent.objects.filter(state='pending', available_at__lte=now).order_by('event_id')
+        if connection.features.has_select_for_update_skip_locked:
+            qs = qs.select_for_update(skip_locked=True)
+        events = list(qs[:batch_size])
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+            available_at=now + CLAIM_LEASE, attempts=F('attempts') + 1,
+        )
+    for event in events:
+        event.attempts += 1
+    return events
+
+
+def _complete(events):
+    OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+        state='done', processed_at=timezone.now(), last_error=None,
+    )
+
+
+def _fail(event, error):
+    now = timezone.now()
+    if event.attempts >= MAX_ATTEMPTS:
+        event.state = 'failed'
+        event.processed_at = now
+    event.available_at = now + RETRY_BASE_DELAY * (2 ** (event.attempts - 1))
+    event.last_error = f"{type(error).__name__}: {error}"
+    event.save(update_fields=['state', 'processed_at', 'available_at', 'last_error'])
+    logger.warning("Outbox event %s failed (attempt %s): %s", event.pk, event.attempts, event.last_error)
+
+
+def process_events(events):
+    """Deliver claimed events, a whole batch per handler when possible.
+
+    When a batch fails, its events are retried one by one so that a single bad
+    event only delays itself. Returns ``(delivered_events, failed_events)``.
+    """
+    delivered, failed = 0, 0
+    by_type = {}
+    for event in events:
+        by_type.setdefault(event.event_type, []).append(event)
+    for event_type, group in by_type.items():
+        handler = HANDLERS.get(event_type)
+        if handler is None:
+            for event in group:
+                _fail(event, LookupError(f"no handler for event type '{event_type}'"))
+            failed += len(group)
+            continue
+        # Handlers may write to every shard (notifications go to their user's).
+        if len(group) > 1:
+            try:
+                with shard_atomic():
+                    handler(group)
+                    _complete(group)
+                delivered += len(group)
+                continue
+            except Exception:
+                logger.exception("Outbox batch of %s '%s' event(s) failed, retrying one by one", len(group), event_type)
+        for event in group:
+            try:
+                with shard_atomic():
+                    handler([event])
+                    _complete([event])
+                delivered += 1
+            except Exception as error:
+                _fail(event, error)
+                failed += 1
+    return delivered, failed
+
+
+def drain(batch_size=DRAIN_BATCH_SIZE, max_batches=None):
+    """Process claimable events until none are left; return ``(delivered, failed)``."""
+    delivered, failed, batches = 0, 0, 0
+    while max_batches is None or batches < max_batches:
+        events = claim_events(batch_size)
+        if not events:
+            break
+        batch_delivered, batch_failed = process_events(events)
+        delivered += batch_delivered
+        failed += batch_failed
+        batches += 1
+    return delivered, failed
+
+
+def purge_done_events(days=None, batch_size=PURGE_BATCH_SIZE):
+    """Delete delivered events processed more than ``days`` ago; return how many went.
+
+    Failed events are kept for inspection. Deleting in batches keeps each write
+    transaction short, so the worker and enqueuing requests are not held up.
+    """
+    if days is None:
+        days = getattr(settings, 'OUTBOX_RETENTION_DAYS', DEFAULT_OUTBOX_RETENTION_DAYS)
+    cutoff = timezone.now() - timedelta(days=days)
+    qs = OutboxEvent.objects.filter(state='done', processed_at__lt=cutoff).order_by('event_id')
+    purged = 0
+    while True:
+        pks = list(qs.values_list('event_id', flat=True)[:batch_size])
+        if not pks:
+            return purged
+        purged += OutboxEvent.objects.filter(pk__in=pks).delete()[0]
+
+
+def outbox_lag():
+    stats = OutboxEvent.objects.exclude(state='done').aggregate(
+        pending=Count('event_id', filter=Q(state='pending')),
+        failed=Count('event_id', filter=Q(state='failed')),
+        oldest=Min('created_at', filter=Q(state='pending')),
+    )
+    oldest = stats.pop('oldest')
+    stats['lag_seconds'] = (timezone.now() - oldest).total_seconds() if oldest else 0.0
+    return stats
@@ -0,0 +1,66 @@
+import time
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from .models import Department, Structure
+
+REFERENCE_VERSION_KEY = 'reference:version'
+# Invalidation bumps the version instead of deleting keys: the entries it orphans expire after this.
+REFERENCE_CACHE_TIMEOUT = 300
+
+
+def cache_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Seeded from the clock so that a lost key never brings back an older version.
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache_version(key)
+
+
+def invalidate_now_and_on_commit(invalidate, *args):
+    """Call ``invalidate(*args)`` now and once more when the current transaction commits.
+
+    Until the commit other requests still read the old rows and may cache them
+    afresh; the second call drops what they stored.
+    """
+    invalidate(*args)
+    transaction.on_commit(lambda: invalidate(*args))
+
+
+def reference_version():
+    return cache_version(REFERENCE_VERSION_KEY)
+
+
+def bump_reference_version():
+    bump_cache_version(REFERENCE_VERSION_KEY)
+
+
+# Loaders read the primary: a lagging replica would store stale rows under the new version.
+def _cached(name, loader):
+    key = f"reference:{reference_version()}:{name}"
+    value = cache.get(key)
+    if value is None:
+        value = loader()
+        cache.set(key, value, REFERENCE_CACHE_TIMEOUT)
+    return value
+
+
+def cached_structures():
+    return _cached('structures', lambda: list(
+        Structure.objects.using(DEFAULT_DB_ALIAS).order_by('structure_varchar')
+        .values('structure_id', 'structure_varchar', 'structure_code')
+    ))
+
+
+def cached_departments(structure_id):
+    return _cached(f"departments:{structure_id}", lambda: list(
+        Department.objects.using(DEFAULT_DB_ALIAS).filter(structure_id=structure_id).order_by('department_name')
+        .values('department_id', 'department_name', 'department_code')
+    ))
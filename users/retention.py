@@ -0,0 +1,174 @@
+import gzip
+import io
+import json
+import os
+import time
+import zlib
+from datetime import timedelta
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+from .models import Notification, NotificationArchive, NotificationCounter
+from .sharding import all_shards, shard_atomic
+
+RETENTION_BATCH_SIZE = 1000
+# Free pages handed back per incremental_vacuum step; each step is one short write.
+VACUUM_STEP_PAGES = 2000
+INCREMENTAL_AUTO_VACUUM = 2  # PRAGMA auto_vacuum value
+
+# Each policy applies to the notifications older than ``days`` in the given read
+# state; ``action`` is 'archive' (copy to NotificationArchive, then delete) or 'delete'.
+DEFAULT_RETENTION_POLICIES = [
+    {'name': 'read', 'is_read': True, 'days': 90, 'action': 'archive'},
+    {'name': 'unread', 'is_read': False, 'days': 365, 'action': 'archive'},
+]
+RETENTION_ACTIONS = ('archive', 'delete')
+
+
+def retention_policies():
+    policies = getattr(settings, 'NOTIFICATION_RETENTION_POLICIES', DEFAULT_RETENTION_POLICIES)
+    for policy in policies:
+        if policy.get('action') not in RETENTION_ACTIONS:
+            raise ValueError(f"Unknown retention action {policy.get('action')!r} in policy {policy.get('name')!r}.")
+        if policy.get('days') is None or policy['days'] < 0:
+            raise ValueError(f"Retention policy {policy.get('name')!r} needs a non-negative 'days'.")
+    return policies
+
+
+def policy_queryset(policy, now=None):
+    cutoff = (now or timezone.now()) - timedelta(days=policy['days'])
+    qs = Notification.objects.filter(created_at__lt=cutoff)
+    if policy.get('is_read') is not None:
+        qs = qs.filter(is_read=policy['is_read'])
+    return qs
+
+
+def archive_rows(rows):
+    NotificationArchive.objects.bulk_create(
+        [
+            NotificationArchive(
+                notification_id=pk, user_id=user_id, created_at=created_at, was_read=is_read,
+                message=zlib.compress(message.encode('utf-8')),
+            )
+            for pk, user_id, message, created_at, is_read in rows
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def export_rows(rows, stream):
+    for pk, user_id, message, created_at, is_read in rows:
+        stream.write(json.dumps({
+            'notification_id': pk,
+            'user_id': user_id,
+            'message': message,
+            'created_at': created_at.isoformat(),
+            'is_read': is_read,
+        }) + '\n')
+
+
+def _remove_batch(rows, using=DEFAULT_DB_ALIAS):
+    # A raw DELETE skips the per-row post_delete signal; counters are adjusted once per batch instead.
+    Notification.objects.using(using).filter(pk__in=[row[0] for row in rows])._raw_delete(using)
+    deltas = {}
+    for _, user_id, _, _, is_read in rows:
+        if not is_read:
+            deltas[user_id] = deltas.get(user_id, 0) - 1
+    NotificationCounter.objects.adjust(deltas)
+
+
+def apply_policy(policy, batch_size=RETENTION_BATCH_SIZE, now=None, export=None, dry_run=False, pause=0.0):
+    """Prune the notifications matched by ``policy``; return the number of rows handled.
+
+    Rows go in primary-key order, shard by shard, one short transaction per batch,
+    so writers are never blocked for longer than a single batch. With ``export``, each
+    batch is written and synced to it before its rows are deleted: a batch whose
+    deletion then fails is exported again by the next run, duplicates share their
+    ``notification_id``.
+    """
+    qs = policy_queryset(policy, now)
+    if dry_run:
+        return qs.count()
+    handled = 0
+    for using in all_shards():
+        handled += _apply_on_shard(policy, qs.using(using), using, batch_size, export, pause)
+    return handled
+
+
+def _apply_on_shard(policy, qs, using, batch_size, export, pause):
+    handled, last_pk = 0, 0
+    while True:
+        # The archive and the counters are on 'default'.
+        with shard_atomic([using]):
+            rows = list(
+                qs.filter(notification_id__gt=last_pk).select_for_update().order_by('notification_id')
+                .values_list('notification_id', 'user_id', 'message', 'created_at', 'is_read')[:batch_size]
+            )
+            if not rows:
+                break
+            if policy['action'] == 'archive':
+                if export is not None:
+                    export_rows(rows, export)
+                    sync_export(export)
+                else:
+                    archive_rows(rows)
+            _remove_batch(rows, using)
+        handled += len(rows)
+        last_pk = rows[-1][0]
+        if len(rows) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return handled
+
+
+def sync_export(stream):
+    stream.flush()
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return
+    os.fsync(fileno)
+
+
+def open_export(path):
+    return gzip.open(path, 'at', encoding='utf-8') if path.endswith('.gz') else open(path, 'a', encoding='utf-8')
+
+
+def compact_database(full=False, step=VACUUM_STEP_PAGES):
+    """Give freed pages back and refresh planner statistics; only SQLite needs it done by hand.
+
+    Free pages go back ``step`` at a time through incremental_vacuum, which needs the
+    incremental auto-vacuum mode new databases get from DEFAULT_SQLITE_PRAGMAS. An
+    older file is switched by one full VACUUM, run only when ``full`` is set since it
+    rewrites the whole file under an exclusive lock. Returns ``{alias: pages released}``,
+    with None for a database not in that mode, or None on other backends.
+    """
+    if connections[DEFAULT_DB_ALIAS].vendor != 'sqlite':
+        return None
+    released = {}
+    for using in all_shards():
+        connection = connections[using]
+        if connection.in_atomic_block:
+            # executescript() would commit the caller's transaction, and VACUUM cannot run in one.
+            raise RuntimeError("compact_database() must run outside a transaction.")
+        # 'main' throughout: a shard must not touch the primary it attaches read-only.
+        with connection.cursor() as cursor:
+            if full:
+                cursor.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM main')
+            cursor.execute('PRAGMA main.auto_vacuum')
+            if cursor.fetchone()[0] != INCREMENTAL_AUTO_VACUUM:
+                released[using] = None
+            else:
+                released[using] = 0
+                while True:
+                    cursor.execute('PRAGMA main.freelist_count')
+                    pages = min(cursor.fetchone()[0], step)
+                    if not pages:
+                        break
+                    # executescript() runs the pragma to completion; execute() frees a single page.
+                    connection.connection.executescript(f'PRAGMA main.incremental_vacuum({pages});')
+                    released[using] += pages
+            cursor.execute('ANALYZE main')
+    return released
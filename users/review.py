@@ -0,0 +1,60 @@
+from .approvals import decide_user_formations, decide_users
+from .database import write_atomic
+
+REVIEW_PAGE_SIZE = 100
+REVIEW_MAX_DECISIONS = 5000
+
+# kind -> (decision function, pending filter, joined columns sent to the queue)
+REVIEW_KINDS = {
+    'users': (decide_users, {'state': 'pending'}, {
+        'email': 'user_email',
+        'username': 'user_username',
+        'firstname': 'user_firstname',
+        'lastname': 'user_lastname',
+        'role': 'user_role',
+        'structure': 'structure__structure_varchar',
+        'department': 'department__department_name',
+        'date': 'user_cree_date',
+    }),
+    'enrollments': (decide_user_formations, {'state_formation': 'pending'}, {
+        'username': 'user__user_username',
+        'firstname': 'user__user_firstname',
+        'lastname': 'user__user_lastname',
+        'formation': 'formation__formation_titre',
+        'ref': 'formation__formation_ref',
+        'structure': 'formation__structure__structure_varchar',
+        'cost': 'formation__formation_cout',
+        'date': 'date_inscription',
+    }),
+}
+DECIDED_STATES = {'approve': 'approved', 'refuse': 'rejected'}
+
+
+def review_page(queryset, kind, after=0, limit=REVIEW_PAGE_SIZE):
+    """The next ``limit`` pending items after primary key ``after``, as dicts with their relations joined."""
+    _, pending, columns = REVIEW_KINDS[kind]
+    rows = (
+        queryset.filter(pk__gt=after, **pending).order_by('pk')
+        .values_list('pk', *columns.values())[:limit]
+    )
+    return [{'id': row[0], **dict(zip(columns, row[1:]))} for row in rows]
+
+
+def commit_decisions(queryset, kind, decisions, actor=None):
+    """Apply ``{pk: 'approve'|'refuse'}`` to ``queryset`` in one transaction and return ``{pk: status}``.
+
+    Statuses are 'approved', 'rejected' or 'skipped' for items that are no longer
+    pending or are outside ``queryset``.
+    """
+    decide, _, _ = REVIEW_KINDS[kind]
+    by_decision = {}
+    for pk, decision in decisions.items():
+        by_decision.setdefault(decision, []).append(pk)
+    results = {}
+    with write_atomic():
+        for decision, ids in by_decision.items():
+            result = decide(queryset.filter(pk__in=ids), decision, actor)
+            updated = set(result.updated_ids)
+            for pk in ids:
+                results[pk] = DECIDED_STATES[decision] if pk in updated else 'skipped'
+    return results
@@ -0,0 +1,102 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from .sharding import SHARDED_MODELS, is_sharded, shard_databases, shard_for_row, shard_for_user, sharding_enabled
+
+# Rarely written, read on every page: served by the replicas listed in READ_REPLICAS.
+REPLICATED_MODELS = {'users.formation', 'users.structure', 'users.department', 'users.trainingspendsummary'}
+DEFAULT_REPLICA_STICKY_SECONDS = 10
+PRIMARY_COOKIE = 'read_primary'
+
+_primary_pinned = ContextVar('primary_pinned', default=False)
+_primary_written = ContextVar('primary_written', default=False)
+
+
+def read_replicas():
+    return list(getattr(settings, 'READ_REPLICAS', []))
+
+
+def sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', DEFAULT_REPLICA_STICKY_SECONDS)
+
+
+def pin_primary():
+    """Send the rest of this request's reads to the primary and keep the client there for a while.
+
+    Called on every write the router sees; raw SQL writers (enrollment) call it themselves.
+    """
+    _primary_pinned.set(True)
+    _primary_written.set(True)
+
+
+def primary_written():
+    return _primary_written.get()
+
+
+@contextmanager
+def primary_scope(pinned=False):
+    """Fresh pinning state for one request; ``pinned`` starts it on the primary."""
+    pinned_token = _primary_pinned.set(pinned)
+    written_token = _primary_written.set(False)
+    try:
+        yield
+    finally:
+        _primary_pinned.reset(pinned_token)
+        _primary_written.reset(written_token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower not in REPLICATED_MODELS or _primary_pinned.get():
+            return DEFAULT_DB_ALIAS
+        # Reads inside a transaction must see that transaction's writes.
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        replicas = read_replicas()
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        pin_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from snapshot_replica, never from migrate.
+        return db == DEFAULT_DB_ALIAS
+
+
+class StructureShardRouter:
+    """Sends the sharded tables (users.sharding) to the shard of the user a row belongs to.
+
+    Decides only from an instance: a row of a sharded model, or the user whose
+    related rows are read. Unbound querysets fan out by themselves.
+    """
+
+    def _shard(self, model, instance):
+        if instance is None or not is_sharded(model) or not sharding_enabled():
+            return None
+        if is_sharded(type(instance)):
+            return shard_for_row(instance)
+        if instance._meta.concrete_model._meta.label_lower == 'users.user':
+            return shard_for_user(instance)
+        return None
+
+    def db_for_read(self, model, instance=None, **hints):
+        return self._shard(model, instance)
+
+    def db_for_write(self, model, instance=None, **hints):
+        return self._shard(model, instance)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True if is_sharded(type(obj1)) or is_sharded(type(obj2)) else None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in shard_databases():
+            return None
+        # Shards hold the sharded tables only; the rest is read from the attached primary.
+        return f"{app_label}.{model_name}" in SHARDED_MODELS
@@ -0,0 +1,213 @@
+import re
+from functools import lru_cache
+from django.db import DEFAULT_DB_ALIAS, connection
+from django.db.models import Count, Q
+from django.db.models.functions import Substr
+from .models import Formation
+from .catalog import CATALOG_FIELDS
+
+FTS_TABLE = 'users_formation_fts'
+FTS_COLUMNS = ('formation_titre', 'formation_description', 'formation_programme', 'formation_objectif', 'formation_cible')
+# bm25 weights, same order as FTS_COLUMNS: a hit in the title counts the most.
+FTS_WEIGHTS = (10.0, 2.0, 1.0, 1.0, 1.0)
+FACET_FIELDS = ('formation_category', 'formation_niveau', 'formation_pays')
+SEARCH_PAGE_SIZE = 24
+SEARCH_MAX_PAGE_SIZE = 100
+INDEX_CHUNK_SIZE = 500
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_ready_databases = set()
+
+
+@lru_cache(maxsize=None)
+def _sqlite_has_fts5():
+    # A compile-time option of the SQLite library, the same for every connection of the process.
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def fts_available():
+    return connection.vendor == 'sqlite' and _sqlite_has_fts5()
+
+
+def build_match_expression(query):
+    # Every word must match, the last one as a prefix so results follow the user's typing.
+    tokens = _TOKEN_RE.findall(query or '')
+    if not tokens:
+        return None
+    terms = ['"%s"' % token for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _table_exists(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+    return cursor.fetchone() is not None
+
+
+def _create_table(cursor):
+    cursor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize = 'unicode61 remove_diacritics 2')"
+        % (FTS_TABLE, ', '.join(FTS_COLUMNS))
+    )
+
+
+def _populate(cursor, formation_ids=None):
+    columns = ', '.join(FTS_COLUMNS)
+    sql = 'INSERT INTO %s (rowid, %s) SELECT formation_id, %s FROM %s' % (
+        FTS_TABLE, columns, columns, Formation._meta.db_table,
+    )
+    params = []
+    if formation_ids is not None:
+        sql += ' WHERE formation_id IN (%s)' % ', '.join(['%s'] * len(formation_ids))
+        params = list(formation_ids)
+    cursor.execute(sql, params)
+
+
+def search_index_ready():
+    # Migration 0005 creates and fills the table where FTS5 is available; without it,
+    # search falls back to the ORM until `manage.py rebuild_formation_index` is run.
+    if not fts_available():
+        return False
+    name = connection.settings_dict['NAME']
+    if name not in _ready_databases:
+        with connection.cursor() as cursor:
+            if not _table_exists(cursor):
+                return False
+        _ready_databases.add(name)
+    return True
+
+
+def rebuild_search_index():
+    if not fts_available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+        _create_table(cursor)
+        _populate(cursor)
+        cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (FTS_TABLE, FTS_TABLE))
+        cursor.execute('SELECT COUNT(*) FROM %s' % FTS_TABLE)
+        count = cursor.fetchone()[0]
+    _ready_databases.add(connection.settings_dict['NAME'])
+    return count
+
+
+def _delete_rows(cursor, formation_ids):
+    cursor.execute(
+        'DELETE FROM %s WHERE rowid IN (%s)' % (FTS_TABLE, ', '.join(['%s'] * len(formation_ids))),
+        list(formation_ids),
+    )
+
+
+def forget_search_index():
+    _ready_databases.clear()
+
+
+def index_formations(formation_ids):
+    formation_ids = list(formation_ids)
+    if not formation_ids or not search_index_ready():
+        return
+    with connection.cursor() as cursor:
+        for start in range(0, len(formation_ids), INDEX_CHUNK_SIZE):
+            chunk = formation_ids[start:start + INDEX_CHUNK_SIZE]
+            _delete_rows(cursor, chunk)
+            _populate(cursor, chunk)
+
+
+def unindex_formations(formation_ids):
+    formation_ids = list(formation_ids)
+    if not formation_ids or not search_index_ready():
+        return
+    with connection.cursor() as cursor:
+        for start in range(0, len(formation_ids), INDEX_CHUNK_SIZE):
+            _delete_rows(cursor, formation_ids[start:start + INDEX_CHUNK_SIZE])
+
+
+def _filter_sql(filters):
+    clauses, params = [], []
+    for name, value in (filters or {}).items():
+        column = 'structure_id' if name == 'structure' else name
+        clauses.append('f.%s = %%s' % column)
+        params.append(value)
+    return ''.join(' AND ' + clause for clause in clauses), params
+
+
+def _fold_facets(rows):
+    facets = {field: {} for field in FACET_FIELDS}
+    for row in rows:
+        count = row[-1]
+        for field, value in zip(FACET_FIELDS, row):
+            facets[field][value] = facets[field].get(value, 0) + count
+    return {
+        field: [
+            {'value': value, 'count': count}
+            for value, count in sorted(values.items(), key=lambda item: -item[1])
+        ]
+        for field, values in facets.items()
+    }
+
+
+def _fts_search(match, filters, limit, offset):
+    where, filter_params = _filter_sql(filters)
+    joined = 'FROM %s JOIN %s f ON f.formation_id = %s.rowid WHERE %s MATCH %%s%s' % (
+        FTS_TABLE, Formation._meta.db_table, FTS_TABLE, FTS_TABLE, where,
+    )
+    # Without filters the FTS table alone answers counting and ranking (its rowid is the formation_id).
+    base = joined if where else 'FROM %s WHERE %s MATCH %%s' % (FTS_TABLE, FTS_TABLE)
+    params = [match] + filter_params
+    # FTS5 ranks every hit with the weighted bm25 itself and only hands back the requested page.
+    rank = 'bm25(%s)' % ', '.join(str(weight) for weight in FTS_WEIGHTS)
+    facet_columns = ', '.join('f.%s' % field for field in FACET_FIELDS)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) %s' % base, params)
+        total = cursor.fetchone()[0]
+        cursor.execute(
+            'SELECT %s.rowid %s AND %s.rank MATCH %%s ORDER BY %s.rank LIMIT %%s OFFSET %%s' % (
+                FTS_TABLE, base, FTS_TABLE, FTS_TABLE,
+            ),
+            params + [rank, limit, offset],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT %s, COUNT(*) %s GROUP BY %s' % (facet_columns, joined, facet_columns), params)
+        facets = _fold_facets(cursor.fetchall())
+    return ids, total, facets
+
+
+def _orm_search(query, filters, limit, offset):
+    # Fallback for databases without FTS5: unranked substring matching.
+    qs = Formation.objects.filter(**(filters or {}))
+    condition = Q()
+    for token in _TOKEN_RE.findall(query):
+        token_condition = Q()
+        for column in FTS_COLUMNS:
+            token_condition |= Q(**{'%s__icontains' % column: token})
+        condition &= token_condition
+    qs = qs.filter(condition)
+    ids = list(qs.order_by('formation_id').values_list('formation_id', flat=True)[offset:offset + limit])
+    rows = qs.order_by().values_list(*FACET_FIELDS).annotate(count=Count('formation_id'))
+    facets = _fold_facets(rows)
+    return ids, sum(facet['count'] for facet in facets[FACET_FIELDS[0]]), facets
+
+
+def search_formations(query, filters=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    match = build_match_expression(query)
+    if match is None:
+        return {'results': [], 'total': 0, 'facets': {field: [] for field in FACET_FIELDS}, 'next_offset': None}
+    if search_index_ready():
+        ids, total, facets = _fts_search(match, filters, limit, offset)
+    else:
+        ids, total, facets = _orm_search(query, filters, limit, offset)
+    # The FTS table lives on the primary: fetch the rows there too, a lagging replica could miss some.
+    rows = {
+        row['formation_id']: row
+        for row in Formation.objects.using(DEFAULT_DB_ALIAS).filter(formation_id__in=ids)
+        .annotate(formation_resume=Substr('formation_description', 1, 160))
+        .values(*CATALOG_FIELDS)
+    }
+    return {
+        'results': [rows[pk] for pk in ids if pk in rows],
+        'total': total,
+        'facets': facets,
+        'next_offset': offset + limit if offset + limit < total else None,
+    }
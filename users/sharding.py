@@ -0,0 +1,378 @@
+import os
+from contextlib import ExitStack, contextmanager
+from functools import cmp_to_key
+from itertools import chain
+from urllib.request import pathname2url
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, NotSupportedError, connections, models
+from django.db.models import Count, F, Max, Min, Sum
+from django.db.models.expressions import OrderBy
+from django.db.models.query import ModelIterable
+from .audit import AuditQuerySet
+from .database import write_atomic
+
+# Optional sharding of the high-volume tables by the structure of the user a row belongs
+# to. STRUCTURE_SHARDS maps structure ids to aliases from SHARD_DATABASES; unmapped
+# structures, and every other table, stay on 'default'. Shards are SQLite files that
+# attach the primary read-only, so their queries join users and formations as usual.
+SHARDED_MODELS = {'users.userformation', 'users.notification'}
+PRIMARY_SCHEMA = 'primary_db'
+# Shard n hands out primary keys from n << SHARD_ID_BITS: a row's id tells its shard,
+# and ids stay unique across shards (admin URLs, archives, notification cursors).
+SHARD_ID_BITS = 40
+
+AGGREGATE_COMBINERS = {Count: sum, Sum: sum, Max: max, Min: min}
+USER_LOOKUP_CHUNK = 10000
+
+
+def shard_databases():
+    return list(getattr(settings, 'SHARD_DATABASES', []))
+
+
+def structure_shards():
+    return getattr(settings, 'STRUCTURE_SHARDS', {})
+
+
+def sharding_enabled():
+    return bool(structure_shards())
+
+
+def is_sharded(model):
+    return model._meta.concrete_model._meta.label_lower in SHARDED_MODELS
+
+
+def all_shards():
+    """'default' and the shards structures are mapped to.
+
+    Only mapped shards are read: an unmigrated shard would resolve the sharded tables
+    to the attached primary's. Migrate a shard before mapping structures to it.
+    """
+    mapped = set(structure_shards().values())
+    return [DEFAULT_DB_ALIAS] + [alias for alias in shard_databases() if alias in mapped]
+
+
+def shard_index(alias):
+    return 0 if alias == DEFAULT_DB_ALIAS else shard_databases().index(alias) + 1
+
+
+def id_range_start(alias):
+    return shard_index(alias) << SHARD_ID_BITS
+
+
+def shard_for_pk(pk):
+    index = int(pk) >> SHARD_ID_BITS
+    return DEFAULT_DB_ALIAS if index == 0 else shard_databases()[index - 1]
+
+
+def shard_for_structure(structure_id):
+    return structure_shards().get(structure_id, DEFAULT_DB_ALIAS)
+
+
+def shard_for_user(user):
+    return shard_for_structure(user.structure_id)
+
+
+def shards_for_users(user_ids):
+    """``{alias: [user_id, ...]}``: where the rows of each user live. Unknown users are left out.
+
+    Queries the users only when sharding is on.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not sharding_enabled():
+        return {DEFAULT_DB_ALIAS: user_ids} if user_ids else {}
+    from .models import User
+    shards = {}
+    for start in range(0, len(user_ids), USER_LOOKUP_CHUNK):
+        chunk = user_ids[start:start + USER_LOOKUP_CHUNK]
+        for user_id, structure_id in User.objects.filter(pk__in=chunk).values_list('pk', 'structure_id'):
+            shards.setdefault(shard_for_structure(structure_id), []).append(user_id)
+    return shards
+
+
+def shards_for_pks(pks):
+    """``{alias: [pk, ...]}`` for rows of a sharded table, read off their ids."""
+    shards = {}
+    for pk in pks:
+        shards.setdefault(shard_for_pk(pk), []).append(pk)
+    return shards
+
+
+def shard_for_row(row):
+    """The shard a new row of a sharded model belongs on: its user's."""
+    if row._state.db:
+        return row._state.db
+    if type(row).user.is_cached(row):
+        return shard_for_user(row.user)
+    return next(iter(shards_for_users([row.user_id])), DEFAULT_DB_ALIAS)
+
+
+def queryset_shards(queryset):
+    """The databases ``queryset`` reads: its own, or every shard when it fans out."""
+    if isinstance(queryset, ShardedQuerySet) and queryset.fans_out():
+        return all_shards()
+    return [queryset.db]
+
+
+@contextmanager
+def shard_atomic(aliases=None):
+    """One write transaction per database, 'default' included, committed one after the other.
+
+    Not two-phase: a failure while committing can leave a shard committed and another not.
+    """
+    aliases = dict.fromkeys([DEFAULT_DB_ALIAS] + list(all_shards() if aliases is None else aliases))
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(write_atomic(using=alias))
+        yield
+
+
+def attach_primary(connection):
+    """Called for every new shard connection (users.signals.configure_connection)."""
+    if connection.vendor != 'sqlite':
+        raise ImproperlyConfigured("Shards attach the primary database and must use SQLite.")
+    primary = connections[DEFAULT_DB_ALIAS]
+    name = str(primary.settings_dict['NAME'])
+    if primary.is_in_memory_db():
+        # Test databases share one in-memory cache, where IMMEDIATE would lock the primary
+        # for the length of every shard transaction.
+        connection.write_transaction_mode = None
+    else:
+        # Read-only, so that BEGIN IMMEDIATE on the shard does not take the primary's write lock.
+        name = f"file:{pathname2url(os.path.abspath(name))}?mode=ro"
+    with connection.cursor() as cursor:
+        cursor.execute(f"ATTACH DATABASE %s AS {PRIMARY_SCHEMA}", [name])
+
+
+def reserve_id_range(connection, sharded_models):
+    """Start the autoincrement sequences of ``sharded_models`` at the shard's id range."""
+    start = id_range_start(connection.alias)
+    if not start:
+        return
+    with connection.cursor() as cursor:
+        for model in sharded_models:
+            table = model._meta.db_table
+            cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s", [start, table])
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, start])
+
+
+def _merge_ordering(queryset):
+    query = queryset.query
+    if query.extra_order_by:
+        raise NotSupportedError("Cannot merge shards ordered with extra().")
+    ordering = query.order_by or (queryset.model._meta.ordering if query.default_ordering else ())
+    names = []
+    for item in ordering:
+        if isinstance(item, OrderBy) and isinstance(item.expression, F):
+            item = ('-' if item.descending else '') + item.expression.name
+        if not isinstance(item, str) or item == '?':
+            raise NotSupportedError(f"Cannot merge shards ordered by {item!r}.")
+        names.append(item)
+    if names and not {name.lstrip('-') for name in names} & {'pk', queryset.model._meta.pk.name}:
+        # Ties would otherwise come back in a different order from each query of a shard.
+        names.append('pk')
+    return names
+
+
+def _compare(directions):
+    def compare(a, b):
+        for value_a, value_b, descending in zip(a[0], b[0], directions):
+            if value_a == value_b:
+                continue
+            # NULLs first, as SQLite sorts them.
+            result = -1 if value_a is None or (value_b is not None and value_a < value_b) else 1
+            return -result if descending else result
+        return 0
+    return cmp_to_key(compare)
+
+
+class ShardedQuerySet(AuditQuerySet):
+    """Queryset of a sharded model.
+
+    Bound to a database (``using()``, ``for_structure()``, a related manager of a
+    user...) it behaves as usual. Unbound while sharding is on, it fans out: it
+    reads every shard and merges the rows in the queryset's order, sums counts,
+    updates and deletes, and combines Count/Sum/Max/Min aggregates. Grouped
+    ``values().annotate()`` rows come back once per shard, and ``iterator()``
+    streams the shards one after the other.
+    """
+
+    def for_structure(self, structure_id):
+        return self.using(shard_for_structure(structure_id))
+
+    def for_user(self, user):
+        return self.using(shard_for_user(user)).filter(user=user)
+
+    def fans_out(self):
+        return self._db is None and not self._hints and sharding_enabled()
+
+    def _on_shards(self):
+        return [self.using(alias) for alias in all_shards()]
+
+    def _fetch_all(self):
+        if self._result_cache is None and self.fans_out():
+            self._result_cache = self._merge_shards()
+            self._prefetch_done = True
+        super()._fetch_all()
+
+    def _merge_shards(self):
+        low, high = self.query.low_mark, self.query.high_mark
+        base = self._chain()
+        base.query.clear_limits()
+        ordering = _merge_ordering(base)
+        if ordering:
+            base = base.order_by(*ordering)
+        parts = []
+        for shard in base._on_shards():
+            rows = shard._chain()
+            rows.query.set_limits(high=high)
+            rows = list(rows)
+            if ordering:
+                parts.append(zip(self._ordering_keys(shard, rows, ordering, high), rows))
+            else:
+                parts.append(((None, row) for row in rows))
+        merged = chain.from_iterable(parts)
+        if ordering:
+            merged = sorted(merged, key=_compare([name.startswith('-') for name in ordering]))
+        return [row for _, row in merged][low:high]
+
+    def _ordering_keys(self, shard, rows, ordering, high):
+        fields = [name.lstrip('-') for name in ordering]
+        if issubclass(self._iterable_class, ModelIterable):
+            try:
+                attnames = [
+                    self.model._meta.pk.attname if name == 'pk' else self.model._meta.get_field(name).attname
+                    for name in fields
+                ]
+            except FieldDoesNotExist:
+                attnames = None
+            if attnames:
+                return [tuple(getattr(row, attname) for attname in attnames) for row in rows]
+        # Rows that do not carry their sort key (values_list, related fields): read it alongside.
+        keys = shard.values_list(*fields)
+        keys.query.set_limits(high=high)
+        return list(keys)
+
+    def count(self):
+        if self._result_cache is not None or not self.fans_out():
+            return super().count()
+        low, high = self.query.low_mark, self.query.high_mark
+        total = 0
+        for shard in self._on_shards():
+            shard.query.clear_limits()
+            shard.query.set_limits(high=high)
+            total += shard.count()
+        if high is not None:
+            total = min(total, high)
+        return max(total - low, 0)
+
+    def exists(self):
+        if self._result_cache is not None or not self.fans_out():
+            return super().exists()
+        if self.query.is_sliced:
+            return self.count() > 0
+        return any(shard.exists() for shard in self._on_shards())
+
+    def aggregate(self, *args, **kwargs):
+        if not self.fans_out():
+            return super().aggregate(*args, **kwargs)
+        aggregates = {**{arg.default_alias: arg for arg in args}, **kwargs}
+        for name, aggregate in aggregates.items():
+            if type(aggregate) not in AGGREGATE_COMBINERS or getattr(aggregate, 'distinct', False):
+                raise NotSupportedError(f"Cannot combine {aggregate!r} across shards.")
+        results = [shard.aggregate(**aggregates) for shard in self._on_shards()]
+        combined = {}
+        for name, aggregate in aggregates.items():
+            values = [result[name] for result in results if result[name] is not None]
+            combined[name] = AGGREGATE_COMBINERS[type(aggregate)](values) if values else None
+        return combined
+
+    def iterator(self, chunk_size=None):
+        if not self.fans_out():
+            return super().iterator(chunk_size=chunk_size)
+        return chain.from_iterable(shard.iterator(chunk_size=chunk_size) for shard in self._on_shards())
+
+    def update(self, **kwargs):
+        if not self.fans_out():
+            return super().update(**kwargs)
+        return sum(shard.update(**kwargs) for shard in self._on_shards())
+
+    update.alters_data = True
+
+    def delete(self):
+        if not self.fans_out():
+            return super().delete()
+        deleted, per_model = 0, {}
+        for shard in self._on_shards():
+            count, rows = shard.delete()
+            deleted += count
+            for label, rows_deleted in rows.items():
+                per_model[label] = per_model.get(label, 0) + rows_deleted
+        return deleted, per_model
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def create(self, **kwargs):
+        if not self.fans_out():
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True)
+        return obj
+
+    create.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if not self.fans_out():
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        shard_of = {
+            user_id: alias
+            for alias, user_ids in shards_for_users(obj.user_id for obj in objs).items()
+            for user_id in user_ids
+        }
+        by_shard = {}
+        for obj in objs:
+            by_shard.setdefault(shard_of.get(obj.user_id, DEFAULT_DB_ALIAS), []).append(obj)
+        for alias, group in by_shard.items():
+            self.using(alias).bulk_create(group, *args, **kwargs)
+        return objs
+
+    bulk_create.alters_data = True
+
+
+ShardedManager = models.Manager.from_queryset(ShardedQuerySet, 'ShardedManager')
+
+
+def move_misplaced_rows(model, batch_size=1000):
+    """Move the rows of ``model`` that are not on their user's shard; return how many moved.
+
+    Run after changing STRUCTURE_SHARDS or moving users between structures. Moved rows
+    get ids in their new shard's range. Rows are copied and deleted without signals: an
+    enrollment keeps its state and spend, a notification its counter.
+    """
+    moved = 0
+    # Every shard holding the table, including those no structure is mapped to anymore.
+    sources = [DEFAULT_DB_ALIAS] + [
+        alias for alias in shard_databases()
+        if model._meta.db_table in connections[alias].introspection.table_names()
+    ]
+    for source in sources:
+        rows = model._base_manager.using(source)
+        targets = shards_for_users(rows.order_by().values_list('user_id', flat=True).distinct())
+        for target, user_ids in targets.items():
+            if target == source:
+                continue
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                with shard_atomic([source, target]):
+                    objs = list(rows.filter(user_id__in=batch))
+                    pks = [obj.pk for obj in objs]
+                    for obj in objs:
+                        obj.pk = None
+                        obj._state.adding = True
+                    model._base_manager.using(target).bulk_create(objs, batch_size=batch_size)
+                    rows.filter(pk__in=pks)._raw_delete(source)
+                moved += len(objs)
+    return moved
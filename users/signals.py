@@ -0,0 +1,103 @@
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from .analytics import SPEND_STATE, apply_spend
+from .backends import invalidate_cached_users
+from .catalog import invalidate_catalog
+from .database import apply_sqlite_pragmas
+from .models import Department, Formation, Notification, NotificationCounter, Structure, User, UserFormation
+from .reference import bump_reference_version, invalidate_now_and_on_commit
+from .search import forget_search_index, index_formations, unindex_formations
+from .sharding import all_shards, attach_primary, reserve_id_range, shard_databases
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        apply_sqlite_pragmas(connection)
+    if connection.alias in shard_databases():
+        attach_primary(connection)
+
+
+@receiver(post_migrate)
+def shard_migrated(sender, using, **kwargs):
+    if sender.name == 'users' and using in shard_databases():
+        reserve_id_range(connections[using], [UserFormation, Notification])
+
+
+@receiver(post_migrate)
+def search_index_migrated(sender, **kwargs):
+    # Migrations create and drop the search table: look for it again.
+    if sender.name == 'users':
+        forget_search_index()
+
+
+@receiver(pre_save, sender=Formation)
+def formation_saving(sender, instance, raw=False, **kwargs):
+    # A formation moved to another structure leaves that structure's pages stale too.
+    if not raw and not instance._state.adding:
+        previous = Formation.objects.filter(pk=instance.pk).exclude(structure_id=instance.structure_id)
+        invalidate_catalog(previous.values_list('structure_id', flat=True))
+
+
+@receiver(post_save, sender=Formation)
+def formation_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_formations([instance.pk])
+        invalidate_catalog([instance.structure_id])
+
+
+@receiver(post_delete, sender=Formation)
+def formation_deleted(sender, instance, **kwargs):
+    unindex_formations([instance.pk])
+    invalidate_catalog([instance.structure_id])
+
+
+@receiver(pre_delete, sender=User)
+@receiver(pre_delete, sender=Formation)
+def delete_sharded_rows(sender, instance, **kwargs):
+    # The deletion collector only cascades within the deleted row's own database.
+    for alias in all_shards()[1:]:
+        if sender is User:
+            UserFormation.objects.using(alias).filter(user=instance).delete()
+            Notification.objects.using(alias).filter(user=instance).delete()
+        else:
+            UserFormation.objects.using(alias).filter(formation=instance).delete()
+
+
+@receiver(post_delete, sender=Notification)
+def notification_deleted(sender, instance, **kwargs):
+    if not instance.is_read:
+        NotificationCounter.objects.adjust({instance.user_id: -1})
+
+
+@receiver([post_save, post_delete], sender=Structure)
+@receiver([post_save, post_delete], sender=Department)
+def reference_data_changed(sender, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(bump_reference_version)
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_now_and_on_commit(invalidate_cached_users, [instance.pk])
+
+
+@receiver(post_save, sender=UserFormation)
+def user_formation_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and 'state_formation' not in update_fields):
+        return
+    was_spent = not created and getattr(instance, '_loaded_state', None) == SPEND_STATE
+    is_spent = instance.state_formation == SPEND_STATE
+    if was_spent != is_spent:
+        apply_spend([instance.pk], 1 if is_spent else -1)
+    instance._loaded_state = instance.state_formation
+
+
+@receiver(pre_delete, sender=UserFormation)
+def user_formation_deleted(sender, instance, **kwargs):
+    # pre_delete: the enrollment must still be joinable to its user and formation.
+    if instance.state_formation == SPEND_STATE:
+        apply_spend([instance.pk], -1)
@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import weakref
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+from .models import Notification, NotificationCounter
+from .sharding import all_shards
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0
+POLL_BATCH_SIZE = 1000
+KEEPALIVE_INTERVAL = 15.0
+LONG_POLL_TIMEOUT = 25.0
+SSE_RETRY_MS = 3000
+BACKLOG_LIMIT = 50
+
+
+def serialize_notification(notification):
+    return {
+        'notification_id': notification['notification_id'],
+        'message': notification['message'],
+        'created_at': notification['created_at'].isoformat(),
+    }
+
+
+def _notification_rows(qs, limit):
+    return list(qs.values('notification_id', 'user_id', 'message', 'created_at')[:limit])
+
+
+def unread_counts(user_ids):
+    user_ids = list(user_ids)
+    counts = {}
+    for start in range(0, len(user_ids), POLL_BATCH_SIZE):
+        counts.update(NotificationCounter.objects.filter(
+            user_id__in=user_ids[start:start + POLL_BATCH_SIZE]
+        ).values_list('user_id', 'unread'))
+    return {user_id: counts.get(user_id, 0) for user_id in user_ids}
+
+
+def fetch_backlog(user_id, since):
+    # The newest BACKLOG_LIMIT rows, sent oldest first.
+    rows = _notification_rows(
+        Notification.objects.filter(user_id=user_id, is_read=False, notification_id__gt=since)
+        .order_by('-notification_id'),
+        BACKLOG_LIMIT,
+    )
+    rows.reverse()
+    return rows, unread_counts([user_id])[user_id]
+
+
+def fetch_new(after, using=DEFAULT_DB_ALIAS):
+    rows = _notification_rows(
+        Notification.objects.using(using).filter(notification_id__gt=after).order_by('notification_id'), POLL_BATCH_SIZE,
+    )
+    affected = {row['user_id'] for row in rows}
+    return rows, unread_counts(affected) if affected else {}
+
+
+def latest_notification_id(using=DEFAULT_DB_ALIAS):
+    return Notification.objects.using(using).aggregate(last=Max('notification_id'))['last'] or 0
+
+
+class NotificationHub:
+    """Fans new notifications out to the connections held by this process.
+
+    A single poller task reads the rows created since the last poll, whatever
+    the number of connected users, and hands each one to the queues of its
+    recipient. Idle connections only cost a queue and a suspended coroutine.
+    Each shard hands out ids from its own range, so each has its own cursor.
+    Unread counts lowered by another process (marking as read) are picked up by
+    comparing the subscribers' counters with the last count sent to them.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.last_ids = {}
+        self.unread = {}
+        self.poller = None
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.ensure_future(self.poll())
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+                self.unread.pop(user_id, None)
+
+    def publish(self, rows, unread):
+        for row in rows:
+            for queue in self.subscribers.get(row['user_id'], ()):
+                queue.put_nowait(('notification', serialize_notification(row)))
+        for user_id, count in unread.items():
+            if user_id in self.subscribers:
+                self.unread[user_id] = count
+            for queue in self.subscribers.get(user_id, ()):
+                queue.put_nowait(('unread', {'unread': count}))
+
+    async def poll(self):
+        while self.subscribers:
+            try:
+                backlog = await self.poll_once()
+            except Exception:
+                # A failed pass must not end the poller: log it, back off and retry.
+                logger.exception("Notification poll failed")
+                backlog = False
+            if not backlog:
+                await asyncio.sleep(POLL_INTERVAL)
+
+    async def poll_once(self):
+        """Publish what arrived since the last pass; return True if a shard has more waiting."""
+        backlog = False
+        for using in all_shards():
+            if using not in self.last_ids:
+                self.last_ids[using] = await sync_to_async(latest_notification_id)(using)
+            rows, unread = await sync_to_async(fetch_new)(self.last_ids[using], using)
+            if rows:
+                self.last_ids[using] = rows[-1]['notification_id']
+                self.publish(rows, unread)
+            backlog = backlog or len(rows) == POLL_BATCH_SIZE
+        unread = await sync_to_async(unread_counts)(list(self.subscribers))
+        self.publish([], {
+            user_id: count for user_id, count in unread.items()
+            if self.unread.setdefault(user_id, count) != count
+        })
+        return backlog
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = NotificationHub()
+    return hub
+
+
+def publish_unread(user_ids):
+    """Send the current unread count of ``user_ids`` to this process's connections on commit.
+
+    Connections held by other processes get it from their hub's next poll.
+    """
+    def publish():
+        hubs = [
+            (loop, hub) for loop, hub in list(_hubs.items())
+            if not loop.is_closed() and any(user_id in hub.subscribers for user_id in user_ids)
+        ]
+        if hubs:
+            unread = unread_counts(user_ids)
+            for loop, hub in hubs:
+                loop.call_soon_threadsafe(hub.publish, [], unread)
+
+    transaction.on_commit(publish)
+
+
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+async def sse_stream(user_id, since):
+    hub = get_hub()
+    queue = hub.subscribe(user_id)
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        rows, unread = await sync_to_async(fetch_backlog)(user_id, since)
+        hub.unread.setdefault(user_id, unread)
+        for row in rows:
+            yield format_event('notification', serialize_notification(row), row['notification_id'])
+        yield format_event('unread', {'unread': unread})
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(event, data, data.get('notification_id'))
+    finally:
+        hub.unsubscribe(user_id, queue)
+
+
+async def long_poll(user_id, since, timeout=LONG_POLL_TIMEOUT):
+    """Return ``(notifications, unread)`` as soon as something newer than ``since`` exists."""
+    hub = get_hub()
+    queue = hub.subscribe(user_id)
+    try:
+        rows, unread = await sync_to_async(fetch_backlog)(user_id, since)
+        hub.unread.setdefault(user_id, unread)
+        if rows:
+            return [serialize_notification(row) for row in rows], unread
+        notifications = []
+        try:
+            while True:
+                event, data = await asyncio.wait_for(queue.get(), timeout)
+                if event == 'notification':
+                    notifications.append(data)
+                else:
+                    unread = data['unread']
+                if queue.empty():
+                    return notifications, unread
+        except asyncio.TimeoutError:
+            return notifications, unread
+    finally:
+        hub.unsubscribe(user_id, queue)
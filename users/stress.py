@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import namedtuple
+from django.db import OperationalError, connection
+from .approvals import decide_user_formations
+from .enrollment import enroll
+from .models import Formation, Structure, User, UserFormation
+
+StressResult = namedtuple('StressResult', ['writers', 'operations', 'errors', 'seconds', 'p95_ms'])
+
+
+def seed_stress_data(writers, iterations):
+    structure = Structure.objects.create(structure_varchar="Stress", structure_code='STRESS', structure_niveau='1')
+    Formation.objects.bulk_create([
+        Formation(
+            formation_titre=f"Stress formation {i}", formation_ref=f"STRESS-{i}", formation_niveau='L1',
+            formation_description='Stress', formation_cout=100, formation_pays='DZ', formation_duree=1,
+            formation_category='raffinage', structure=structure,
+        )
+        for i in range(iterations)
+    ])
+    User.objects.bulk_create([
+        User(user_email=f"stress{i}@example.com", user_username=f"stress{i}", structure=structure,
+             user_role='employee', state='approved', is_active=True)
+        for i in range(writers)
+    ])
+    return (
+        list(User.objects.filter(structure=structure).order_by('pk').values_list('pk', flat=True)),
+        list(Formation.objects.filter(structure=structure).order_by('pk').values_list('pk', flat=True)),
+    )
+
+
+def _writer(user_id, formation_ids, start, errors, latencies):
+    # The participate_formation and approval write paths, back to back.
+    try:
+        start.wait()
+        for formation_id in formation_ids:
+            started = time.perf_counter()
+            try:
+                enroll([user_id], [formation_id])
+                decide_user_formations(
+                    UserFormation.objects.filter(user_id=user_id, formation_id=formation_id), 'approve',
+                )
+            except OperationalError as error:
+                errors.append(str(error))
+            latencies.append((time.perf_counter() - started) * 1000)
+    finally:
+        connection.close()
+
+
+def run_write_stress(writers=8, iterations=25):
+    """Run ``writers`` threads that enroll and approve at the same time on the default database.
+
+    Each thread uses its own connection, as concurrent requests do. Returns a StressResult
+    whose ``errors`` lists the OperationalErrors (e.g. "database is locked") raised.
+    """
+    user_ids, formation_ids = seed_stress_data(writers, iterations)
+    start = threading.Barrier(writers)
+    errors, latencies = [], []
+    threads = [
+        threading.Thread(target=_writer, args=(user_id, formation_ids, start, errors, latencies))
+        for user_id in user_ids
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return StressResult(
+        writers, len(latencies), errors, time.perf_counter() - started,
+        latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+    )
@@ -0,0 +1,98 @@
+from django.db.models import Count, Prefetch, Q
+from .models import User, UserFormation
+
+TEAM_DEPARTMENTS_PER_PAGE = 5
+
+
+def subordinates_queryset(user):
+    if user.user_role == 'manager' and user.structure_id:
+        qs = User.objects.filter(structure_id=user.structure_id)
+    elif user.user_role == 'department_chief' and user.department_id:
+        qs = User.objects.filter(department_id=user.department_id)
+    else:
+        return User.objects.none()
+    return qs.filter(state='approved').exclude(user_id=user.user_id)
+
+
+def with_enrollments(queryset):
+    return queryset.select_related('department', 'structure').prefetch_related(
+        Prefetch(
+            'user_formations',
+            queryset=UserFormation.objects.select_related('formation').only(
+                'user_formation_id', 'user_id', 'state_formation', 'valide_date',
+                'formation__formation_id', 'formation__formation_titre',
+            ).order_by('date_inscription'),
+        )
+    )
+
+
+def team_matrix(user, page=1, department_id=None, per_page=TEAM_DEPARTMENTS_PER_PAGE):
+    """Employee x formation x state for the user's team, one page of departments at a time.
+
+    The cost is four queries whatever the team size: departments, employees,
+    their enrollments (prefetched) and the per-state totals.
+    """
+    team = subordinates_queryset(user)
+    departments = list(
+        team.order_by('department__department_name', 'department_id')
+        .values('department_id', 'department__department_name')
+        .annotate(employees=Count('user_id'))
+    )
+    if department_id is not None:
+        page_departments = [d for d in departments if d['department_id'] == department_id]
+        num_pages = 1
+    else:
+        num_pages = max(1, -(-len(departments) // per_page))
+        page = min(max(page, 1), num_pages)
+        page_departments = departments[(page - 1) * per_page:page * per_page]
+
+    department_ids = [d['department_id'] for d in page_departments if d['department_id'] is not None]
+    condition = Q(department_id__in=department_ids)
+    if any(d['department_id'] is None for d in page_departments):
+        condition |= Q(department__isnull=True)
+    page_team = team.filter(condition)
+    employees = [] if not page_departments else list(
+        with_enrollments(page_team).order_by('department__department_name', 'user_username')
+    )
+
+    totals = dict(
+        # The team is within the user's structure, so its enrollments are on that structure's shard.
+        UserFormation.objects.for_structure(user.structure_id).filter(user__in=team.values('user_id'))
+        .order_by()
+        .values_list('state_formation')
+        .annotate(count=Count('user_formation_id'))
+    )
+    return {
+        'page': 1 if department_id is not None else page,
+        'num_pages': num_pages,
+        'departments': [
+            {
+                'department_id': d['department_id'],
+                'department_name': d['department__department_name'],
+                'employees': d['employees'],
+            }
+            for d in page_departments
+        ],
+        'totals': totals,
+        'employees': [
+            {
+                'user_id': employee.user_id,
+                'user_username': employee.user_username,
+                'user_email': employee.user_email,
+                'user_role': employee.user_role,
+                'department_id': employee.department_id,
+                'department_name': employee.department.department_name if employee.department else None,
+                'structure_name': employee.structure.structure_varchar if employee.structure else None,
+                'formations': [
+                    {
+                        'formation_id': uf.formation.formation_id,
+                        'formation_titre': uf.formation.formation_titre,
+                        'state_formation': uf.state_formation,
+                        'valide_date': uf.valide_date,
+                    }
+                    for uf in employee.user_formations.all()
+                ],
+            }
+            for employee in employees
+        ],
+    }
@@ -1,3 +1,1626 @@
-from django.test import TestCase
+import base64
+import asyncio
+import csv
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import closing
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import check_password
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections, models, transaction
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from .analytics import BUCKET_FIELDS, rebuild_spend_summary
+from .approvals import decide_user_formations, decide_users
+from .audit import audit_actor
+from .backends import CachedUserBackend, check_user_cache
+from .benchmark import Scenario, benchmark_actors, benchmark_scenarios, generate, run_scenario
+from .catalog import CATALOG_MAX_PAGE_SIZE, cached_catalog_page, catalog_cache_stats
+from .changelists import EstimatedCountPaginator
+from .directory import hash_passwords, read_directory
+from .metrics import QueryRecorder, record_request, registry
+from .middleware import MetricsMiddleware
+from .enrollment import ALREADY_ENROLLED, CREATED, enroll
+from .models import (
+    User, Structure, Department, Formation, UserFormation, Notification, NotificationArchive, NotificationCounter,
+    TrainingSpendSummary, OutboxEvent,
+)
+from .outbox import MAX_ATTEMPTS, RETRY_BASE_DELAY, drain, enqueue_notification, purge_done_events
+from .retention import apply_policy, compact_database, open_export
+from .routers import PRIMARY_COOKIE, primary_scope
+from .search import rebuild_search_index, search_formations
+from .sharding import SHARD_ID_BITS, shard_for_pk
+from .streaming import BACKLOG_LIMIT, fetch_new, format_event
+from .throttle import SlidingWindowThrottle, throttle_stats
 
-# Create your tests here.
+
+def make_structure(code='STR'):
+    return Structure.objects.create(structure_varchar=f"Structure {code}", structure_code=code, structure_niveau='1')
+
+
+def make_department(structure, code):
+    return Department.objects.create(department_name=f"Department {code}", department_code=code, structure=structure)
+
+
+def make_user(username, structure=None, department=None, role='employee', state='approved'):
+    return User.objects.create_user(
+        f"{username}@example.com", username, 'password',
+        structure=structure, department=department, user_role=role, state=state, is_active=state == 'approved',
+    )
+
+
+def make_formation(structure, ref, **fields):
+    values = {
+        'formation_titre': f"Formation {ref}",
+        'formation_ref': ref,
+        'formation_niveau': 'L1',
+        'formation_description': 'Description',
+        'formation_cout': 100,
+        'formation_pays': 'DZ',
+        'formation_duree': 5,
+        'formation_category': 'raffinage',
+    }
+    values.update(fields)
+    return Formation.objects.create(structure=structure, **values)
+
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def setUpModule():
+    # A cache directory of the run's own, so tests never read or clear the project's .django_cache.
+    directory = tempfile.mkdtemp()
+    caches_override = override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': directory,
+    }})
+    caches_override.enable()
+    unittest.addModuleCleanup(shutil.rmtree, directory, ignore_errors=True)
+    unittest.addModuleCleanup(caches_override.disable)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class TeamMatrixTests(TestCase):
+    def setUp(self):
+        self.structure = make_structure()
+        self.departments = [make_department(self.structure, f"D{i}") for i in range(3)]
+        self.formations = [make_formation(self.structure, f"F{i}") for i in range(4)]
+        self.manager = make_user('manager', self.structure, self.departments[0], role='manager')
+        self.client.force_login(self.manager)
+
+    def add_team(self, size):
+        states = ['pending', 'approved', 'rejected']
+        for i in range(size):
+            employee = make_user(f"employee{size}_{i}", self.structure, self.departments[i % 3])
+            for j, formation in enumerate(self.formations[:1 + i % 4]):
+                UserFormation.objects.create(user=employee, formation=formation, state_formation=states[(i + j) % 3])
+
+    def get_matrix(self, **params):
+        return self.client.get(reverse('users:team_formation_matrix'), params).json()
+
+    def test_matrix_lists_every_enrollment_with_state_totals(self):
+        self.add_team(6)
+        data = self.get_matrix()
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(len(data['employees']), 6)
+        enrollments = sum(len(employee['formations']) for employee in data['employees'])
+        self.assertEqual(enrollments, sum(data['totals'].values()))
+        self.assertEqual(enrollments, UserFormation.objects.count())
+
+    def test_matrix_pages_by_department(self):
+        self.add_team(6)
+        data = self.get_matrix(department=self.departments[1].pk)
+        self.assertEqual([d['department_id'] for d in data['departments']], [self.departments[1].pk])
+        self.assertTrue(all(e['department_id'] == self.departments[1].pk for e in data['employees']))
+
+    def test_query_count_does_not_grow_with_team_size(self):
+        self.add_team(3)
+        url = reverse('users:team_formation_matrix')
+        self.client.get(url)
+        # session + departments + employees + enrollments + totals; the user comes from the cache
+        with self.assertNumQueries(5):
+            self.client.get(url)
+        self.add_team(30)
+        with self.assertNumQueries(5):
+            self.client.get(url)
+
+    def test_index_page_query_count_does_not_grow_with_team_size(self):
+        self.add_team(3)
+        url = reverse('users:user_list')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url)
+        self.add_team(30)
+        with self.assertNumQueries(len(small.captured_queries)):
+            self.client.get(url)
+
+    def test_employees_have_no_team(self):
+        employee = make_user('alone', self.structure, self.departments[0])
+        self.client.force_login(employee)
+        response = self.client.get(reverse('users:team_formation_matrix'))
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+@mock.patch('users.streaming.POLL_INTERVAL', 0.05)
+class NotificationStreamTests(TestCase):
+    def setUp(self):
+        self.user = make_user('listener', make_structure())
+        self.async_client.force_login(self.user)
+
+    async def test_long_poll_returns_backlog_immediately(self):
+        notification = await Notification.objects.acreate(user=self.user, message="Hello")
+        response = await self.async_client.get(reverse('users:notification_poll'), {'since': 0})
+        data = response.json()
+        self.assertEqual([n['notification_id'] for n in data['notifications']], [notification.pk])
+        self.assertEqual(data['unread'], 1)
+
+    async def test_long_poll_wakes_up_on_new_notification(self):
+        async def notify_later():
+            await asyncio.sleep(0.1)
+            await sync_to_async(Notification.objects.create)(user=self.user, message="Later")
+
+        task = asyncio.ensure_future(notify_later())
+        response = await self.async_client.get(reverse('users:notification_poll'), {'since': 0, 'timeout': 5})
+        await task
+        data = response.json()
+        self.assertEqual([n['message'] for n in data['notifications']], ["Later"])
+        self.assertEqual(data['unread'], 1)
+
+    async def test_long_poll_times_out_empty(self):
+        response = await self.async_client.get(reverse('users:notification_poll'), {'since': 0, 'timeout': 0.2})
+        self.assertEqual(response.json()['notifications'], [])
+
+    async def test_event_stream_sends_backlog_then_live_events(self):
+        await Notification.objects.acreate(user=self.user, message="Backlog")
+        response = await self.async_client.get(reverse('users:notification_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        chunks = [await anext(stream) for _ in range(3)]
+        self.assertTrue(chunks[0].startswith(b'retry:'))
+        self.assertIn(b'event: notification', chunks[1])
+        self.assertIn(b'"unread": 1', chunks[2])
+        await sync_to_async(Notification.objects.create)(user=self.user, message="Live")
+        live = await asyncio.wait_for(anext(stream), 5)
+        self.assertEqual(json.loads(live.decode().split('data: ')[1])['message'], "Live")
+        await stream.aclose()
+
+    @mock.patch('users.streaming.POLL_INTERVAL', 0.05)
+    async def test_poller_survives_a_failed_pass(self):
+        failures = [DatabaseError("database is locked")]
+
+        def flaky_fetch_new(*args):
+            if failures:
+                raise failures.pop()
+            return fetch_new(*args)
+
+        response = await self.async_client.get(reverse('users:notification_stream'))
+        stream = response.streaming_content
+        for _ in range(2):
+            await anext(stream)
+        with self.assertLogs('users.streaming', 'ERROR') as logs:
+            with mock.patch('users.streaming.fetch_new', side_effect=flaky_fetch_new):
+                await sync_to_async(Notification.objects.create)(user=self.user, message="After failure")
+                chunk = await asyncio.wait_for(anext(stream), 5)
+        self.assertIn("Notification poll failed", logs.output[0])
+        self.assertFalse(failures)
+        self.assertIn(b'"After failure"', chunk)
+        await stream.aclose()
+
+    async def test_backlog_sends_the_newest_notifications_oldest_first(self):
+        created = await sync_to_async(Notification.objects.bulk_create)(
+            [Notification(user=self.user, message=f"N{i}") for i in range(BACKLOG_LIMIT + 5)]
+        )
+        response = await self.async_client.get(reverse('users:notification_poll'), {'since': 0})
+        ids = [n['notification_id'] for n in response.json()['notifications']]
+        self.assertEqual(ids, sorted(n.pk for n in created)[-BACKLOG_LIMIT:])
+
+    async def read_stream_until_unread(self, stream):
+        await sync_to_async(Notification.objects.create)(user=self.user, message="Unread")
+        for _ in range(3):
+            await anext(stream)
+
+    @mock.patch('users.streaming.NotificationHub.poll', mock.AsyncMock())
+    async def test_marking_read_publishes_the_unread_count(self):
+        # Without a poller, only the mark-read path can deliver the event.
+        response = await self.async_client.get(reverse('users:notification_stream'))
+        stream = response.streaming_content
+        await self.read_stream_until_unread(stream)
+        notification = await Notification.objects.aget(user=self.user)
+
+        def mark_read():
+            self.client.force_login(self.user)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    reverse('users:mark_notification_read'), json.dumps({'notification_id': notification.pk}),
+                    content_type='application/json',
+                )
+
+        await sync_to_async(mark_read)()
+        event = await asyncio.wait_for(anext(stream), 5)
+        self.assertEqual(event, format_event('unread', {'unread': 0}).encode())
+        await stream.aclose()
+
+    async def test_count_lowered_elsewhere_reaches_the_stream(self):
+        response = await self.async_client.get(reverse('users:notification_stream'))
+        stream = response.streaming_content
+        await self.read_stream_until_unread(stream)
+        # Another process marked it read: nothing is published here, the hub's poll notices.
+        await NotificationCounter.objects.filter(user=self.user).aupdate(unread=0)
+        event = await asyncio.wait_for(anext(stream), 5)
+        self.assertEqual(event, format_event('unread', {'unread': 0}).encode())
+        await stream.aclose()
+
+    async def test_anonymous_stream_is_refused(self):
+        await self.async_client.alogout()
+        response = await self.async_client.get(reverse('users:notification_stream'))
+        self.assertEqual(response.status_code, 401)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class NotificationCounterTests(TestCase):
+    def setUp(self):
+        self.user = make_user('reader', make_structure())
+        self.notifications = [Notification.objects.create(user=self.user, message=f"N{i}") for i in range(3)]
+        self.client.force_login(self.user)
+
+    def unread(self):
+        return NotificationCounter.objects.unread_for(self.user)
+
+    def mark_read(self, notification):
+        return self.client.post(
+            reverse('users:mark_notification_read'), json.dumps({'notification_id': notification.pk}),
+            content_type='application/json',
+        ).json()
+
+    def test_marking_one_read_counts_it_once(self):
+        self.assertEqual(self.unread(), 3)
+        self.assertEqual(self.mark_read(self.notifications[0])['unread'], 2)
+        self.assertEqual(self.mark_read(self.notifications[0])['unread'], 2)
+        other = Notification.objects.create(user=make_user('other', make_structure('O')), message="Not yours")
+        self.assertEqual(self.mark_read(other)['status'], 'error')
+        self.assertEqual(self.unread(), 2)
+
+    def test_marking_all_read(self):
+        data = self.client.post(reverse('users:mark_all_notifications_read')).json()
+        self.assertEqual(data['unread'], 0)
+        self.assertEqual(self.unread(), 0)
+        self.assertFalse(Notification.objects.filter(user=self.user, is_read=False).exists())
+
+    def test_saving_is_read_adjusts_the_counter(self):
+        notification = Notification.objects.get(pk=self.notifications[0].pk)
+        notification.is_read = True
+        notification.save()
+        notification.save()
+        self.assertEqual(self.unread(), 2)
+        notification.is_read = False
+        notification.save()
+        self.assertEqual(self.unread(), 3)
+
+    def test_counter_never_goes_negative_and_can_be_rebuilt(self):
+        NotificationCounter.objects.filter(user=self.user).update(unread=0)
+        self.mark_read(self.notifications[0])
+        self.assertEqual(self.unread(), 0)
+        call_command('rebuild_notification_counters', stdout=StringIO())
+        self.assertEqual(self.unread(), 2)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class NotificationRetentionTests(TestCase):
+    def setUp(self):
+        self.user = make_user('reader', make_structure())
+
+    def add_notification(self, days_old, is_read):
+        notification = Notification.objects.create(user=self.user, message=f"Old news {days_old}", is_read=is_read)
+        Notification.objects.filter(pk=notification.pk).update(created_at=timezone.now() - timedelta(days=days_old))
+        return notification
+
+    def test_old_notifications_are_archived_in_batches(self):
+        old_read = [self.add_notification(120, True) for _ in range(5)]
+        old_unread = self.add_notification(400, False)
+        recent = [self.add_notification(10, True), self.add_notification(200, False)]
+        out = StringIO()
+        call_command('archive_notifications', batch_size=2, skip_compact=True, stdout=out)
+        self.assertIn("6 notification(s) handled", out.getvalue())
+        self.assertEqual(set(Notification.objects.values_list('pk', flat=True)), {n.pk for n in recent})
+        archived = NotificationArchive.objects.get(pk=old_unread.pk)
+        self.assertEqual(archived.message_text, "Old news 400")
+        self.assertFalse(archived.was_read)
+        self.assertEqual(NotificationArchive.objects.filter(was_read=True).count(), len(old_read))
+        self.assertEqual(NotificationCounter.objects.unread_for(self.user), 1)
+
+    def test_dry_run_changes_nothing(self):
+        self.add_notification(120, True)
+        call_command('archive_notifications', dry_run=True, stdout=StringIO())
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertFalse(NotificationArchive.objects.exists())
+
+    def test_export_is_synced_before_the_rows_are_deleted(self):
+        old = [self.add_notification(120, True) for _ in range(3)]
+        policy = {'name': 'read', 'is_read': True, 'days': 90, 'action': 'archive'}
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        export = open_export(path)
+        self.addCleanup(export.close)
+        with mock.patch('users.retention._remove_batch', side_effect=RuntimeError("locked")):
+            with self.assertRaises(RuntimeError):
+                apply_policy(policy, batch_size=2, export=export)
+        with open(path, encoding='utf-8') as stream:
+            self.assertEqual([json.loads(line)['notification_id'] for line in stream], [n.pk for n in old[:2]])
+        self.assertEqual(Notification.objects.count(), 3)
+
+        with mock.patch('users.retention.os.fsync') as fsync:
+            self.assertEqual(apply_policy(policy, batch_size=2, export=export), 3)
+        self.assertEqual(fsync.call_count, 2)
+        with open(path, encoding='utf-8') as stream:
+            exported = [json.loads(line)['notification_id'] for line in stream]
+        # At least once: the batch whose delete failed is exported again.
+        self.assertEqual(exported, [n.pk for n in old[:2]] + [n.pk for n in old])
+        self.assertFalse(Notification.objects.exists())
+        self.assertFalse(NotificationArchive.objects.exists())
+
+
+class DatabaseCompactionTests(TransactionTestCase):
+    def test_free_pages_are_released_incrementally(self):
+        user = make_user('reader', make_structure())
+        Notification.objects.bulk_create([Notification(user=user, message='x' * 2000) for _ in range(500)])
+        Notification.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA freelist_count')
+            free = cursor.fetchone()[0]
+            self.assertGreater(free, 100)
+            self.assertEqual(compact_database(step=100), {'default': free})
+            cursor.execute('PRAGMA freelist_count')
+            self.assertEqual(cursor.fetchone()[0], 0)
+        with transaction.atomic(), self.assertRaises(RuntimeError):
+            compact_database()
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.user = make_user('recipient', make_structure())
+
+    def test_drain_delivers_and_counts_notifications(self):
+        enqueue_notification(self.user, "First")
+        enqueue_notification(self.user, "Second")
+        self.assertEqual(drain(), (2, 0))
+        self.assertEqual(sorted(Notification.objects.values_list('message', flat=True)), ["First", "Second"])
+        self.assertEqual(NotificationCounter.objects.unread_for(self.user), 2)
+        self.assertEqual(set(OutboxEvent.objects.values_list('state', flat=True)), {'done'})
+        self.assertEqual(drain(), (0, 0))
+
+    def test_failed_event_is_retried_with_backoff(self):
+        enqueue_notification(self.user, "Flaky")
+        with mock.patch.dict('users.outbox.HANDLERS', {'notification': mock.Mock(side_effect=RuntimeError("down"))}):
+            before = timezone.now()
+            with self.assertLogs('users.outbox', 'WARNING'):
+                self.assertEqual(drain(), (0, 1))
+            event = OutboxEvent.objects.get()
+            self.assertEqual((event.state, event.attempts), ('pending', 1))
+            self.assertEqual(event.last_error, "RuntimeError: down")
+            self.assertGreaterEqual(event.available_at, before + RETRY_BASE_DELAY)
+            self.assertEqual(drain(), (0, 0))
+        OutboxEvent.objects.update(available_at=timezone.now())
+        self.assertEqual(drain(), (1, 0))
+        self.assertEqual(OutboxEvent.objects.get().state, 'done')
+        self.assertFalse(Notification.objects.exclude(message="Flaky").exists())
+
+    def test_event_fails_for_good_after_max_attempts(self):
+        OutboxEvent.objects.create(event_type='unknown', payload={}, attempts=MAX_ATTEMPTS - 1)
+        with self.assertLogs('users.outbox', 'WARNING'):
+            self.assertEqual(drain(), (0, 1))
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.state, event.attempts), ('failed', MAX_ATTEMPTS))
+        self.assertIsNotNone(event.processed_at)
+        OutboxEvent.objects.update(available_at=timezone.now())
+        self.assertEqual(drain(), (0, 0))
+
+    def test_bad_event_in_a_batch_only_fails_itself(self):
+        enqueue_notification(self.user, "Good")
+        bad = OutboxEvent.objects.create(event_type='notification', payload={'notifications': [[self.user.pk]]})
+        enqueue_notification(self.user, "Also good")
+        with self.assertLogs('users.outbox', 'WARNING') as logs:
+            self.assertEqual(drain(), (2, 1))
+        self.assertIn("retrying one by one", logs.output[0])
+        self.assertEqual(sorted(Notification.objects.values_list('message', flat=True)), ["Also good", "Good"])
+        self.assertEqual(NotificationCounter.objects.unread_for(self.user), 2)
+        bad.refresh_from_db()
+        self.assertEqual(bad.state, 'pending')
+        self.assertIn("ValueError", bad.last_error)
+
+    def test_old_delivered_events_are_purged(self):
+        for _ in range(3):
+            enqueue_notification(self.user, "Old")
+        drain()
+        OutboxEvent.objects.update(processed_at=timezone.now() - timedelta(days=30))
+        enqueue_notification(self.user, "Recent")
+        drain()
+        failed = OutboxEvent.objects.create(
+            event_type='unknown', payload={}, state='failed', processed_at=timezone.now() - timedelta(days=30),
+        )
+        self.assertEqual(purge_done_events(days=7, batch_size=2), 3)
+        self.assertEqual(OutboxEvent.objects.filter(state='done').count(), 1)
+        self.assertTrue(OutboxEvent.objects.filter(pk=failed.pk).exists())
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class EnrollmentTests(TestCase):
+    def setUp(self):
+        self.structure = make_structure()
+        self.department = make_department(self.structure, 'D0')
+        self.formations = [make_formation(self.structure, f"F{i}") for i in range(3)]
+        self.manager = make_user('manager', self.structure, self.department, role='manager')
+
+    def post(self, name, payload):
+        return self.client.post(reverse(name), json.dumps(payload), content_type='application/json').json()
+
+    def test_enrolling_twice_keeps_one_enrollment(self):
+        employee = make_user('employee', self.structure, self.department)
+        self.client.force_login(employee)
+        payload = {'formation_id': self.formations[0].pk}
+        self.assertEqual(self.post('users:participate_formation', payload)['status'], 'success')
+        second = self.post('users:participate_formation', payload)
+        self.assertEqual(second['message'], 'You are already registered for this formation.')
+        self.assertEqual(UserFormation.objects.filter(user=employee).count(), 1)
+        self.assertEqual(UserFormation.objects.get(user=employee).state_formation, 'pending')
+
+    def test_batch_enroll_reports_each_formation(self):
+        employee = make_user('employee', self.structure, self.department)
+        UserFormation.objects.create(user=employee, formation=self.formations[0], state_formation='approved')
+        self.client.force_login(employee)
+        data = self.post('users:enroll_batch', {'formation_ids': [self.formations[0].pk, self.formations[1].pk, 0]})
+        self.assertEqual(
+            [result['result'] for result in data['results']], ['already_enrolled', 'created', 'not_found'],
+        )
+        self.assertEqual(UserFormation.objects.filter(user=employee).count(), 2)
+
+    def test_manager_enrolls_only_their_team(self):
+        team = [make_user(f"member{i}", self.structure, self.department) for i in range(3)]
+        outsider = make_user('outsider', make_structure('OUT'))
+        self.client.force_login(self.manager)
+        data = self.post('users:enroll_batch', {
+            'formation_id': self.formations[2].pk, 'user_ids': [u.pk for u in team] + [outsider.pk],
+        })
+        results = {result['user_id']: result['result'] for result in data['results']}
+        self.assertEqual(results, {**{u.pk: 'created' for u in team}, outsider.pk: 'forbidden'})
+        self.assertEqual(UserFormation.objects.filter(formation=self.formations[2]).count(), 3)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class SchemaMigrationTests(TransactionTestCase):
+    def migrate(self, *target):
+        call_command('migrate', 'users', *target, verbosity=0)
+
+    def test_duplicate_enrollments_are_removed_before_the_unique_constraint(self):
+        structure = make_structure()
+        formations = [make_formation(structure, f"F{i}") for i in range(2)]
+        employee = make_user('employee', structure)
+        self.addCleanup(self.migrate)
+        self.migrate('0001')
+        with connection.cursor() as cursor:
+            for state in ('pending', 'approved', 'pending'):
+                cursor.execute(
+                    "INSERT INTO users_userformation (date_inscription, state_formation, user_id, formation_id) "
+                    "VALUES (%s, %s, %s, %s)", [timezone.now(), state, employee.pk, formations[0].pk],
+                )
+        self.migrate()
+
+        self.assertEqual(
+            list(UserFormation.objects.values_list('state_formation', flat=True)), ['approved'],
+        )
+        self.assertEqual(enroll([employee.pk], [f.pk for f in formations]), {
+            (employee.pk, formations[0].pk): ALREADY_ENROLLED, (employee.pk, formations[1].pk): CREATED,
+        })
+
+
+    def test_duplicate_formation_refs_are_renamed_before_the_unique_constraint(self):
+        structure = make_structure()
+        self.addCleanup(self.migrate)
+        self.migrate('0001')
+        first, second = make_formation(structure, 'REF'), make_formation(structure, 'REF')
+        self.migrate()
+
+        self.assertEqual(
+            list(Formation.objects.order_by('pk').values_list('formation_ref', flat=True)),
+            ['REF', f"REF-{second.pk}"],
+        )
+        self.assertEqual(first.pk, Formation.objects.get(formation_ref='REF').pk)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class AuditTests(TestCase):
+    def setUp(self):
+        self.admin = make_user('auditor', role='admin')
+
+    def test_set_based_writes_are_stamped(self):
+        with audit_actor(self.admin):
+            structures = Structure.objects.bulk_create(
+                [Structure(structure_varchar=f"S{i}", structure_code=f"S{i}", structure_niveau='1') for i in range(3)]
+            )
+        self.assertEqual({s.structure_cree_par for s in Structure.objects.all()}, {'auditor'})
+        before = Structure.objects.get(structure_code='S0').structure_miseajour_date
+        editor = make_user('editor', role='admin')
+        with audit_actor(editor):
+            Structure.objects.filter(structure_code__in=['S0', 'S1']).update(structure_niveau='2')
+            structures[2].structure_niveau = '3'
+            Structure.objects.bulk_update([structures[2]], ['structure_niveau'])
+        stamped = dict(Structure.objects.values_list('structure_code', 'structure_miseajour_par'))
+        self.assertEqual(stamped, {'S0': 'editor', 'S1': 'editor', 'S2': 'editor'})
+        self.assertGreater(Structure.objects.get(structure_code='S0').structure_miseajour_date, before)
+
+    def test_writes_without_actor_leave_audit_fields_alone(self):
+        structure = make_structure()
+        Structure.objects.filter(pk=structure.pk).update(structure_niveau='2')
+        structure.refresh_from_db()
+        self.assertIsNone(structure.structure_cree_par)
+        self.assertIsNone(structure.structure_miseajour_par)
+
+    def test_approval_engine_records_the_deciding_user(self):
+        structure = make_structure()
+        pending = [make_user(f"pending{i}", structure, state='pending') for i in range(3)]
+        decide_users(User.objects.filter(pk__in=[u.pk for u in pending]), 'approve', actor=self.admin)
+        self.assertEqual(
+            set(User.objects.filter(pk__in=[u.pk for u in pending]).values_list('user_miseajour_par', flat=True)),
+            {'auditor'},
+        )
+
+    def test_request_user_is_the_actor(self):
+        structure = make_structure()
+        formation = make_formation(structure, 'F0')
+        employee = make_user('employee', structure)
+        self.client.force_login(employee)
+        self.client.post(
+            reverse('users:participate_formation'), json.dumps({'formation_id': formation.pk}),
+            content_type='application/json',
+        )
+        self.assertEqual(UserFormation.objects.get(user=employee).valide_par, 'employee')
+
+
+class ReferenceDataTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.structure = make_structure()
+        self.departments = [make_department(self.structure, f"D{i}") for i in range(3)]
+        make_department(make_structure('OTHER'), 'X0')
+
+    def test_login_page_is_served_from_cache(self):
+        self.client.get(reverse('login'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('login'))
+        self.assertContains(response, self.structure.structure_varchar)
+        self.assertNotContains(response, self.departments[0].department_name)
+
+    def test_departments_endpoint_lists_one_structure(self):
+        url = reverse('users:structure_departments', args=[self.structure.pk])
+        data = self.client.get(url).json()
+        self.assertEqual([d['department_id'] for d in data['departments']], [d.pk for d in self.departments])
+
+    def test_saving_reference_data_invalidates_the_cache(self):
+        url = reverse('users:structure_departments', args=[self.structure.pk])
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.departments[0].department_name = 'Renamed'
+            self.departments[0].save()
+        names = [d['department_name'] for d in self.client.get(url).json()['departments']]
+        self.assertIn('Renamed', names)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.departments[1].delete()
+        self.assertEqual(len(self.client.get(url).json()['departments']), 2)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.structure = make_structure()
+        self.other = make_structure('OTHER')
+        self.formation = make_formation(self.structure, 'F0')
+        make_formation(self.other, 'X0')
+
+    def test_catalog_is_served_from_cache_until_a_formation_changes(self):
+        cached_catalog_page()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(cached_catalog_page()['results']), 2)
+        self.assertEqual(catalog_cache_stats(), {'hit': 1, 'miss': 1})
+
+        make_formation(self.structure, 'F1')
+        self.assertEqual(len(cached_catalog_page()['results']), 3)
+        self.formation.delete()
+        self.assertEqual(len(cached_catalog_page()['results']), 2)
+
+    def test_edits_leave_other_structures_pages_cached(self):
+        filters = {'structure': self.structure.pk}
+        cached_catalog_page(filters)
+        make_formation(self.other, 'X1')
+        with self.assertNumQueries(0):
+            cached_catalog_page(filters)
+
+        self.formation.structure = self.other
+        self.formation.save()
+        self.assertEqual(cached_catalog_page(filters)['results'], [])
+
+    def test_formation_card_fragment_is_keyed_on_the_update_time(self):
+        row = cached_catalog_page()['results'][0]
+        self.assertIn(row['formation_titre'], render_to_string('users/formation_card.html', {'formation': row}))
+        self.assertIn(row['formation_titre'], render_to_string(
+            'users/formation_card.html', {'formation': {**row, 'formation_titre': 'Stale'}},
+        ))
+        self.formation.formation_titre = 'Renamed'
+        self.formation.save()
+        row = cached_catalog_page()['results'][0]
+        self.assertIn('Renamed', render_to_string('users/formation_card.html', {'formation': row}))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class CatalogApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.structure = make_structure()
+        self.other = make_structure('OTHER')
+        self.formations = [make_formation(self.structure, f"F{i}", formation_niveau='L2' if i % 2 else 'L1') for i in range(7)]
+        make_formation(self.other, 'X0')
+        self.client.force_login(make_user('reader', self.structure))
+
+    def get(self, **params):
+        return self.client.get(reverse('users:formation_catalog'), params)
+
+    def walk(self, **params):
+        pages, cursor = [], None
+        while True:
+            data = self.get(**params, **({'cursor': cursor} if cursor is not None else {})).json()
+            pages.append([row['formation_id'] for row in data['results']])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return pages
+
+    def test_cursor_is_the_last_id_of_the_page(self):
+        data = self.get(limit=3).json()
+        ids = [row['formation_id'] for row in data['results']]
+        self.assertEqual(ids, [f.pk for f in self.formations[:3]])
+        self.assertEqual(data['next_cursor'], ids[-1])
+        following = self.get(limit=3, cursor=data['next_cursor']).json()
+        self.assertEqual(following['results'][0]['formation_id'], self.formations[3].pk)
+
+    def test_pages_cover_every_row_once(self):
+        expected = [f.pk for f in self.formations]
+        pages = self.walk(limit=3, structure=self.structure.pk)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+        # A last page that is exactly full still says there is nothing after it.
+        self.assertEqual([len(page) for page in self.walk(limit=8)], [8])
+        self.assertEqual([len(page) for page in self.walk(limit=4, formation_niveau='L1', structure=self.structure.pk)], [4])
+
+    def test_cursor_past_the_end_returns_an_empty_page(self):
+        data = self.get(cursor=Formation.objects.order_by('-pk').first().pk).json()
+        self.assertEqual((data['results'], data['next_cursor']), ([], None))
+
+    def test_invalid_parameters_are_refused(self):
+        for params in ({'cursor': 'abc'}, {'cursor': '1.5'}, {'limit': '0'}, {'limit': 'x'}, {'structure': 'S'}):
+            response = self.get(**params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertEqual(response.json()['status'], 'error')
+
+    def test_page_size_is_capped(self):
+        for i in range(CATALOG_MAX_PAGE_SIZE):
+            make_formation(self.other, f"Y{i}")
+        data = self.get(limit=CATALOG_MAX_PAGE_SIZE + 50).json()
+        self.assertEqual(len(data['results']), CATALOG_MAX_PAGE_SIZE)
+        self.assertIsNotNone(data['next_cursor'])
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class CachedUserBackendTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.structure = make_structure()
+        self.user = make_user('cached', self.structure, make_department(self.structure, 'D0'))
+        self.backend = CachedUserBackend()
+
+    def test_user_is_loaded_once_with_structure_and_department(self):
+        with self.assertNumQueries(1):
+            self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(user.structure.structure_varchar, self.structure.structure_varchar)
+            self.assertEqual(user.department.department_code, 'D0')
+
+    def test_saving_the_user_refreshes_the_snapshot(self):
+        self.backend.get_user(self.user.pk)
+        self.user.user_firstname = 'Changed'
+        self.user.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).user_firstname, 'Changed')
+
+    def test_refused_users_are_logged_out(self):
+        pending = make_user('waiting', self.structure, state='pending')
+        pending.is_active = True
+        pending.save()
+        self.assertIsNotNone(self.backend.get_user(pending.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            decide_users(User.objects.filter(pk=pending.pk), 'refuse')
+        self.assertIsNone(self.backend.get_user(pending.pk))
+
+    def test_a_per_process_cache_is_refused(self):
+        check_user_cache()
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaises(ImproperlyConfigured):
+                check_user_cache()
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS, LOGIN_THROTTLE_RATES={'ip': (6, 60), 'email': (3, 300)})
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.user = make_user('member', make_structure())
+
+    def attempt(self, email, password='wrong'):
+        return self.client.post(reverse('login'), {'email': email, 'password': password})
+
+    def test_repeated_failures_are_refused_before_hashing(self):
+        for _ in range(3):
+            self.assertEqual(self.attempt(self.user.user_email).status_code, 200)
+        with mock.patch('users.views.authenticate') as authenticate:
+            response = self.attempt(self.user.user_email, 'password')
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(authenticate.called)
+        self.assertEqual(throttle_stats(), {'allowed': 3, 'blocked': 1})
+
+    def test_ip_limit_covers_many_emails(self):
+        for i in range(6):
+            self.attempt(f"guess{i}@example.com")
+        self.assertEqual(self.attempt('other@example.com').status_code, 429)
+
+    def test_successful_login_clears_the_email_window(self):
+        self.attempt(self.user.user_email)
+        self.attempt(self.user.user_email)
+        self.assertEqual(self.attempt(self.user.user_email, 'password').status_code, 302)
+        self.assertEqual(self.attempt(self.user.user_email).status_code, 200)
+
+    def test_window_slides(self):
+        throttle = SlidingWindowThrottle('test', 10, 60)
+        for _ in range(10):
+            throttle.hit('key', now=600)
+        self.assertFalse(throttle.allows('key', now=630))
+        self.assertEqual(throttle.count('key', now=675), 7.5)
+        self.assertTrue(throttle.allows('key', now=700))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class TrainingSpendTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.structures = [make_structure('S0'), make_structure('S1')]
+        self.formations = [
+            make_formation(self.structures[0], 'F0', formation_cout=100, formation_category='raffinage'),
+            make_formation(self.structures[0], 'F1', formation_cout=250, formation_category='genie_du_gaz'),
+        ]
+        self.employees = [
+            make_user(f"employee{i}", self.structures[i % 2], make_department(self.structures[i % 2], f"D{i}"))
+            for i in range(4)
+        ]
+        for employee in self.employees:
+            for formation in self.formations:
+                UserFormation.objects.create(user=employee, formation=formation, state_formation='pending')
+
+    def summary(self):
+        return sorted(TrainingSpendSummary.objects.values_list(*BUCKET_FIELDS, 'enrollments', 'total_cost'))
+
+    def assert_summary_matches_rebuild(self):
+        incremental = [row for row in self.summary() if row[-2]]
+        rebuild_spend_summary()
+        self.assertEqual(incremental, self.summary())
+
+    def test_approvals_and_state_changes_keep_the_summary_exact(self):
+        decide_user_formations(UserFormation.objects.filter(formation=self.formations[0]), 'approve')
+        self.assertEqual(sum(row[-1] for row in self.summary()), 400)
+        enrollment = UserFormation.objects.filter(formation=self.formations[1]).first()
+        enrollment.state_formation = 'approved'
+        enrollment.save()
+        approved = UserFormation.objects.filter(formation=self.formations[0]).first()
+        approved.state_formation = 'rejected'
+        approved.save()
+        self.assert_summary_matches_rebuild()
+        UserFormation.objects.filter(pk=enrollment.pk).delete()
+        self.employees[1].delete()
+        self.assert_summary_matches_rebuild()
+        self.assertEqual(sum(row[-1] for row in self.summary()), 200)
+
+    def test_removal_uses_the_bucket_the_enrollment_was_counted_in(self):
+        decide_user_formations(UserFormation.objects.filter(formation=self.formations[0]), 'approve')
+        employee = self.employees[0]
+        [counted] = [row for row in self.summary() if row[:2] == (employee.structure_id, employee.department_id)]
+        self.assertEqual(counted[-2:], (1, 100))
+        Formation.objects.filter(pk=self.formations[0].pk).update(formation_cout=999, formation_pays='FR')
+        employee.structure, employee.department = self.structures[1], None
+        employee.save()
+        enrollment = UserFormation.objects.get(user=employee, formation=self.formations[0])
+        enrollment.state_formation = 'rejected'
+        enrollment.save()
+
+        self.assertIn(counted[:5] + (0, 0), self.summary())
+        self.assertTrue(all(row[-2] >= 0 and row[-1] >= 0 for row in self.summary()))
+        self.assertEqual(sum(row[-1] for row in self.summary()), 300)
+        # A rebuild recounts at today's prices.
+        rebuild_spend_summary()
+        self.assertEqual(sum(row[-1] for row in self.summary()), 3 * 999)
+
+    def test_drh_dashboard_reads_only_their_structure(self):
+        decide_user_formations(UserFormation.objects.all(), 'approve')
+        drh = make_user('drh', self.structures[0], role='DRH')
+        User.objects.filter(pk=drh.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(User.objects.get(pk=drh.pk))
+        response = self.client.get(reverse('admin:users_trainingspendsummary_changelist'))
+        self.assertEqual(response.status_code, 200)
+        dashboard = response.context['dashboard']
+        self.assertEqual(dashboard['enrollments'], 4)
+        self.assertEqual(dashboard['total_cost'], 700)
+        self.assertEqual([row['key'] for row in dashboard['by_structure']], [self.structures[0].pk])
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.structures = [make_structure('S0'), make_structure('S1')]
+        for i, structure in enumerate(self.structures):
+            formation = make_formation(structure, f"F{i}")
+            for j in range(3):
+                employee = make_user(f"employee{i}_{j}", structure)
+                UserFormation.objects.create(user=employee, formation=formation, state_formation='pending')
+
+    def login_admin(self, role='admin', structure=None):
+        user = make_user(f"{role.lower()}_exporter", structure, role=role)
+        User.objects.filter(pk=user.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(user)
+
+    def export(self, model_name, fmt='csv'):
+        response = self.client.get(reverse(f'admin:users_{model_name}_export', args=[fmt]))
+        return response, list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+
+    def test_enrollment_export_streams_every_row(self):
+        self.login_admin()
+        response, rows = self.export('userformation')
+        self.assertTrue(response.streaming)
+        self.assertEqual(rows[0][:3], ['ID', 'Username', 'Email'])
+        self.assertEqual(len(rows) - 1, UserFormation.objects.count())
+
+    def test_drh_export_is_scoped_to_their_structure(self):
+        self.login_admin('DRH', self.structures[0])
+        _, rows = self.export('pendinguserformations')
+        self.assertEqual(len(rows) - 1, 3)
+        self.assertEqual({row[8] for row in rows[1:]}, {'Formation F0'})
+        _, rows = self.export('user')
+        self.assertTrue(all(row[8] == self.structures[0].structure_varchar for row in rows[1:]))
+
+    def test_export_action_exports_the_selection(self):
+        self.login_admin()
+        selected = list(UserFormation.objects.values_list('pk', flat=True)[:2])
+        response = self.client.post(reverse('admin:users_userformation_changelist'), {
+            'action': 'export_csv', '_selected_action': selected,
+        })
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertEqual([int(row[0]) for row in rows[1:]], sorted(selected))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class FormationImportTests(TestCase):
+    HEADER = 'structure_code,formation_ref,formation_titre,formation_niveau,formation_description,' \
+             'formation_cout,formation_pays,formation_duree,formation_category\n'
+
+    def setUp(self):
+        self.structure = make_structure('S0')
+        self.existing = make_formation(self.structure, 'REF-1')
+
+    def write_csv(self, lines):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w', encoding='utf-8') as stream:
+            stream.write(self.HEADER + ''.join(line + '\n' for line in lines))
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_upserts_and_reports_rejections(self):
+        path = self.write_csv([
+            'S0,REF-1,Updated title,L2,Text,300,FR,3,raffinage',
+            'S0,REF-2,Pipeline integrity,L1,Text,100,DZ,2,genie_du_gaz',
+            'S0,REF-3,Old title,L1,Text,100,DZ,2,raffinage',
+            'S0,REF-3,Well control,L1,Text,150,DZ,2,raffinage',
+            'XX,REF-4,Unknown structure,L1,Text,100,DZ,2,raffinage',
+            'S0,REF-5,Bad cost,L1,Text,cheap,DZ,2,raffinage',
+        ])
+        out, err = StringIO(), StringIO()
+        call_command('import_formations', path, batch_size=2, stdout=out, stderr=err)
+        self.assertIn("2 inserted, 1 updated, 3 rejected", out.getvalue())
+        self.assertIn("unknown structure_code 'XX'", err.getvalue())
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.formation_titre, self.existing.formation_cout), ('Updated title', 300))
+        self.assertEqual(Formation.objects.get(formation_ref='REF-3').formation_titre, 'Well control')
+        self.assertEqual(Formation.objects.count(), 3)
+        self.assertEqual(
+            [r['formation_ref'] for r in search_formations('pipeline')['results']], ['REF-2'],
+        )
+
+    def test_dry_run_writes_nothing(self):
+        path = self.write_csv(['S0,REF-9,New,L1,Text,100,DZ,2,raffinage'])
+        out = StringIO()
+        call_command('import_formations', path, dry_run=True, stdout=out, stderr=StringIO())
+        self.assertIn("1 inserted, 0 updated, 0 rejected", out.getvalue())
+        self.assertFalse(Formation.objects.filter(formation_ref='REF-9').exists())
+
+    def test_drh_upload_is_limited_to_their_structure(self):
+        make_structure('S1')
+        drh = make_user('drh', self.structure, role='DRH')
+        User.objects.filter(pk=drh.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(User.objects.get(pk=drh.pk))
+        upload = SimpleUploadedFile('catalog.csv', (self.HEADER + (
+            'S0,REF-7,Mine,L1,Text,100,DZ,2,raffinage\n'
+            'S1,REF-8,Not mine,L1,Text,100,DZ,2,raffinage\n'
+        )).encode('utf-8'))
+        self.client.post(reverse('admin:users_formation_import'), {'file': upload})
+        self.assertEqual(
+            list(Formation.objects.filter(formation_ref__in=['REF-7', 'REF-8']).values_list('formation_ref', flat=True)),
+            ['REF-7'],
+        )
+
+
+    def test_json_rows_must_be_objects(self):
+        admin = make_user('admin', self.structure, role='admin')
+        User.objects.filter(pk=admin.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(User.objects.get(pk=admin.pk))
+        upload = SimpleUploadedFile('catalog.json', b'[1, 2]')
+        response = self.client.post(reverse('admin:users_formation_import'), {'file': upload}, follow=True)
+        self.assertContains(response, 'Could not read the file: row 1 is not a JSON object')
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.structure = make_structure()
+        self.title_hit = make_formation(self.structure, 'F0', formation_titre='Corrosion control')
+        self.body_hit = make_formation(
+            self.structure, 'F1', formation_description='Corrosion of pipes, corrosion of tanks',
+            formation_pays='FR',
+        )
+        make_formation(self.structure, 'F2', formation_titre='Well control')
+
+    def refs(self, query, **filters):
+        return [row['formation_ref'] for row in search_formations(query, filters)['results']]
+
+    def test_title_hits_rank_first(self):
+        self.assertEqual(self.refs('corro'), ['F0', 'F1'])
+        self.assertEqual(self.refs('corrosion', formation_pays='FR'), ['F1'])
+
+    def test_facets_count_every_hit(self):
+        result = search_formations('corrosion')
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['facets']['formation_pays'], [{'value': 'DZ', 'count': 1}, {'value': 'FR', 'count': 1}])
+        self.assertEqual(result['facets']['formation_niveau'], [{'value': 'L1', 'count': 2}])
+
+    def test_index_follows_save_and_delete(self):
+        self.title_hit.formation_titre = 'Drilling basics'
+        self.title_hit.save()
+        self.assertEqual(self.refs('corrosion'), ['F1'])
+        self.assertEqual(self.refs('drilling'), ['F0'])
+        self.title_hit.delete()
+        self.assertEqual(self.refs('drilling'), [])
+
+    def test_substring_fallback_without_fts5(self):
+        with mock.patch('users.search.fts_available', return_value=False):
+            result = search_formations('corrosion', {'formation_pays': 'FR'})
+        self.assertEqual([row['formation_ref'] for row in result['results']], ['F1'])
+        self.assertEqual(result['facets']['formation_pays'], [{'value': 'FR', 'count': 1}])
+
+    def test_search_of_a_large_catalog(self):
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO users_formation (formation_titre, formation_ref, formation_niveau, formation_description, "
+                "formation_cout, formation_mise_a_jour_date, formation_pays, formation_duree, formation_category, "
+                "structure_id) VALUES (%s, %s, 'L1', %s, 100, %s, 'DZ', 1, 'raffinage', %s)",
+                [
+                    (f"Formation {i}", f"BULK-{i}", f"Pipeline maintenance module{i % 100:02d}", now, self.structure.pk)
+                    for i in range(100_000)
+                ],
+            )
+        rebuild_search_index()
+        self.title_hit.formation_titre = 'Pipeline corrosion'
+        self.title_hit.save()
+
+        # Every hit is ranked: the oldest formation, with the title hit, still comes first.
+        result = search_formations('pipeline')
+        self.assertEqual((result['total'], result['results'][0]['formation_ref']), (100_001, 'F0'))
+        self.assertEqual(result['facets']['formation_category'], [{'value': 'raffinage', 'count': 100_001}])
+
+        # The target: under 50 ms on a 100k-formation catalog for a query with a thousand hits.
+        timings = []
+        for _ in range(3):
+            started = time.perf_counter()
+            result = search_formations('module07')
+            timings.append(time.perf_counter() - started)
+        self.assertEqual(result['total'], 1000)
+        self.assertLess(min(timings), 0.05)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class LargeTableAdminTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.structure = make_structure('S0')
+        self.department = make_department(self.structure, 'D0')
+        self.formations = [make_formation(self.structure, f"F{i}") for i in range(5)]
+        admin_user = make_user('admin', self.structure, self.department, role='admin')
+        User.objects.filter(pk=admin_user.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(admin_user)
+
+    def enroll(self, count):
+        start = User.objects.count()
+        for i in range(start, start + count):
+            user = make_user(f"employee{i}", self.structure, self.department)
+            UserFormation.objects.create(user=user, formation=self.formations[i % 5], state_formation='pending')
+
+    def changelist_queries(self, name, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(f'admin:users_{name}_changelist'), params)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.enroll(3)
+        for name in ('userformation', 'pendinguserformations', 'user'):
+            self.changelist_queries(name)
+            baseline = self.changelist_queries(name)
+            self.enroll(20)
+            self.assertEqual(self.changelist_queries(name), baseline, name)
+
+    def test_department_filter_needs_a_structure(self):
+        response = self.client.get(reverse('admin:users_user_changelist'))
+        option = 'data-name="department" value="%s"' % self.department.pk
+        self.assertNotContains(response, option)
+        response = self.client.get(reverse('admin:users_user_changelist'), {'structure': self.structure.pk})
+        self.assertContains(response, option)
+
+    def test_count_is_capped_and_deep_pages_use_primary_keys(self):
+        self.enroll(12)
+        qs = UserFormation.objects.order_by('date_inscription', 'pk')
+        expected = list(qs.values_list('pk', flat=True))
+        with mock.patch('users.changelists.COUNT_CAP', 5), mock.patch('users.changelists.DEFERRED_JOIN_OFFSET', 4):
+            paginator = EstimatedCountPaginator(qs, 4)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertGreaterEqual(paginator.count, 12)
+            self.assertIn('LIMIT 6', queries[0]['sql'])
+            self.assertEqual([obj.pk for obj in paginator.page(2)], expected[4:8])
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual([obj.pk for obj in paginator.page(3)], expected[8:12])
+            # Page 3 seeks past the last row of page 2 instead of skipping 8 rows.
+            self.assertNotIn('OFFSET', queries[0]['sql'])
+            descending = EstimatedCountPaginator(qs.order_by('-date_inscription', '-pk'), 4)
+            self.assertEqual([obj.pk for obj in descending.page(2)], expected[::-1][4:8])
+            self.assertEqual([obj.pk for obj in descending.page(3)], expected[::-1][8:12])
+
+    def test_invalid_filter_values_are_rejected(self):
+        response = self.client.get(reverse('admin:users_user_changelist'), {'structure': 'abc'})
+        self.assertRedirects(response, reverse('admin:users_user_changelist') + '?e=1', fetch_redirect_response=False)
+
+    def test_state_filter_offers_every_state(self):
+        response = self.client.get(reverse('admin:users_userformation_changelist'), {'state_formation': 'cancelled'})
+        self.assertContains(response, 'data-name="state_formation" value="validated"')
+        self.assertContains(response, 'data-name="state_formation" value="cancelled" selected')
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ReviewQueueTests(TestCase):
+    def setUp(self):
+        self.structures = [make_structure('S0'), make_structure('S1')]
+        self.formations = [make_formation(structure, f"F{i}") for i, structure in enumerate(self.structures)]
+        self.enrollments = [
+            UserFormation.objects.create(
+                user=make_user(f"employee{i}", self.structures[i % 2]),
+                formation=self.formations[i % 2],
+                state_formation='pending',
+            )
+            for i in range(6)
+        ]
+        drh = make_user('drh', self.structures[0], role='DRH')
+        User.objects.filter(pk=drh.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(drh)
+
+    def test_items_are_scoped_and_joined(self):
+        url = reverse('admin:users_pendinguserformations_review_items')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            items = self.client.get(url).json()['items']
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([item['id'] for item in items], [e.pk for e in self.enrollments[::2]])
+        self.assertEqual(items[0]['formation'], 'Formation F0')
+        after = self.client.get(url, {'after': items[0]['id']}).json()['items']
+        self.assertEqual(len(after), 2)
+
+    def test_commit_applies_every_decision_in_one_post(self):
+        approve, refuse, decided = self.enrollments[0], self.enrollments[2], self.enrollments[4]
+        UserFormation.objects.filter(pk=decided.pk).update(state_formation='approved')
+        response = self.client.post(
+            reverse('admin:users_pendinguserformations_review_commit'),
+            json.dumps({'decisions': {
+                approve.pk: 'approve', refuse.pk: 'refuse', decided.pk: 'refuse', self.enrollments[1].pk: 'approve',
+            }}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['results'], {
+            str(approve.pk): 'approved',
+            str(refuse.pk): 'rejected',
+            str(decided.pk): 'skipped',
+            str(self.enrollments[1].pk): 'skipped',
+        })
+        self.assertEqual(UserFormation.objects.get(pk=approve.pk).valide_par, 'drh')
+        self.assertEqual(UserFormation.objects.get(pk=self.enrollments[1].pk).state_formation, 'pending')
+
+    def test_commit_rejects_unknown_decisions(self):
+        response = self.client.post(
+            reverse('admin:users_accountsdemanded_review_commit'),
+            json.dumps({'decisions': {self.enrollments[0].user_id: 'delete'}}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_review_page_renders(self):
+        response = self.client.get(reverse('admin:users_accountsdemanded_changelist'))
+        self.assertContains(response, reverse('admin:users_accountsdemanded_review'))
+        response = self.client.get(reverse('admin:users_accountsdemanded_review'))
+        self.assertContains(response, reverse('admin:users_accountsdemanded_review_commit'))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ApprovalNotificationTests(TestCase):
+    def setUp(self):
+        self.structure = make_structure()
+        self.formation = make_formation(self.structure, 'F0')
+        self.admin = make_user('admin', self.structure, role='admin')
+        User.objects.filter(pk=self.admin.pk).update(is_staff=True, is_superuser=True)
+
+    def queued(self):
+        return sorted(
+            (user_id, message)
+            for event in OutboxEvent.objects.filter(state='pending')
+            for user_id, message in event.payload['notifications']
+        )
+
+    def enrollment(self, username, state='pending'):
+        return UserFormation.objects.create(
+            user=make_user(username, self.structure), formation=self.formation, state_formation=state,
+        )
+
+    def test_user_decisions_queue_one_message_per_decided_user(self):
+        accepted = [make_user(f"new{i}", self.structure, state='pending') for i in range(2)]
+        drh = make_user('drh', self.structure, role='DRH', state='pending')
+        refused = make_user('refused', self.structure, state='pending')
+        already = make_user('already', self.structure)
+
+        result = decide_users(User.objects.filter(pk__in=[u.pk for u in accepted + [drh, already]]), 'approve')
+        self.assertEqual((result.selected, result.pending, result.updated, result.notified), (4, 3, 3, 3))
+        decide_users(User.objects.filter(pk=refused.pk), 'refuse')
+
+        welcome = "Your account has been validated. Welcome to TMS!"
+        self.assertEqual(self.queued(), sorted(
+            [(u.pk, welcome) for u in accepted + [drh]] + [(refused.pk, "Your account request has been refused.")]
+        ))
+        self.assertTrue(User.objects.get(pk=drh.pk).is_staff)
+        self.assertFalse(User.objects.get(pk=refused.pk).is_active)
+        self.assertFalse(Notification.objects.exists())
+        drain()
+        self.assertEqual(Notification.objects.filter(user=already).count(), 0)
+        self.assertEqual(NotificationCounter.objects.unread_for(refused), 1)
+
+    def test_enrollment_decisions_name_the_formation(self):
+        approved, refused, decided = self.enrollment('a'), self.enrollment('r'), self.enrollment('d', 'approved')
+        decide_user_formations(UserFormation.objects.filter(pk__in=[approved.pk, decided.pk]), 'approve', self.admin)
+        decide_user_formations(UserFormation.objects.filter(pk=refused.pk), 'refuse', self.admin)
+        self.assertEqual(self.queued(), sorted([
+            (approved.user_id, "Your registration for 'Formation F0' has been validated."),
+            (refused.user_id, "Your registration for 'Formation F0' has been refused."),
+        ]))
+        self.assertEqual(UserFormation.objects.get(pk=refused.pk).valide_par, 'admin')
+        self.assertIsNone(UserFormation.objects.get(pk=decided.pk).valide_par)
+
+    def test_a_failed_decision_queues_nothing(self):
+        enrollment = self.enrollment('a')
+        with mock.patch('users.approvals.apply_spend', side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                decide_user_formations(UserFormation.objects.all(), 'approve')
+        self.assertEqual(UserFormation.objects.get(pk=enrollment.pk).state_formation, 'pending')
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_admin_actions_and_buttons_queue_notifications(self):
+        self.client.force_login(self.admin)
+        by_action, by_button = self.enrollment('action'), self.enrollment('button')
+        self.client.post(reverse('admin:users_userformation_changelist'), {
+            'action': 'refuse_formations', '_selected_action': [by_action.pk],
+        })
+        with self.assertLogs('users.admin', 'INFO'):
+            self.client.get(reverse('admin:validate-user-formation', args=[by_button.pk]))
+        self.assertEqual(self.queued(), sorted([
+            (by_action.user_id, "Your registration for 'Formation F0' has been refused."),
+            (by_button.user_id, "Your registration for 'Formation F0' has been validated."),
+        ]))
+        self.assertEqual(drain(), (2, 0))
+        self.assertEqual(Notification.objects.get(user_id=by_button.user_id).is_read, False)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class DirectorySyncTests(TestCase):
+    def setUp(self):
+        self.structure = make_structure('S0')
+        self.department = make_department(self.structure, 'D0')
+        make_department(make_structure('S1'), 'D1')
+        self.existing = make_user('known', self.structure, state='pending')
+
+    def sync(self, content, suffix, *args):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w', encoding='utf-8') as stream:
+            stream.write(content)
+        self.addCleanup(os.remove, path)
+        out, err = StringIO(), StringIO()
+        call_command('sync_directory', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_sync_creates_updates_and_approves(self):
+        out, err = self.sync(
+            'email,username,firstname,lastname,role,structure_code,department_code,password\n'
+            'new@example.com,newbie,New,Hire,employee,S0,D0,secret-1\n'
+            'known@example.com,known,Renamed,Person,manager,S0,D0,\n'
+            'lost@example.com,lost,Lost,Person,employee,S0,D1,\n',
+            '.csv', '--approve', '--workers=1',
+        )
+        self.assertIn("1 created, 1 updated, 2 approved", out)
+        self.assertIn("~ known@example.com: user_firstname: '' -> 'Renamed'", out)
+        self.assertIn("department 'D1' is not in that structure", err)
+        newbie = User.objects.get(user_email='new@example.com')
+        self.assertTrue(newbie.check_password('secret-1'))
+        self.assertEqual((newbie.state, newbie.is_active, newbie.department_id), ('approved', True, self.department.pk))
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.user_role, self.existing.state), ('manager', 'approved'))
+
+    def test_ldif_dry_run_writes_nothing(self):
+        out, _ = self.sync(
+            'dn: uid=ldap,ou=people,dc=example\n'
+            'mail: ldap@example.com\n'
+            'uid: ldap\n'
+            'givenName: Ld\n'
+            'sn: Ap\n'
+            'o: S0\n'
+            '\n',
+            '.ldif', '--dry-run',
+        )
+        self.assertIn("+ ldap@example.com (ldap, employee)", out)
+        self.assertIn("Dry run: 1 to create", out)
+        self.assertFalse(User.objects.filter(user_email='ldap@example.com').exists())
+
+    def test_ldif_folded_base64_and_repeated_attributes(self):
+        encoded = base64.b64encode('Élodie-Marie Dupont-Lefèvre'.encode()).decode()
+        entries = list(read_directory(StringIO(
+            'dn: uid=elodie,ou=people,dc=example\n'
+            'mail: elodie@example.com\n'
+            'uid: elo\n'
+            ' die\n'
+            'givenName:: ' + encoded[:12] + '\n'
+            ' ' + encoded[12:] + '\n'
+            'o: S0\n'
+            'o: S1-with-a-long\n'
+            ' -name\n'
+            '\n'
+        ), 'ldif'))
+        self.assertEqual(entries, [(1, {
+            'user_email': 'elodie@example.com',
+            'user_username': 'elodie',
+            'user_firstname': 'Élodie-Marie Dupont-Lefèvre',
+            'structure_code': 'S0',
+        })])
+
+    def test_passwords_are_hashed_in_worker_processes(self):
+        hashes = hash_passwords([f"password-{i}" for i in range(20)], workers=2)
+        self.assertTrue(all(check_password(f"password-{i}", hashed) for i, hashed in enumerate(hashes)))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class MetricsTests(TestCase):
+    databases = {'default', 'shard_1'}
+
+    def setUp(self):
+        registry.reset()
+        self.structure = make_structure()
+        make_formation(self.structure, 'F1')
+        self.user = make_user('employee', self.structure)
+        self.client.force_login(self.user)
+
+    def scrape(self, **extra):
+        return self.client.get('/metrics', **extra).content.decode()
+
+    def test_requests_are_exposed_per_view(self):
+        self.client.get(reverse('users:formation_catalog'))
+        body = self.scrape()
+        self.assertIn(
+            'http_requests_total{view="users:formation_catalog",action="",method="GET",status="200"} 1', body,
+        )
+        self.assertIn('http_sampled_requests_total{view="users:formation_catalog",action=""} 1', body)
+        self.assertRegex(body, r'db_queries_total\{view="users:formation_catalog",action=""\} [1-9]')
+        self.assertIn('outbox_lag_seconds{} 0', body)
+        self.assertIn('catalog_cache_requests_total{outcome="miss"}', body)
+
+    def test_admin_actions_are_labelled(self):
+        User.objects.filter(pk=self.user.pk).update(is_staff=True, is_superuser=True)
+        self.client.post(reverse('admin:users_user_changelist'), {
+            'action': 'export_csv', '_selected_action': [self.user.pk],
+        })
+        self.assertIn('view="admin:users_user_changelist",action="export_csv"', self.scrape())
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_only_timed(self):
+        self.client.get(reverse('users:formation_catalog'))
+        body = self.scrape()
+        self.assertIn('http_request_duration_seconds_count{view="users:formation_catalog",action=""} 1', body)
+        self.assertIn('http_sampled_requests_total{view="users:formation_catalog",action=""} 0', body)
+
+    def test_repeated_statements_are_flagged(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for _ in range(5):
+                User.objects.filter(pk=self.user.pk).exists()
+        self.assertEqual((recorder.count, recorder.duplicates), (5, 4))
+        with self.assertLogs('users.metrics', 'WARNING') as logs:
+            record_request(RequestFactory().get('/'), HttpResponse('ok'), 0.01, recorder)
+        self.assertIn('Possible N+1', logs.output[0])
+        self.assertIn('db_n_plus_one_requests_total{view="<unresolved>",action=""} 1', self.scrape())
+
+    def test_queries_on_every_database_are_recorded(self):
+        def view(request):
+            for alias in ('default', 'shard_1'):
+                with connections[alias].cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            return HttpResponse('ok')
+
+        MetricsMiddleware(view)(RequestFactory().get('/'))
+        self.assertIn('db_queries_total{view="<unresolved>",action=""} 2', self.scrape())
+
+    def test_metrics_are_local_only(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 404)
+
+
+class SQLiteProfileTests(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_connections_get_the_profile(self):
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 20000)
+        self.assertEqual(self.pragma('temp_store'), 2)
+        self.assertEqual(self.pragma('auto_vacuum'), 2)
+        self.assertIsNone(connection.transaction_mode)
+
+    def test_parallel_writers_hit_no_lock_errors(self):
+        # Runs in its own process: the writers need a file database, not the in-memory test one.
+        manage = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manage.py')
+        result = subprocess.run(
+            [sys.executable, manage, 'stress_writes', '--writers=8', '--iterations=10'],
+            capture_output=True, text=True, timeout=120,
+        )
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertIn("0 error(s)", result.stdout)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class WriteTransactionTests(TransactionTestCase):
+    def begins(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return [query['sql'] for query in queries if query['sql'].startswith('BEGIN')]
+
+    def test_only_write_paths_begin_immediate(self):
+        structure = make_structure()
+        formation = make_formation(structure, 'F0')
+        user = make_user('writer', structure)
+        self.assertEqual(self.begins(lambda: enroll([user.pk], [formation.pk])), ['BEGIN IMMEDIATE'])
+        self.assertIn('BEGIN IMMEDIATE', self.begins(lambda: decide_user_formations(UserFormation.objects.all(), 'approve')))
+
+        def read():
+            with transaction.atomic():
+                list(UserFormation.objects.all())
+
+        self.assertEqual(self.begins(read), ['BEGIN'])
+        self.assertIsNone(connection.transaction_mode)
+
+
+# Outside the test transaction, so that the router does not pin every read to 'default'.
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS, READ_REPLICAS=['replica'])
+class ReplicaRouterTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def test_reference_reads_go_to_the_replica_until_a_write(self):
+        structure = make_structure()
+        with primary_scope():
+            self.assertEqual(Formation.objects.all().db, 'replica')
+            self.assertEqual(User.objects.all().db, 'default')
+            with transaction.atomic():
+                self.assertEqual(Formation.objects.all().db, 'default')
+            make_formation(structure, 'F0')
+            self.assertEqual(Formation.objects.all().db, 'default')
+        with primary_scope(), override_settings(READ_REPLICAS=[]):
+            self.assertEqual(Formation.objects.all().db, 'default')
+
+    def test_client_reads_the_primary_after_a_write(self):
+        structure = make_structure()
+        formation = make_formation(structure, 'F0')
+        self.client.force_login(make_user('employee', structure))
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.client.get(reverse('users:formation_detail', args=[formation.pk]))
+        self.assertTrue(replica.captured_queries)
+
+        self.client.post(
+            reverse('users:participate_formation'), json.dumps({'formation_id': formation.pk}),
+            content_type='application/json',
+        )
+        self.assertEqual(self.client.cookies[PRIMARY_COOKIE]['max-age'], 10)
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.client.get(reverse('users:formation_detail', args=[formation.pk]))
+        self.assertEqual(replica.captured_queries, [])
+
+    def test_search_reads_the_primary(self):
+        make_formation(make_structure(), 'F0', formation_titre='Corrosion control')
+        with primary_scope(), CaptureQueriesContext(connections['replica']) as replica:
+            result = search_formations('corrosion')
+        self.assertEqual([row['formation_ref'] for row in result['results']], ['F0'])
+        self.assertEqual(replica.captured_queries, [])
+
+    def test_snapshot_copies_the_primary(self):
+        make_formation(make_structure(), 'F0')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'replica.sqlite3')
+        call_command('snapshot_replica', f'--to={path}', stdout=StringIO())
+        with closing(sqlite3.connect(path)) as copy:
+            self.assertEqual(copy.execute("SELECT formation_ref FROM users_formation").fetchall(), [('F0',)])
+
+
+# Shard connections read the primary's tables, so the primary cannot sit in an open test transaction.
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ShardingTests(TransactionTestCase):
+    databases = {'default', 'shard_1', 'shard_2'}
+
+    def setUp(self):
+        self.sharded, self.unsharded = make_structure('S1'), make_structure('S2')
+        self.formation = make_formation(self.sharded, 'F0')
+        self.employee = make_user('employee', self.sharded)
+        self.other = make_user('other', self.unsharded)
+
+    def shard(self):
+        self.enterContext(self.settings(STRUCTURE_SHARDS={self.sharded.pk: 'shard_1'}))
+
+    def test_rows_live_on_their_users_shard(self):
+        self.shard()
+        enroll([self.employee.pk, self.other.pk], [self.formation.pk])
+        decide_user_formations(UserFormation.objects.all(), 'approve')
+        drain()
+
+        on_shard = UserFormation.objects.using('shard_1').get()
+        self.assertEqual(on_shard.user_id, self.employee.pk)
+        self.assertEqual(on_shard.state_formation, 'approved')
+        self.assertGreater(on_shard.pk, 1 << SHARD_ID_BITS)
+        self.assertEqual(shard_for_pk(on_shard.pk), 'shard_1')
+        self.assertEqual(UserFormation.objects.using('default').get().user_id, self.other.pk)
+        self.assertEqual(Notification.objects.using('shard_1').get().user_id, self.employee.pk)
+        self.assertEqual(NotificationCounter.objects.unread_for(self.employee), 1)
+        self.assertEqual(TrainingSpendSummary.objects.aggregate(total=models.Sum('enrollments'))['total'], 2)
+
+        self.assertEqual(self.employee.user_formations.get(), on_shard)
+        self.assertEqual(list(UserFormation.objects.for_user(self.other)), [UserFormation.objects.using('default').get()])
+        merged = UserFormation.objects.order_by('-user__user_username')
+        self.assertEqual([uf.user_id for uf in merged], [self.other.pk, self.employee.pk])
+        self.assertEqual([uf.user_id for uf in merged[1:]], [self.employee.pk])
+        self.assertEqual(merged.count(), 2)
+        self.assertEqual(UserFormation.objects.update(valide_par='auditor'), 2)
+        self.assertEqual(Notification.objects.aggregate(count=models.Count('pk'))['count'], 2)
+
+    @override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+    def test_benchmark_counts_and_rolls_back_shard_writes(self):
+        self.client.force_login(self.employee)
+        scenario = Scenario('participate_formation', 'employee', 'post', reverse('users:participate_formation'),
+                            {'formation_id': self.formation.pk}, 4)
+        unsharded = run_scenario(self.client, scenario, repeat=1)
+        self.shard()
+        sharded = run_scenario(self.client, scenario, repeat=1)
+        self.assertEqual(sharded['status'], 200)
+        # Same queries plus the lookup of the user's shard; uncounted shard queries would make it fewer.
+        self.assertGreater(sharded['queries'], unsharded['queries'])
+        self.assertFalse(UserFormation.objects.exists())
+
+    def test_admin_changelist_and_feed_read_the_shards(self):
+        self.shard()
+        enroll([self.employee.pk, self.other.pk], [self.formation.pk])
+        decide_user_formations(UserFormation.objects.all(), 'approve')
+        drain()
+        admin_user = make_user('admin', self.unsharded, role='admin')
+        User.objects.filter(pk=admin_user.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:users_userformation_changelist'))
+        self.assertContains(response, 'employee - Formation F0')
+        self.assertContains(response, 'other - Formation F0')
+
+        self.client.force_login(self.employee)
+        feed = self.client.get(reverse('users:notification_feed')).json()
+        self.assertEqual(len(feed['results']), 1)
+
+    def test_marking_read_rolls_back_on_the_shard(self):
+        self.shard()
+        notification = Notification.objects.create(user=self.employee, message="Hello")
+        self.client.force_login(self.employee)
+        with mock.patch('users.models.NotificationCounterManager.adjust', side_effect=DatabaseError("locked")):
+            for name, data in (
+                ('users:mark_notification_read', json.dumps({'notification_id': notification.pk})),
+                ('users:mark_all_notifications_read', None),
+            ):
+                response = self.client.post(reverse(name), data, content_type='application/json')
+                self.assertEqual(response.json()['status'], 'error')
+        self.assertFalse(Notification.objects.using('shard_1').get().is_read)
+
+    def test_rebalance_moves_rows_to_the_new_shard(self):
+        enroll([self.employee.pk], [self.formation.pk])
+        Notification.objects.create(user=self.employee, message="Hello")
+        self.shard()
+        call_command('rebalance_shards', stdout=StringIO())
+        self.assertFalse(UserFormation.objects.using('default').exists())
+        self.assertEqual(UserFormation.objects.using('shard_1').get().user_id, self.employee.pk)
+        self.assertEqual(Notification.objects.using('shard_1').get().message, "Hello")
+        self.assertEqual(NotificationCounter.objects.unread_for(self.employee), 1)
+
+        self.employee.delete()
+        self.assertFalse(UserFormation.objects.exists())
+        self.assertFalse(Notification.objects.exists())
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.counts = generate(scale=0.002)
+
+    def test_generator_loads_every_table(self):
+        self.assertEqual(self.counts['UserFormation'], 2000)
+        self.assertEqual(NotificationCounter.objects.aggregate(total=models.Sum('unread'))['total'],
+                         Notification.objects.filter(is_read=False).count())
+        with self.assertRaises(ValueError):
+            generate(scale=0.002)
+
+    def test_every_view_stays_within_its_query_budget(self):
+        actors = benchmark_actors()
+        for scenario in benchmark_scenarios(actors):
+            with self.subTest(scenario.name):
+                self.client.force_login(actors[scenario.actor])
+                result = run_scenario(self.client, scenario, repeat=1)
+                self.assertLess(result['status'], 400)
+                self.assertLessEqual(result['queries'], scenario.budget)
+
+    def test_command_writes_a_json_report(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        call_command('benchmark', '--repeat=1', '--only=formation_catalog', f'--output={path}', stdout=StringIO())
+        with open(path, encoding='utf-8') as stream:
+            report = json.load(stream)
+        self.assertEqual([result['name'] for result in report['results']], ['formation_catalog'])
+        self.assertEqual(report['rows']['UserFormation'], 2000)
@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import time
+from django.conf import settings
+from django.core.cache import caches
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# scope -> (attempts, window in seconds)
+DEFAULT_LOGIN_THROTTLE_RATES = {
+    'ip': (20, 60),
+    'email': (5, 300),
+}
+THROTTLE_OUTCOMES = ('allowed', 'blocked')
+
+
+def throttle_cache():
+    return caches[getattr(settings, 'LOGIN_THROTTLE_CACHE', 'default')]
+
+
+class SlidingWindowThrottle:
+    """Approximate sliding window over two fixed windows.
+
+    The previous window's count is weighted by how much of it still overlaps
+    the sliding window, which needs two cache keys per identifier and no list
+    of timestamps.
+    """
+
+    def __init__(self, scope, limit, window):
+        self.scope = scope
+        self.limit = limit
+        self.window = window
+
+    def _key(self, ident, index):
+        digest = hashlib.sha256(str(ident).lower().encode('utf-8')).hexdigest()[:32]
+        return f"throttle:{self.scope}:{digest}:{index}"
+
+    def _keys(self, ident, now):
+        index = int(now // self.window)
+        return self._key(ident, index), self._key(ident, index - 1)
+
+    def count(self, ident, now=None):
+        now = time.time() if now is None else now
+        current, previous = self._keys(ident, now)
+        counts = throttle_cache().get_many([current, previous])
+        overlap = 1 - (now % self.window) / self.window
+        return counts.get(current, 0) + counts.get(previous, 0) * overlap
+
+    def allows(self, ident, now=None):
+        return self.count(ident, now) < self.limit
+
+    def hit(self, ident, now=None):
+        now = time.time() if now is None else now
+        current, _ = self._keys(ident, now)
+        cache = throttle_cache()
+        # Kept for two windows: the next window still reads it as its previous one.
+        cache.add(current, 0, self.window * 2)
+        try:
+            cache.incr(current)
+        except ValueError:
+            cache.set(current, 1, self.window * 2)
+
+    def reset(self, ident):
+        index = int(time.time() // self.window)
+        throttle_cache().delete_many([self._key(ident, index), self._key(ident, index - 1)])
+
+
+def login_throttles():
+    rates = getattr(settings, 'LOGIN_THROTTLE_RATES', DEFAULT_LOGIN_THROTTLE_RATES)
+    return {scope: SlidingWindowThrottle(scope, limit, window) for scope, (limit, window) in rates.items()}
+
+
+def client_ip(request):
+    return request.META.get('REMOTE_ADDR') or 'unknown'
+
+
+def check_login_attempt(request, email):
+    """Count a login attempt; return the seconds to wait if it must be refused, else None.
+
+    Runs before ``authenticate()`` so that refused attempts never reach the password hasher.
+    """
+    idents = {'ip': client_ip(request), 'email': (email or '').strip()}
+    throttles = login_throttles()
+    for scope, throttle in throttles.items():
+        if scope in idents and not throttle.allows(idents[scope]):
+            registry.increment('login_throttle', 'blocked')
+            logger.warning("Login throttled by %s limit for %s", scope, idents['ip'])
+            return throttle.window
+    for scope, throttle in throttles.items():
+        if scope in idents:
+            throttle.hit(idents[scope])
+    registry.increment('login_throttle', 'allowed')
+    return None
+
+
+def login_succeeded(email):
+    throttle = login_throttles().get('email')
+    if throttle is not None:
+        throttle.reset((email or '').strip())
+
+
+def throttle_stats():
+    return registry.counts('login_throttle', THROTTLE_OUTCOMES)
@@ -12,8 +12,17 @@ urlpatterns = [
     path('<int:pk>/delete/', views.UserDeleteView.as_view(), name='user_delete'),  # Delete a user
     path('logout/', user_logout, name='logout'),
     path('participate/', views.participate_formation, name='participate_formation'),  # Participate in a formation
+    path('participate/batch/', views.enroll_batch, name='enroll_batch'),
     path('mark_notification_read/', views.mark_notification_read, name='mark_notification_read'),
     path('mark_all_notifications_read/', views.mark_all_notifications_read, name='mark_all_notifications_read'),
     path('register/', views.register, name='register'),
+    path('structures/<int:pk>/departments/', views.structure_departments, name='structure_departments'),
+    path('notifications/', views.notification_feed, name='notification_feed'),
+    path('notifications/stream/', views.notification_stream, name='notification_stream'),
+    path('notifications/poll/', views.notification_poll, name='notification_poll'),
+    path('formations/', views.formation_catalog, name='formation_catalog'),
+    path('formations/search/', views.formation_search, name='formation_search'),
+    path('team/', views.team_formation_matrix, name='team_formation_matrix'),
+    path('formations/<int:pk>/', views.formation_detail, name='formation_detail'),
 
 ]
\ No newline at end of file
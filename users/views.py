@@ -3,22 +3,44 @@ from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import redirect, render
 from django.urls import reverse_lazy
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from .models import User, Formation, UserFormation, Notification, Structure, Department
+from django.db.models import Q
+from .models import User, Formation, UserFormation, Notification, NotificationCounter
 from .forms import UserForm, RegistrationForm
+from .catalog import (
+    FORMATION_DETAIL_FIELDS, catalog_cache_stats, cached_catalog_page, cached_facet_values, parse_catalog_params,
+)
+from .search import SEARCH_MAX_PAGE_SIZE, search_formations
+from .team import subordinates_queryset, team_matrix, with_enrollments
+from .reference import cached_departments, cached_structures
+from .sharding import shard_atomic, shard_for_user
+from .throttle import check_login_attempt, client_ip, login_succeeded, throttle_stats
+from .metrics import render_prometheus
+from .outbox import outbox_lag
+from .enrollment import ALREADY_ENROLLED, CREATED, ENROLL_BATCH_LIMIT, NOT_FOUND, enroll
+from .streaming import LONG_POLL_TIMEOUT, long_poll, publish_unread, sse_stream
+from datetime import datetime
 import json
 
 def user_login(request):
     if request.method == 'POST':
         email = request.POST.get('email')
         password = request.POST.get('password')
+        retry_after = check_login_attempt(request, email)
+        if retry_after is not None:
+            messages.error(request, "Too many login attempts. Please try again later.")
+            response = render(request, 'login.html', {'structures': cached_structures()}, status=429)
+            response['Retry-After'] = str(retry_after)
+            return response
         user = authenticate(request, user_email=email, password=password)
         if user is not None:
             if user.state != 'approved':
                 messages.error(request, "Your account is not yet approved. Please wait for admin approval.")
             else:
                 login(request, user)
+                login_succeeded(email)
 
 
                 if user.user_role == 'DRH' or user.user_role == 'admin':
@@ -28,9 +50,27 @@ def user_login(request):
                     return redirect('users:user_list')
         else:
             messages.error(request, "Invalid email or password.")
-    structures = Structure.objects.all()
-    departments = Department.objects.all()
-    return render(request, 'login.html', {'structures': structures, 'departments': departments})
+    return render(request, 'login.html', {'structures': cached_structures()})
+
+def structure_departments(request, pk):
+    # Public: feeds the registration form's department list once a structure is picked.
+    return JsonResponse({'status': 'success', 'departments': cached_departments(pk)})
+
+def metrics(request):
+    # Prometheus scrape target, only answered for the addresses in METRICS_ALLOWED_IPS.
+    if client_ip(request) not in getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')):
+        return HttpResponse(status=404)
+    lag = outbox_lag()
+    body = render_prometheus([
+        ('login_throttle_checks_total', 'counter', 'Login attempts checked by the throttle.',
+         [({'outcome': outcome}, count) for outcome, count in throttle_stats().items()]),
+        ('outbox_events', 'gauge', 'Outbox events waiting for delivery.',
+         [({'state': 'pending'}, lag['pending']), ({'state': 'failed'}, lag['failed'])]),
+        ('outbox_lag_seconds', 'gauge', 'Age of the oldest pending outbox event.', [({}, lag['lag_seconds'])]),
+        ('catalog_cache_requests_total', 'counter', 'Catalog page and facet lookups by cache outcome.',
+         [({'outcome': outcome}, count) for outcome, count in catalog_cache_stats().items()]),
+    ])
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
 
 def user_logout(request):
     logout(request)
@@ -60,34 +100,90 @@ def participate_formation(request):
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            formation_id = data.get('formation_id')
-            formation = Formation.objects.get(formation_id=formation_id)
+            formation_id = int(data.get('formation_id'))
             user = request.user
-            if UserFormation.objects.filter(user=user, formation=formation).exists():
+            state = enroll([user.pk], [formation_id], actor=user)[(user.pk, formation_id)]
+            if state == ALREADY_ENROLLED:
                 return JsonResponse({'status': 'error', 'message': 'You are already registered for this formation.'})
-            user_formation = UserFormation(
-                user=user,
-                formation=formation,
-                state_formation='pending'
-            )
-            user_formation.save()
+            if state == NOT_FOUND:
+                return JsonResponse({'status': 'error', 'message': 'Formation not found.'})
             return JsonResponse({'status': 'success', 'message': 'Successfully registered for the formation!'})
-        except Formation.DoesNotExist:
+        except (TypeError, ValueError):
             return JsonResponse({'status': 'error', 'message': 'Formation not found.'})
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': str(e)})
     return JsonResponse({'status': 'error', 'message': 'Invalid request method.'})
 
+def _id_list(values):
+    if not isinstance(values, list):
+        raise ValueError
+    return [int(value) for value in values]
+
+@login_required
+def enroll_batch(request):
+    """Enroll the current user in many formations, or a manager's team in one formation.
+
+    Body: ``{"formation_ids": [...]}`` or ``{"formation_id": id, "user_ids": [...]}``.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method.'}, status=405)
+    try:
+        data = json.loads(request.body)
+        if 'user_ids' in data:
+            formation_ids = [int(data.get('formation_id'))]
+            user_ids = _id_list(data['user_ids'])
+        else:
+            formation_ids = _id_list(data.get('formation_ids'))
+            user_ids = [request.user.pk]
+    except (TypeError, ValueError):
+        return JsonResponse({'status': 'error', 'message': 'Invalid enrollment request.'}, status=400)
+    if len(user_ids) * len(formation_ids) > ENROLL_BATCH_LIMIT:
+        return JsonResponse(
+            {'status': 'error', 'message': f'At most {ENROLL_BATCH_LIMIT} enrollments per request.'}, status=400
+        )
+
+    forbidden = set()
+    if user_ids != [request.user.pk]:
+        team = set(subordinates_queryset(request.user).filter(pk__in=user_ids).values_list('pk', flat=True))
+        forbidden = set(user_ids) - team
+    states = enroll([u for u in user_ids if u not in forbidden], formation_ids, actor=request.user)
+    results = [
+        {
+            'user_id': user_id,
+            'formation_id': formation_id,
+            'result': 'forbidden' if user_id in forbidden else states[(user_id, formation_id)],
+        }
+        for user_id in dict.fromkeys(user_ids)
+        for formation_id in dict.fromkeys(formation_ids)
+    ]
+    created = sum(result['result'] == CREATED for result in results)
+    return JsonResponse({
+        'status': 'success' if created else 'error',
+        'message': f'{created} enrollment(s) created.',
+        'results': results,
+    })
+
 @login_required
 def mark_notification_read(request):
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
             notification_id = data.get('notification_id')
-            notification = Notification.objects.get(notification_id=notification_id, user=request.user)
-            notification.is_read = True
-            notification.save()
-            return JsonResponse({'status': 'success', 'message': 'Notification marked as read.'})
+            # The notifications are on the user's shard, the counter on 'default'.
+            with shard_atomic([shard_for_user(request.user)]):
+                marked = Notification.objects.for_user(request.user).filter(
+                    notification_id=notification_id, is_read=False
+                ).update(is_read=True)
+                if marked:
+                    NotificationCounter.objects.adjust({request.user.pk: -marked})
+                    publish_unread([request.user.pk])
+                elif not Notification.objects.for_user(request.user).filter(notification_id=notification_id).exists():
+                    raise Notification.DoesNotExist
+            return JsonResponse({
+                'status': 'success',
+                'message': 'Notification marked as read.',
+                'unread': NotificationCounter.objects.unread_for(request.user),
+            })
         except Notification.DoesNotExist:
             return JsonResponse({'status': 'error', 'message': 'Notification not found.'})
         except Exception as e:
@@ -98,12 +194,128 @@ def mark_notification_read(request):
 def mark_all_notifications_read(request):
     if request.method == 'POST':
         try:
-            request.user.notifications.filter(is_read=False).update(is_read=True)
-            return JsonResponse({'status': 'success', 'message': 'All notifications marked as read.'})
+            with shard_atomic([shard_for_user(request.user)]):
+                marked = Notification.objects.for_user(request.user).filter(is_read=False).update(is_read=True)
+                NotificationCounter.objects.adjust({request.user.pk: -marked})
+                if marked:
+                    publish_unread([request.user.pk])
+            return JsonResponse({'status': 'success', 'message': 'All notifications marked as read.', 'unread': 0})
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': str(e)})
     return JsonResponse({'status': 'error', 'message': 'Invalid request method.'})
 
+NOTIFICATION_FEED_PAGE_SIZE = 20
+NOTIFICATION_FEED_MAX_PAGE_SIZE = 100
+
+@login_required
+def notification_feed(request):
+    # Keyset pagination on (created_at, notification_id), served by notification_feed_idx.
+    try:
+        limit = min(int(request.GET.get('limit') or NOTIFICATION_FEED_PAGE_SIZE), NOTIFICATION_FEED_MAX_PAGE_SIZE)
+        cursor = request.GET.get('cursor')
+        if cursor:
+            created_at, notification_id = cursor.rsplit('_', 1)
+            created_at, notification_id = datetime.fromisoformat(created_at), int(notification_id)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid feed parameters.'}, status=400)
+    qs = Notification.objects.for_user(request.user)
+    if request.GET.get('unread', '1') == '1':
+        qs = qs.filter(is_read=False)
+    if cursor:
+        qs = qs.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, notification_id__lt=notification_id)
+        )
+    rows = list(
+        qs.order_by('-created_at', '-notification_id')
+        .values('notification_id', 'message', 'created_at', 'is_read')[:limit + 1]
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['created_at'].isoformat()}_{rows[-1]['notification_id']}"
+    return JsonResponse({
+        'status': 'success',
+        'results': rows,
+        'next_cursor': next_cursor,
+        'unread': NotificationCounter.objects.unread_for(request.user),
+    })
+
+@login_required
+def formation_catalog(request):
+    if request.method != 'GET':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method.'}, status=405)
+    try:
+        filters, cursor, limit = parse_catalog_params(request.GET)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid catalog parameters.'}, status=400)
+    page = cached_catalog_page(filters, cursor, limit)
+    return JsonResponse({'status': 'success', **page})
+
+@login_required
+def formation_search(request):
+    if request.method != 'GET':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method.'}, status=405)
+    try:
+        filters, _, limit = parse_catalog_params(request.GET)
+        offset = int(request.GET.get('offset') or 0)
+        if offset < 0:
+            raise ValueError("offset must not be negative")
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid search parameters.'}, status=400)
+    result = search_formations(request.GET.get('q', ''), filters, min(limit, SEARCH_MAX_PAGE_SIZE), offset)
+    return JsonResponse({'status': 'success', **result})
+
+@login_required
+def formation_detail(request, pk):
+    formation = Formation.objects.filter(formation_id=pk).values(*FORMATION_DETAIL_FIELDS).first()
+    if formation is None:
+        return JsonResponse({'status': 'error', 'message': 'Formation not found.'}, status=404)
+    return JsonResponse({'status': 'success', 'formation': formation})
+
+@login_required
+def team_formation_matrix(request):
+    if request.user.user_role not in ('manager', 'department_chief'):
+        return JsonResponse({'status': 'error', 'message': 'Only managers and department chiefs have a team.'}, status=403)
+    try:
+        page = int(request.GET.get('page') or 1)
+        department_id = request.GET.get('department')
+        department_id = int(department_id) if department_id else None
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid team parameters.'}, status=400)
+    return JsonResponse({'status': 'success', **team_matrix(request.user, page, department_id)})
+
+def _stream_since(request):
+    value = request.headers.get('Last-Event-ID') or request.GET.get('since') or 0
+    return int(value)
+
+async def notification_stream(request):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'status': 'error', 'message': 'Authentication required.'}, status=401)
+    try:
+        since = _stream_since(request)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid event id.'}, status=400)
+    response = StreamingHttpResponse(sse_stream(user.pk, since), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def notification_poll(request):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'status': 'error', 'message': 'Authentication required.'}, status=401)
+    try:
+        since = _stream_since(request)
+        timeout = min(float(request.GET.get('timeout') or LONG_POLL_TIMEOUT), LONG_POLL_TIMEOUT)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid poll parameters.'}, status=400)
+    notifications, unread = await long_poll(user.pk, since, timeout)
+    last_id = max([since] + [n['notification_id'] for n in notifications])
+    return JsonResponse({'status': 'success', 'notifications': notifications, 'unread': unread, 'last_id': last_id})
+
 class UserListView(ListView):
     model = User
     template_name = 'users/index.html'
@@ -112,28 +324,29 @@ class UserListView(ListView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.request.user
-        if user.is_authenticated and user.structure:
-            context['formations'] = Formation.objects.all()
+        if user.is_authenticated and user.structure_id:
+            # Only the first catalog page is rendered; the rest is fetched from formation_catalog on scroll.
+            context['formation_page'] = cached_catalog_page()
+            context['formation_levels'] = cached_facet_values('formation_niveau')
+            context['formation_countries'] = cached_facet_values('formation_pays')
         else:
-            context['formations'] = Formation.objects.none()
+            context['formation_page'] = {'results': [], 'next_cursor': None}
+            context['formation_levels'] = []
+            context['formation_countries'] = []
+        context['formation_categories'] = Formation._meta.get_field('formation_category').choices
         if user.is_authenticated:
-            context['user_formations'] = UserFormation.objects.filter(user=user)
-            context['notifications'] = Notification.objects.filter(user=user, is_read=False)
-            if user.user_role == 'manager' and user.structure:
-                context['subordinate_employees'] = User.objects.filter(
-                    structure=user.structure,
-                    state='approved'
-                ).exclude(user_id=user.user_id).select_related('department', 'structure')
-            elif user.user_role == 'department_chief' and user.department:
-                context['subordinate_employees'] = User.objects.filter(
-                    department=user.department,
-                    state='approved'
-                ).exclude(user_id=user.user_id).select_related('department', 'structure')
-            else:
-                context['subordinate_employees'] = User.objects.none()
+            context['user_formations'] = UserFormation.objects.for_user(user).select_related('formation')
+            # The badge reads the denormalized counter; the dropdown loads from notification_feed when opened.
+            context['unread_count'] = NotificationCounter.objects.unread_for(user)
+            context['last_notification_id'] = (
+                Notification.objects.for_user(user).order_by('-notification_id')
+                .values_list('notification_id', flat=True).first() or 0
+            )
+            context['subordinate_employees'] = with_enrollments(subordinates_queryset(user))
         else:
             context['user_formations'] = UserFormation.objects.none()
-            context['notifications'] = Notification.objects.none()
+            context['unread_count'] = 0
+            context['last_notification_id'] = 0
             context['subordinate_employees'] = User.objects.none()
         context['user'] = user
         return context